@@ -140,13 +140,10 @@ class MonkeyCLI(Cmd):
                 monkeycli.core_info.list_local_instances())
             print("Available instances", available_instances)
             if instance is None:
-                raise ValueError(
-                    "Please define an instance to run on the local provider. "
-                    +
-                    f"\nAvailable instance include: \n{available_instances}" +
-                    "\nTo run with instance set use monkey run -i <instance_name>"
-                )
-            job_yaml["instance"] = args.instance
+                print("No instance set, Monkey Core will pick one with the " +
+                      "provider's placement policy")
+            else:
+                job_yaml["instance"] = args.instance
 
         job_uid = self.get_new_job_uid()
         job_yaml["job_uid"] = job_uid
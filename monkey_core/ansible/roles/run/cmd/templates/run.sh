@@ -1,5 +1,11 @@
 #!/bin/bash
 set -m
+# Holds the cached environment's lock shared until the job and everything
+# it starts exit, so the environment isn't evicted under the job
+if [ -f {{job_dir_path}}/.monkey_env_lock ]; then
+    exec 9>>"$(cat {{job_dir_path}}/.monkey_env_lock)"
+    flock -s 9
+fi
 touch {{activate_file}}
 . {{activate_file}}  | tee -a {{job_dir_path}}/logs/run.log
 echo Activated environment correctly 2>&1 | tee -a {{job_dir_path}}/logs/run.log
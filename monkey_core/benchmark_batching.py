@@ -0,0 +1,117 @@
+"""Compares machine creation latency for many jobs with identical machine
+params, with and without batched create_instances calls
+
+The provider is fake: every create call takes --call-time seconds plus
+--machine-time per machine, and at most --api-concurrency calls run at once,
+like a rate limited cloud API.  No cloud account is needed:
+
+    python3 benchmark_batching.py -n 64 --window 0.5
+
+Machines are requested by dispatch workers, so at most
+--max-concurrent-dispatches requests are in flight and a batch holds no more
+than that.  Raise it along with max_batch_size in providers.yml for bigger
+batches:
+
+    python3 benchmark_batching.py -n 64 --max-concurrent-dispatches 64
+"""
+import argparse
+import statistics
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+from core.provider.monkey_provider import MonkeyProvider
+
+
+class FakeProvider(MonkeyProvider):
+
+    def __init__(self, provider_info, call_time, machine_time,
+                 api_concurrency):
+        super().__init__(provider_info)
+        self.provider_type = "fake"
+        self.call_time = call_time
+        self.machine_time = machine_time
+        self.api_semaphore = threading.Semaphore(api_concurrency)
+        self.api_calls = 0
+        self.api_calls_lock = threading.Lock()
+
+    def call_api(self, job_ymls):
+        with self.api_semaphore:
+            with self.api_calls_lock:
+                self.api_calls += 1
+            time.sleep(self.call_time + self.machine_time * len(job_ymls))
+        return {
+            x["job_uid"]: (SimpleNamespace(name=x["job_uid"]), True)
+            for x in job_ymls
+        }
+
+    def create_instance(self, machine_params, job_yml):
+        return self.call_api([job_yml])[job_yml["job_uid"]]
+
+    def create_instances(self, machine_params, job_ymls):
+        return self.call_api(job_ymls)
+
+
+def run(args, window):
+    provider = FakeProvider(
+        {
+            "name": "fake",
+            "batch_create_window": window,
+            "max_batch_size": args.max_batch_size,
+            "max_concurrent_dispatches": args.max_concurrent_dispatches,
+        },
+        call_time=args.call_time,
+        machine_time=args.machine_time,
+        api_concurrency=args.api_concurrency)
+    machine_params = {"machine_type": "n1-standard-1", "zone": "fake-zone"}
+
+    def request(index):
+        _, success = provider.request_instance(
+            machine_params=dict(machine_params, monkey_job_uid=f"job-{index}"),
+            job_yml={"job_uid": f"job-{index}"})
+        # Every job is submitted at the start, and may wait for a slot
+        return time.time() - start, success
+
+    start = time.time()
+    # Each worker holds one of the provider's dispatch slots
+    workers = min(args.jobs, provider.max_concurrent_dispatches)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(request, range(args.jobs)))
+    total = time.time() - start
+    latencies = [x for x, _ in results]
+    failed = len([x for _, x in results if not x])
+    return provider.api_calls, latencies, total, failed
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark batched machine creation")
+    parser.add_argument("-n", type=int, default=64, dest="jobs")
+    parser.add_argument("--window",
+                        type=float,
+                        default=0.5,
+                        help="batch_create_window of the batched run")
+    parser.add_argument("--max-batch-size", type=int, default=64)
+    parser.add_argument("--max-concurrent-dispatches",
+                        type=int,
+                        default=MonkeyProvider.max_concurrent_dispatches,
+                        help="Dispatch slots of the provider")
+    parser.add_argument("--call-time", type=float, default=1.0)
+    parser.add_argument("--machine-time", type=float, default=0.01)
+    parser.add_argument("--api-concurrency", type=int, default=4)
+    args = parser.parse_args()
+
+    print("{:<10} {:>9} {:>10} {:>10} {:>10} {:>9}".format(
+        "Mode", "api calls", "mean(s)", "p50(s)", "max(s)", "total(s)"))
+    for name, window in (("single", 0), ("batched", args.window)):
+        api_calls, latencies, total, failed = run(args, window)
+        print("{:<10} {:>9} {:>10.2f} {:>10.2f} {:>10.2f} {:>9.2f}".format(
+            name, api_calls, statistics.mean(latencies),
+            statistics.median(latencies), max(latencies), total))
+        if failed > 0:
+            print(f"{failed} machine(s) failed to create")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,145 @@
+"""Measures how long background jobs wait between submission and DISPATCHING,
+with the event-driven dispatcher and with the periodic scan it replaced
+
+Jobs are submitted with foreground=False at a steady rate to a fake provider
+whose jobs finish immediately.  Runs against an in-memory mongomock
+database, no mongo or cloud account is needed:
+
+    pip install mongomock
+    python3 benchmark_dispatch.py -n 20 --spacing 0.5 --interval 10
+
+The periodic mode scans for queued jobs every --interval seconds, like
+daemon_loop did before dispatching was event driven.
+"""
+import argparse
+import statistics
+import threading
+import time
+
+import mongomock
+import mongoengine
+
+from core import monkey_global
+import core.mongo.mongo_global as monkey_state
+from core.mongo import monkey_job
+from core.mongo.monkey_job import MonkeyJob
+from core.monkey import Monkey
+from core.provider.monkey_provider import MonkeyProvider
+
+
+def connect_mongomock():
+    mongoengine.disconnect()
+    try:
+        mongoengine.connect("monkeydb",
+                            host="mongodb://localhost",
+                            mongo_client_class=mongomock.MongoClient)
+    except TypeError:
+        # mongoengine < 0.27
+        mongoengine.connect("monkeydb", host="mongomock://localhost")
+
+
+class FakeProvider(MonkeyProvider):
+
+    def __init__(self, provider_info):
+        super().__init__(provider_info)
+        self.provider_type = "fake"
+
+
+class BenchmarkMonkey(Monkey):
+    """Dispatches jobs to a fake provider and returns as soon as they run"""
+
+    def __init__(self, jobs):
+        self.jobs = jobs
+        super().__init__(start_loop=False)
+        self.max_concurrent_dispatches = jobs
+
+    def instantiate_providers(self, providers_path=None):
+        self.providers = [
+            FakeProvider({
+                "name": "fake",
+                "max_concurrent_dispatches": self.jobs
+            })
+        ]
+
+    def run_job(self, provider, job_yml):
+        return True, "Job completed"
+
+
+def run(args, mode):
+    MonkeyJob.drop_collection()
+    monkey = BenchmarkMonkey(jobs=args.jobs)
+    submit_times = dict()
+    dispatch_times = dict()
+    all_dispatched = threading.Event()
+
+    def record_dispatch(job, previous_state, state, elapsed):
+        if state == monkey_state.MONKEY_STATE_DISPATCHING:
+            dispatch_times[job.job_uid] = time.time()
+            if len(dispatch_times) == args.jobs:
+                all_dispatched.set()
+
+    monkey_job.add_state_listeners(monkey.owner_id,
+                                   transition_listeners=[record_dispatch])
+    stop = threading.Event()
+    if mode == "event":
+        # The wiring of Monkey(start_loop=True) without the daemon loop
+        monkey_job.add_state_listeners(
+            monkey.owner_id, change_listeners=[monkey.notify_scheduler])
+        threading.Thread(target=monkey.dispatch_loop, daemon=True).start()
+    else:
+
+        def scan():
+            while not stop.wait(args.interval):
+                monkey.check_for_queued_jobs()
+
+        threading.Thread(target=scan, daemon=True).start()
+
+    for index in range(args.jobs):
+        job_uid = f"{mode}-{index}-bench"
+        submit_times[job_uid] = time.time()
+        job_yml = {"job_uid": job_uid, "provider": "fake"}
+        monkey.submit_job(job_yml, foreground=False)
+        time.sleep(args.spacing)
+    all_dispatched.wait(timeout=args.interval + args.timeout)
+    stop.set()
+    monkey.close()
+    return [dispatch_times[x] - y
+            for x, y in submit_times.items()
+            if x in dispatch_times]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark submit to DISPATCHING latency")
+    parser.add_argument("-n", type=int, default=20, dest="jobs")
+    parser.add_argument("--spacing",
+                        type=float,
+                        default=0.5,
+                        help="Seconds between submissions")
+    parser.add_argument("--interval",
+                        type=float,
+                        default=10,
+                        help="Scan interval of the periodic mode")
+    parser.add_argument("--timeout",
+                        type=float,
+                        default=30,
+                        help="Seconds to wait for the last dispatch")
+    args = parser.parse_args()
+
+    monkey_global.QUIET_PERIODIC_PRINTOUT = True
+    connect_mongomock()
+    print("{:<10} {:>10} {:>10} {:>10} {:>10}".format("Mode", "dispatched",
+                                                      "mean(s)", "p50(s)",
+                                                      "max(s)"))
+    for mode in ("event", "periodic"):
+        latencies = run(args, mode)
+        if len(latencies) == 0:
+            print("{:<10} {:>10}".format(mode, 0))
+            continue
+        print("{:<10} {:>10} {:>10.3f} {:>10.3f} {:>10.3f}".format(
+            mode, len(latencies), statistics.mean(latencies),
+            statistics.median(latencies), max(latencies)))
+
+
+if __name__ == '__main__':
+    main()
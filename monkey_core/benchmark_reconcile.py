@@ -0,0 +1,178 @@
+"""Compares the load and write cost of one reconciliation pass over a seeded
+job collection, with the current query and with the full scan it replaced
+
+The collection is seeded with mostly finished jobs and a few active ones.
+Runs against a real mongo given with --host, where the state indexes are
+used, or an in-memory mongomock database.  mongomock scans every document
+in python, so it defaults to 5k jobs instead of 50k:
+
+    python3 benchmark_reconcile.py --host mongodb://localhost:27017/monkeydb_benchmark
+    pip install mongomock
+    python3 benchmark_reconcile.py -n 5000 --active 200
+
+The benchmark drops and reseeds the MonkeyJob collection of the database it
+connects to, never point it at monkeydb.
+"""
+import argparse
+import random
+import statistics
+import time
+from datetime import datetime, timedelta
+
+import mongoengine
+
+from core import monkey_global
+import core.mongo.mongo_global as monkey_state
+from core.loop.monkey_loop import get_reconcile_jobs
+from core.mongo.monkey_job import MonkeyJob
+
+
+def connect(host):
+    mongoengine.disconnect()
+    if host is not None:
+        mongoengine.connect(host=host)
+        return
+    import mongomock
+    try:
+        mongoengine.connect("monkeydb_benchmark",
+                            host="mongodb://localhost",
+                            mongo_client_class=mongomock.MongoClient)
+    except TypeError:
+        # mongoengine < 0.27
+        mongoengine.connect("monkeydb_benchmark", host="mongomock://localhost")
+
+
+def seed_jobs(jobs, active, days, indexes):
+    MonkeyJob.drop_collection()
+    collection = MonkeyJob._get_collection()
+    if indexes:
+        MonkeyJob.ensure_indexes()
+    else:
+        # mongomock never reads through indexes, but checks unique ones by
+        # scanning the collection on every write
+        collection.drop_indexes()
+    now = datetime.now()
+    documents = []
+    for index in range(jobs):
+        creation_date = now - timedelta(days=random.uniform(0, days))
+        document = {
+            "job_uid": f"bench-{index}",
+            "job_random_suffix": f"{index}",
+            "job_yml": {
+                "job_uid": f"bench-{index}",
+                "instance": "bench-host"
+            },
+            "provider_type": "local",
+            "provider_name": "bench",
+            "provider_vars": {
+                "name": "bench",
+                "type": "local"
+            },
+            "priority": 0,
+            "project_name": "",
+            "dispatch_attempts": 0,
+            "completed_stages": [],
+            "creation_date": creation_date,
+            "run_timeout_time": -1,
+            "run_elapsed_time": 0,
+            "total_wall_time": 0,
+            "setup_timings": {},
+            "task_timings": {},
+            "experiment_hyperparameters": {},
+        }
+        if index < active:
+            document["state"] = random.choice(
+                monkey_state.MONKEY_RECONCILE_STATES)
+            document["last_state_change"] = now
+        else:
+            completion_date = creation_date + timedelta(minutes=30)
+            document["state"] = monkey_state.MONKEY_STATE_FINISHED
+            document["last_state_change"] = completion_date
+            document["completion_date"] = min(completion_date, now)
+        documents.append(document)
+    for start in range(0, len(documents), 5000):
+        collection.insert_many(documents[start:start + 5000])
+
+
+def full_scan_pass():
+    """A pass as reconciliation ran before, loading and saving every job
+    created in the last 10 days
+
+    Returns:
+        (int, int): (Jobs loaded, jobs written)
+    """
+    jobs = MonkeyJob.objects(creation_date__gte=(datetime.now() -
+                                                 timedelta(days=10)))
+    loaded = 0
+    for job in jobs:
+        loaded += 1
+        job.total_wall_time = (datetime.now() -
+                               job.creation_date).total_seconds()
+        job.save()
+    return loaded, loaded
+
+
+def indexed_pass():
+    """A pass as check_for_dead_jobs runs now, healthy jobs aren't written
+
+    Returns:
+        (int, int): (Jobs loaded, jobs written)
+    """
+    pending_jobs, finished_jobs = get_reconcile_jobs()
+    return len(pending_jobs) + len(finished_jobs), 0
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark a reconciliation pass over many jobs")
+    parser.add_argument("-n",
+                        type=int,
+                        default=None,
+                        dest="jobs",
+                        help="Jobs to seed, defaults to 50000 with --host "
+                        "and 5000 on mongomock")
+    parser.add_argument("--active",
+                        type=int,
+                        default=200,
+                        help="Jobs in a non-terminal state")
+    parser.add_argument("--days",
+                        type=float,
+                        default=30,
+                        help="Creation dates are spread over this many days")
+    parser.add_argument("--passes", type=int, default=3)
+    parser.add_argument("--host",
+                        default=None,
+                        help="Mongo URI of a benchmark database, "
+                        "defaults to mongomock")
+    args = parser.parse_args()
+    if args.jobs is None:
+        args.jobs = 50000 if args.host is not None else 5000
+
+    monkey_global.QUIET_PERIODIC_PRINTOUT = True
+    connect(args.host)
+    print(f"Seeding {args.jobs} jobs, {args.active} active")
+    start = time.time()
+    seed_jobs(args.jobs,
+              args.active,
+              args.days,
+              indexes=args.host is not None)
+    print(f"Seeded in {time.time() - start:.1f}s")
+
+    print("{:<10} {:>10} {:>10} {:>10} {:>10}".format("Mode", "loaded",
+                                                      "written", "mean(s)",
+                                                      "max(s)"))
+    modes = [("full scan", full_scan_pass), ("indexed", indexed_pass)]
+    for name, run_pass in modes:
+        durations = []
+        for _ in range(args.passes):
+            start = time.time()
+            loaded, written = run_pass()
+            durations.append(time.time() - start)
+        print("{:<10} {:>10} {:>10} {:>10.3f} {:>10.3f}".format(
+            name, loaded, written, statistics.mean(durations),
+            max(durations)))
+    MonkeyJob.drop_collection()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+"""Compares the latency of simple remote operations over ansible and over
+the persistent ssh executor
+
+Any host in ansible/inventory works, a local sshd in a container is enough:
+
+    docker run -d -p 2222:2222 -e USER_NAME=monkey -e PUBLIC_KEY="$(cat ~/.ssh/id_rsa.pub)" linuxserver/openssh-server
+    # ansible/inventory/bench.yml
+    all:
+      hosts:
+        bench:
+          ansible_host: 127.0.0.1
+          ansible_port: 2222
+          ansible_user: monkey
+
+    python3 benchmark_ssh.py bench -n 20
+"""
+import argparse
+import statistics
+import time
+
+from core.instance.monkey_instance import MonkeyInstance
+
+OPERATIONS = [
+    ("file state=directory", lambda x: x.run_ansible_module(
+        modulename="file",
+        args={
+            "path": "/tmp/monkey-bench",
+            "state": "directory"
+        })),
+    ("killall", lambda x: x.run_ansible_shell(
+        command="killall monkey-bench-missing || true")),
+    ("bash script", lambda x: x.run_ansible_shell(
+        command="bash -c 'echo persist > /tmp/monkey-bench/out'")),
+]
+
+
+def time_operation(instance, operation, iterations):
+    durations = []
+    for _ in range(iterations):
+        start = time.time()
+        operation(instance)
+        durations.append(time.time() - start)
+    return durations
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark ssh fast path")
+    parser.add_argument("host", help="Host name in ansible/inventory")
+    parser.add_argument("-n", type=int, default=10, dest="iterations")
+    args = parser.parse_args()
+
+    instance = MonkeyInstance(name=args.host, ip_address=args.host)
+    print("{:<24} {:<8} {:>10} {:>10} {:>10}".format("Operation", "Path",
+                                                     "mean(ms)", "p50(ms)",
+                                                     "max(ms)"))
+    for name, operation in OPERATIONS:
+        for ssh_fast_path in (False, True):
+            instance.ssh_fast_path = ssh_fast_path
+            durations = time_operation(instance, operation, args.iterations)
+            # The first ssh call includes the connection handshake
+            print("{:<24} {:<8} {:>10.1f} {:>10.1f} {:>10.1f}".format(
+                name, "ssh" if ssh_fast_path else "ansible",
+                statistics.mean(durations) * 1000,
+                statistics.median(durations) * 1000,
+                max(durations) * 1000))
+    instance.close_ssh_executor()
+
+
+if __name__ == '__main__':
+    main()
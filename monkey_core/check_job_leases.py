@@ -0,0 +1,151 @@
+"""Checks job claims, lease takeovers and state change listeners between two
+Monkey instances in one process
+
+Runs against an in-memory mongomock database, no mongo or providers are
+needed:
+
+    pip install mongomock
+    python3 check_job_leases.py
+
+Checks that:
+- Only one Monkey can claim a queued job
+- A lease can only be taken over once it expires
+- Each Monkey only receives state changes of the jobs it leases, and changes
+  of unleased jobs reach both
+- A closed Monkey receives no more state changes
+"""
+import sys
+from datetime import datetime, timedelta
+
+import mongomock
+import mongoengine
+
+import core.mongo.mongo_global as monkey_state
+from core.mongo import monkey_job
+from core.mongo.monkey_job import MonkeyJob
+# core.monkey and monkey_global import each other, monkey_global goes first
+from core.monkey_global import Monkey
+
+
+def connect_mongomock():
+    mongoengine.disconnect()
+    try:
+        mongoengine.connect("monkeydb",
+                            host="mongodb://localhost",
+                            mongo_client_class=mongomock.MongoClient)
+    except TypeError:
+        # mongoengine < 0.27
+        mongoengine.connect("monkeydb", host="mongomock://localhost")
+
+
+class ProviderlessMonkey(Monkey):
+    """Leases jobs without dispatching them anywhere"""
+
+    def instantiate_providers(self, providers_path=None):
+        self.providers = []
+
+
+def create_job(job_uid):
+    job = MonkeyJob(job_uid=job_uid,
+                    job_yml={"job_uid": job_uid},
+                    state=monkey_state.MONKEY_STATE_QUEUED,
+                    provider_type="local",
+                    provider_name="local",
+                    provider_vars={
+                        "name": "local",
+                        "type": "local"
+                    })
+    job.save()
+    return job
+
+
+def load_job(job_uid):
+    return MonkeyJob.objects(job_uid=job_uid).get()
+
+
+def main():
+    connect_mongomock()
+    monkeys = dict()
+    # name -> [(job_uid, state)] received
+    events = dict()
+    for name in ("a", "b"):
+        monkeys[name] = ProviderlessMonkey(start_loop=False)
+        events[name] = []
+        monkey_job.add_state_listeners(
+            monkeys[name].owner_id,
+            change_listeners=[
+                lambda job_uid, state, name=name: events[name].append(
+                    (job_uid, state))
+            ])
+    a, b = monkeys["a"], monkeys["b"]
+    errors = []
+
+    def expect(description, condition):
+        print("{:<52} {}".format(description, "ok" if condition else "FAILED"))
+        if not condition:
+            errors.append(description)
+
+    def take_events():
+        taken = {x: list(y) for x, y in events.items()}
+        for x in events.values():
+            x.clear()
+        return taken
+
+    create_job("lease-check")
+    a_job, b_job = load_job("lease-check"), load_job("lease-check")
+    expect("a claims the queued job", a_job.claim(owner=a.owner_id))
+    expect("b can't claim the same job", not b_job.claim(owner=b.owner_id))
+    received = take_events()
+    expect("only a receives its claim",
+           received == {
+               "a": [("lease-check", monkey_state.MONKEY_STATE_DISPATCHING)],
+               "b": []
+           })
+
+    b_job = load_job("lease-check")
+    expect("b can't take over a held lease",
+           not b_job.take_over_lease(owner=b.owner_id))
+    MonkeyJob.objects(job_uid="lease-check").update(
+        set__lease_expiry=datetime.now() - timedelta(seconds=1))
+    expect("b takes over the expired lease",
+           b_job.take_over_lease(owner=b.owner_id))
+    expect("a can't take the lease back",
+           not a_job.take_over_lease(owner=a.owner_id))
+
+    b_job.set_state(monkey_state.MONKEY_STATE_RUNNING)
+    # A stale copy of the previous owner still reports to the new owner
+    a_job.set_state(monkey_state.MONKEY_STATE_CLEANUP,
+                    expected_state=monkey_state.MONKEY_STATE_RUNNING)
+    received = take_events()
+    expect("only b receives changes after the takeover",
+           received == {
+               "a": [],
+               "b": [("lease-check", monkey_state.MONKEY_STATE_RUNNING),
+                     ("lease-check", monkey_state.MONKEY_STATE_CLEANUP)]
+           })
+
+    create_job("unleased-check").set_state(monkey_state.MONKEY_STATE_FAILED)
+    received = take_events()
+    expect("both receive changes of an unleased job",
+           all(x == [("unleased-check", monkey_state.MONKEY_STATE_FAILED)]
+               for x in received.values()))
+
+    a.close()
+    create_job("closed-check").set_state(monkey_state.MONKEY_STATE_FAILED)
+    received = take_events()
+    expect("a closed monkey receives nothing",
+           received["a"] == [] and len(received["b"]) == 1)
+    expect("closing removes all of a's listeners",
+           a.owner_id not in monkey_job.state_change_listeners and
+           a.owner_id not in monkey_job.state_transition_listeners)
+    b.close()
+
+    for error in errors:
+        print(f"FAILED: {error}")
+    if len(errors) > 0:
+        sys.exit(1)
+    print("All checks passed")
+
+
+if __name__ == '__main__':
+    main()
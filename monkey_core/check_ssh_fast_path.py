@@ -0,0 +1,173 @@
+"""Checks that operations sent over the persistent ssh executor leave a host
+in the same state as running them through ansible
+
+Uses the same inventory host as benchmark_ssh.py, a local sshd in a
+container is enough:
+
+    docker run -d -p 2222:2222 -e USER_NAME=monkey -e PUBLIC_KEY="$(cat ~/.ssh/id_rsa.pub)" linuxserver/openssh-server
+    python3 check_ssh_fast_path.py bench
+
+Every operation is run once per path from a clean directory and the
+resulting state is compared.  A command whose connection times out after
+it started must fail instead of being run again through ansible.
+"""
+import argparse
+import sys
+import time
+
+from core.instance.monkey_instance import AnsibleRunException, MonkeyInstance
+from core.instance.monkey_ssh import get_ssh_executor
+
+CHECK_DIR = "/tmp/monkey-check"
+# Prints the type, mode and content of everything under CHECK_DIR, but the
+# archive, which is recreated with a new timestamp for every operation
+STATE_COMMAND = f"cd {CHECK_DIR} 2>/dev/null && " + \
+    "find . ! -name archive.tar.gz | sort | " + \
+    "while read x; do echo \"$x $(stat -c '%F %a' \"$x\") " + \
+    "$([ -f \"$x\" ] && md5sum < \"$x\")\"; done"
+
+OPERATIONS = [
+    ("file state=directory", lambda x: x.run_ansible_module(
+        modulename="file",
+        args={
+            "path": f"{CHECK_DIR}/dir",
+            "state": "directory"
+        })),
+    ("file state=directory mode", lambda x: x.run_ansible_module(
+        modulename="file",
+        args={
+            "path": f"{CHECK_DIR}/dir/private",
+            "state": "directory",
+            "mode": "0700"
+        })),
+    ("file state=absent", lambda x: x.run_ansible_module(
+        modulename="file",
+        args={
+            "path": f"{CHECK_DIR}/remove",
+            "state": "absent"
+        })),
+    ("shell", lambda x: x.run_ansible_shell(
+        command=f"echo persist > {CHECK_DIR}/out")),
+    ("unarchive remote_src", lambda x: x.run_ansible_module(
+        modulename="unarchive",
+        args={
+            "src": f"{CHECK_DIR}/archive.tar.gz",
+            "dest": f"{CHECK_DIR}/dir",
+            "remote_src": "True"
+        })),
+    ("unarchive creates", lambda x: x.run_ansible_module(
+        modulename="unarchive",
+        args={
+            "src": f"{CHECK_DIR}/archive.tar.gz",
+            "dest": f"{CHECK_DIR}/dir",
+            "remote_src": "True",
+            "creates": f"{CHECK_DIR}/remove"
+        })),
+]
+
+# Run before every operation, the same on both paths
+PREPARE_COMMAND = f"rm -rf {CHECK_DIR} && mkdir -p {CHECK_DIR}/remove " + \
+    f"{CHECK_DIR}/dir && echo data > {CHECK_DIR}/remove/file && " + \
+    f"tar -czf {CHECK_DIR}/archive.tar.gz -C {CHECK_DIR} remove"
+
+
+def run_operation(instance, executor, operation):
+    """
+    Returns:
+        (bool, str): (Whether the operation succeeded, state of the host)
+    """
+    status, _, error = executor.run(PREPARE_COMMAND)
+    if status != 0:
+        raise Exception(f"Failed to prepare {CHECK_DIR}: {error}")
+    try:
+        operation(instance)
+        success = True
+    except AnsibleRunException:
+        success = False
+    _, state, _ = executor.run(STATE_COMMAND)
+    return success, state
+
+
+def check_operations(instance, executor):
+    errors = []
+    for name, operation in OPERATIONS:
+        results = dict()
+        for ssh_fast_path in (False, True):
+            instance.ssh_fast_path = ssh_fast_path
+            results[ssh_fast_path] = run_operation(instance, executor,
+                                                   operation)
+            if ssh_fast_path and instance.ssh_executor is None:
+                errors.append(f"{name}: fell back to ansible")
+        same = results[False] == results[True]
+        print("{:<28} {}".format(name, "same" if same else "DIFFERENT"))
+        if not same:
+            errors.append(f"{name}: ansible {results[False]}, " +
+                          f"ssh {results[True]}")
+    return errors
+
+
+def check_failed_command(instance):
+    errors = []
+    for ssh_fast_path in (False, True):
+        instance.ssh_fast_path = ssh_fast_path
+        try:
+            instance.run_ansible_shell(command="exit 3")
+            errors.append("exit 3 succeeded with ssh_fast_path: " +
+                          str(ssh_fast_path))
+        except AnsibleRunException:
+            pass
+    print("{:<28} {}".format("failing command",
+                             "raises" if len(errors) == 0 else "DIFFERENT"))
+    return errors
+
+
+def check_lost_command(instance, executor):
+    """A command that outlives ssh_command_timeout must not run twice"""
+    executor.run(f"rm -rf {CHECK_DIR} && mkdir -p {CHECK_DIR}")
+    instance.ssh_fast_path = True
+    instance.ssh_command_timeout = 1
+    errors = []
+    try:
+        instance.run_ansible_shell(
+            command=f"sleep 3; echo ran >> {CHECK_DIR}/count")
+        errors.append("timed out command did not fail")
+    except AnsibleRunException:
+        pass
+    finally:
+        instance.ssh_command_timeout = None
+    time.sleep(4)
+    # The instance stops using ssh after a lost command, the executor
+    # itself reconnects
+    _, output, _ = executor.run(f"cat {CHECK_DIR}/count 2>/dev/null | wc -l")
+    runs = int(output.strip() or 0)
+    print("{:<28} ran {} time(s)".format("lost command", runs))
+    if runs > 1:
+        errors.append(f"lost command ran {runs} times")
+    return errors
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Check ssh fast path against ansible")
+    parser.add_argument("host", help="Host name in ansible/inventory")
+    args = parser.parse_args()
+
+    instance = MonkeyInstance(name=args.host, ip_address=args.host)
+    executor = get_ssh_executor(instance)
+    if executor is None:
+        print(f"{args.host} can't be reached over plain ssh")
+        sys.exit(1)
+    errors = check_operations(instance, executor)
+    errors += check_failed_command(instance)
+    errors += check_lost_command(instance, executor)
+    executor.run(f"rm -rf {CHECK_DIR}")
+    executor.close()
+    for error in errors:
+        print(f"FAILED: {error}")
+    if len(errors) > 0:
+        sys.exit(1)
+    print("All checks passed")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,7 @@
 import logging
 
 logger = logging.getLogger(__name__)
+from core.instance.monkey_ansible import read_event_log
 from core.mongo.monkey_job import MonkeyJob
 
 
@@ -34,6 +35,24 @@ def get_job_info(self, uid):
     return job.get_dict()
 
 
+def get_job_setup_log(self, uid, offset=0):
+    """Reads a job's setup log from a byte offset
+
+    Returns:
+        dict: The log text and the offset to read from next, None if the job
+            doesn't exist
+    """
+    job = MonkeyJob.objects(job_uid=uid).only("provider_name").first()
+    if job is None:
+        return None
+    found_provider = self.get_provider(job.provider_name)
+    if found_provider is None:
+        return None
+    log, next_offset = read_event_log(
+        found_provider.get_job_setup_log_path(uid), offset=offset)
+    return {"log": log, "offset": next_offset}
+
+
 def get_list_providers(self):
     return [x.get_dict() for x in self.providers]
 
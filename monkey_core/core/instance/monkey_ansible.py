@@ -0,0 +1,267 @@
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+from collections import deque
+from datetime import datetime
+from uuid import uuid4
+
+import ansible_runner
+
+logger = logging.getLogger(__name__)
+
+ANSIBLE_ARTIFACTS_DIR = "ansible/artifacts"
+# Events of a run kept in memory, only failed runs write them to disk
+ANSIBLE_EVENT_BUFFER_SIZE = 1000
+# Artifact directories kept, by count and by age in seconds
+ANSIBLE_ARTIFACT_MAX_COUNT = 500
+ANSIBLE_ARTIFACT_MAX_AGE = 60 * 60 * 24 * 3
+
+# Seconds task events are kept in memory before being appended to a job
+# event log.  Logs live on monkeyfs, where every append to a bucket mount
+# uploads the whole file again
+EVENT_LOG_FLUSH_INTERVAL = 5
+# Bytes returned by one read of a job event log
+EVENT_LOG_READ_SIZE = 1024 * 1024
+# Task end events and the status they are logged with
+TASK_END_EVENTS = {
+    "runner_on_ok": "ok",
+    "runner_on_failed": "failed",
+    "runner_on_skipped": "skipped",
+    "runner_on_unreachable": "unreachable",
+}
+
+# Artifact directories of runs that haven't finished yet
+active_idents = set()
+active_idents_lock = threading.Lock()
+prune_lock = threading.Lock()
+
+
+class EventBuffer():
+    """An ansible_runner event_handler keeping the last events in memory
+
+    Returning False stops ansible_runner from writing a file per event, only
+    the playbook stats are written so runner.stats keeps working
+    """
+
+    def __init__(self, size=ANSIBLE_EVENT_BUFFER_SIZE):
+        self.events = deque(maxlen=size)
+
+    def __call__(self, event):
+        self.events.append(event)
+        return event.get("event") == "playbook_on_stats"
+
+
+class JobEventLog():
+    """Appends the start and end of every ansible task run for a job to an
+    append-only log, one json object per line
+
+    Events arrive from ansible_runner as they happen and are appended in
+    batches, at most EVENT_LOG_FLUSH_INTERVAL seconds apart and at the end of
+    every setup step, so the log can be followed while a job sets up.
+    Seconds per role are kept in role_timings.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        # Keeps batches in order when flushed from several threads
+        self.flush_lock = threading.Lock()
+        self.pending_lines = []
+        # Flushes the pending lines, started by the first of them
+        self.flush_timer = None
+        # (task uuid, host) -> start time
+        self.task_starts = dict()
+        self.role_timings = dict()
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        except OSError as e:
+            logger.error(f"Failed to create setup log folder {path}: {e}")
+
+    def write(self, entry):
+        entry = dict(entry, date=datetime.now().isoformat())
+        with self.lock:
+            self.pending_lines.append(json.dumps(entry) + "\n")
+            if self.flush_timer is None:
+                self.flush_timer = threading.Timer(EVENT_LOG_FLUSH_INTERVAL,
+                                                   self.flush)
+                self.flush_timer.daemon = True
+                self.flush_timer.start()
+
+    def flush(self):
+        """Appends the buffered events to the log in a single write
+        """
+        with self.flush_lock:
+            with self.lock:
+                lines = self.pending_lines
+                self.pending_lines = []
+                if self.flush_timer is not None:
+                    self.flush_timer.cancel()
+                    self.flush_timer = None
+            if len(lines) == 0:
+                return
+            try:
+                with open(self.path, "a") as f:
+                    f.write("".join(lines))
+            except OSError as e:
+                logger.error(f"Failed to write setup log {self.path}: {e}")
+
+    def __call__(self, event):
+        name = event.get("event", "")
+        event_data = event.get("event_data", dict())
+        key = (event_data.get("task_uuid"), event_data.get("host"))
+        entry = {
+            "host": event_data.get("host", ""),
+            "role": event_data.get("role", ""),
+            "task": event_data.get("task", ""),
+        }
+        if name == "runner_on_start":
+            with self.lock:
+                self.task_starts[key] = time.time()
+            self.write(dict(entry, status="started"))
+        elif name in TASK_END_EVENTS:
+            with self.lock:
+                start = self.task_starts.pop(key, None)
+                duration = 0 if start is None else time.time() - start
+                role = entry["role"] or entry["task"]
+                self.role_timings[role] = round(
+                    self.role_timings.get(role, 0) + duration, 2)
+            entry = dict(entry,
+                         status=TASK_END_EVENTS[name],
+                         duration=round(duration, 2))
+            if name in ("runner_on_failed", "runner_on_unreachable"):
+                entry["msg"] = event_data.get("res", dict()).get("msg", "")
+            self.write(entry)
+
+
+def read_event_log(path, offset=0, max_bytes=EVENT_LOG_READ_SIZE):
+    """Reads a job event log from a byte offset
+
+    Returns:
+        (str, int): The text read, ending on a full line, and the offset to
+            read from next
+    """
+    try:
+        with open(path, "rb") as f:
+            f.seek(offset)
+            data = f.read(max_bytes)
+    except FileNotFoundError:
+        return "", offset
+    # Leave a partly written last line for the next read
+    end = data.rfind(b"\n") + 1
+    return data[:end].decode(errors="replace"), offset + end
+
+
+def format_module_args(args):
+    """Builds the key=value args of an ad-hoc module call
+
+    Values are double quoted with their backslashes and quotes escaped, which
+    ansible undoes, so they may hold spaces, quotes and regex metacharacters
+
+    Args:
+        args (dict or str): The module args, a str is used as is
+
+    Returns:
+        str: The module args string
+    """
+    if type(args) is not dict:
+        return args
+    formatted = []
+    for key, val in args.items():
+        val = str(val).replace("\\", "\\\\").replace('"', '\\"')
+        formatted.append(f'{key}="{val}"')
+    return " ".join(formatted)
+
+
+def run_ansible(event_handler=None, **kwargs):
+    """Runs ansible_runner.run with its events captured in memory
+
+    The events are available as runner.captured_events.  A failed run
+    writes them to its artifact directory so runner.events can still be
+    read from disk
+
+    Args:
+        event_handler (function, optional): Also called with every event
+        **kwargs: Arguments of ansible_runner.run
+
+    Returns:
+        ansible_runner.Runner: The finished runner
+    """
+    event_buffer = EventBuffer()
+
+    def handle_event(event):
+        if event_handler is not None:
+            try:
+                event_handler(event)
+            except Exception as e:
+                logger.error(f"Failed to handle ansible event: {e}")
+        return event_buffer(event)
+
+    ident = uuid4().hex
+    with active_idents_lock:
+        active_idents.add(ident)
+    try:
+        runner = ansible_runner.run(ident=ident,
+                                    event_handler=handle_event,
+                                    **kwargs)
+    finally:
+        with active_idents_lock:
+            active_idents.discard(ident)
+    runner.captured_events = list(event_buffer.events)
+    if runner.status in ("failed", "timeout"):
+        persist_events(runner)
+    return runner
+
+
+def persist_events(runner):
+    events_dir = os.path.join(runner.config.artifact_dir, "job_events")
+    try:
+        os.makedirs(events_dir, exist_ok=True)
+        for index, event in enumerate(runner.captured_events):
+            filename = "{}-{}.json".format(event.get("counter", index),
+                                           event.get("uuid", index))
+            with open(os.path.join(events_dir, filename), "w") as f:
+                json.dump(event, f)
+    except Exception as e:
+        logger.error(f"Failed to save events of failed ansible run: {e}")
+
+
+def prune_artifacts(artifacts_dir=ANSIBLE_ARTIFACTS_DIR,
+                    max_count=ANSIBLE_ARTIFACT_MAX_COUNT,
+                    max_age=ANSIBLE_ARTIFACT_MAX_AGE):
+    """Removes artifact directories past the newest max_count or older than
+    max_age seconds, skipped while a previous prune is running
+
+    Returns:
+        int: The number of directories removed
+    """
+    if not prune_lock.acquire(blocking=False):
+        return 0
+    try:
+        try:
+            entries = [x for x in os.scandir(artifacts_dir) if x.is_dir()]
+        except FileNotFoundError:
+            return 0
+        with active_idents_lock:
+            running = set(active_idents)
+        artifacts = []
+        for entry in entries:
+            if entry.name in running:
+                continue
+            try:
+                artifacts.append((entry.stat().st_mtime, entry.path))
+            except FileNotFoundError:
+                continue
+        artifacts.sort(reverse=True)
+        now = time.time()
+        removed = 0
+        for index, (modified, path) in enumerate(artifacts):
+            if index < max_count and now - modified < max_age:
+                continue
+            shutil.rmtree(path, ignore_errors=True)
+            removed += 1
+        return removed
+    finally:
+        prune_lock.release()
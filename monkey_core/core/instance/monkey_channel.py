@@ -0,0 +1,67 @@
+import threading
+from uuid import uuid1
+
+
+class ExecutionChannel():
+    """The state ansible calls to one instance run under
+
+    Every instance owns its channel, so calls to different instances never
+    share a lock and host vars of one instance never reach another.
+
+    - token: The cancellation token of the call that currently owns the
+      instance, taking the channel with a new token cancels the previous
+      owner
+    - extravars: Variables added to every role and playbook run on the
+      instance, e.g. the host vars of a local instance
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.token = None
+        self.extravars = dict()
+
+    def get_token(self):
+        with self.lock:
+            return self.token
+
+    def take(self):
+        """Makes the caller the owner of the channel
+
+        Returns:
+            UUID: The new token, calls under any older token are cancelled
+        """
+        with self.lock:
+            self.token = uuid1()
+            return self.token
+
+    def cancel(self):
+        with self.lock:
+            self.token = None
+
+    def is_current(self, token):
+        with self.lock:
+            return token is not None and self.token == token
+
+    def get_cancel_callback(self, token):
+        """
+        Returns:
+            function: True once token no longer owns the channel, for
+                ansible_runner's cancel_callback
+        """
+
+        def is_cancelled():
+            return not self.is_current(token)
+
+        return is_cancelled
+
+    def update_extravars(self, extravars):
+        with self.lock:
+            self.extravars = dict(self.extravars, **extravars)
+
+    def get_extravars(self, extravars=dict()):
+        """
+        Returns:
+            dict: A copy of extravars with the channel's variables added
+        """
+        with self.lock:
+            return dict(extravars, **self.extravars)
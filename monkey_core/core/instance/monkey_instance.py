@@ -1,25 +1,61 @@
+import base64
+import hashlib
 import logging
 import os
+import re
 import threading
-from concurrent.futures import Future
+import time
+from concurrent.futures import (FIRST_COMPLETED, Future, ThreadPoolExecutor,
+                                wait)
+from contextlib import contextmanager
 from datetime import datetime
 from threading import Thread
-from uuid import uuid1
 
-import ansible_runner
 import requests
+from core.instance.monkey_ansible import format_module_args, run_ansible
+from core.instance.monkey_channel import ExecutionChannel
+from core.instance.monkey_ssh import (SSHCommandLostException,
+                                      module_to_command)
 from core.monkey_global import QUIET_ANSIBLE
 
 logger = logging.getLogger(__name__)
 
 HEARTBEAT_TIME = 30
 HEARTBEAT_FAILURE_TOLERANCE = 3
+# Seconds a ping result is reused before pinging the instance again
+HEALTH_CHECK_TTL = 20
+# Setup steps of a job run at once on the same host
+SETUP_STEP_WORKERS = 4
+# Task names marking setup steps in a generated setup playbook
+SETUP_STEP_MARKER = "monkey-setup-step"
+SETUP_STEP_FAILED = "monkey-setup-step-failed"
+# Conda and pip environments kept per host, and minutes since its last use
+# before an environment may be evicted
+ENV_CACHE_SIZE = 8
+ENV_CACHE_MIN_IDLE = 60
 
 
 class AnsibleRunException(Exception):
     pass
 
 
+def get_role_fingerprint(rolename):
+    """Hashes every file of an ansible role
+
+    Installs are redone on a host once the role that made them changes
+    """
+    role_path = os.path.join("ansible", "roles", rolename)
+    fingerprint = hashlib.sha256()
+    for root, dirs, files in os.walk(role_path):
+        dirs.sort()
+        for file_name in sorted(files):
+            file_path = os.path.join(root, file_name)
+            fingerprint.update(os.path.relpath(file_path, role_path).encode())
+            with open(file_path, "rb") as f:
+                fingerprint.update(f.read())
+    return fingerprint.hexdigest()[:16]
+
+
 class MonkeyInstance():
 
     name = None
@@ -27,18 +63,45 @@ class MonkeyInstance():
     destruction_time = None
     ip_address = None
     state = None
-    lock = threading.Lock()
-    additional_extravars = dict()
 
-    offline_count = 0
+    # Simple module and shell calls go over a persistent ssh connection
+    ssh_fast_path = True
+    # Seconds to wait on output of a command sent over ssh, None waits
+    # until it exits
+    ssh_command_timeout = None
+
     offline_retries = 3
-    last_uuid = None
+    # Instances start offline until their first successful ping
+    offline_count = offline_retries
+    online = False
+    last_online_check = None
 
     def __init__(self, name, ip_address):
         super().__init__()
         self.name = name
         self.ip_address = ip_address
         self.creation_time = datetime.now()
+        self.offline_count = self.offline_retries
+        self.online = False
+        self.last_online_check = None
+        # Lock, cancellation token and extravars of ansible calls to this
+        # instance
+        self.channel = ExecutionChannel()
+        # Machine level setup that outlives a single job on the instance,
+        # installed dependency -> fingerprint of its role
+        self.installed_dependencies = dict()
+        self.install_ledger_loaded = False
+        self.monkeyfs_mounted = False
+        self.jobs_run = 0
+        # Lets parallel setup steps share the uuid of their setup_job
+        self.run_context = threading.local()
+        # job_uid -> seconds spent in each setup step
+        self.setup_timings = dict()
+        # Live load of the host, for placing jobs that don't name a host
+        self.load = None
+        self.ssh_executor = None
+        self.ssh_failed_time = None
+        self.ssh_lock = threading.Lock()
         # threading.Thread(target=self.heartbeat_loop, daemon=True)
 
     def __eq__(self, other):
@@ -47,53 +110,89 @@ class MonkeyInstance():
     def __lt__(self, other):
         return self.creation_time < other.creation_time
 
-    def check_online(self):
+    def ping(self):
+        """Pings the monkey client on the instance
+
+        Returns:
+            bool: True if the client responded
+        """
         if self.ip_address is None:
             return False
         try:
             r = requests.get("http://{}:9991/ping".format(self.ip_address),
                              timeout=4)
         except:
+            return False
+        return r.ok
+
+    def record_ping(self, reachable):
+        """Updates the cached online status from a ping result
+
+        An instance that has answered is only considered offline after
+        offline_retries consecutive failed pings, one that never has stays
+        offline until it answers
+        """
+        if reachable:
+            self.offline_count = 0
+        else:
             self.offline_count += 1
-            return self.offline_count >= self.offline_retries
-        if not r.ok:
-            self.offline_count += 1
-        if self.offline_count >= self.offline_retries:
+        self.online = self.offline_count < self.offline_retries
+        self.last_online_check = datetime.now()
+        return self.online
+
+    def is_health_check_stale(self):
+        return self.last_online_check is None or (
+            datetime.now() -
+            self.last_online_check).total_seconds() > HEALTH_CHECK_TTL
+
+    def check_online(self):
+        if self.ip_address is None:
             return False
-        self.offline_count = 0
-        return True
+        if self.is_health_check_stale():
+            self.record_ping(self.ping())
+        return self.online
 
     def update_instance_details(self, other):
         self.name = other.name
         self.ip_address = other.ip_address
 
     def get_uuid(self):
-        with self.lock:
-            uuid = self.last_uuid
-        return uuid
+        return self.channel.get_token()
 
     def update_uuid(self):
-        with self.lock:
-            new_uuid = uuid1()
-            self.last_uuid = new_uuid
-        return new_uuid
+        return self.channel.take()
 
-    def ansible_runner_uuid_cancel(self, uuid):
+    def get_run_uuid(self):
+        """The uuid to run the next ansible call under
 
-        def check_for_uuid_change():
-            change = self.last_uuid != uuid
-            # print("Checking uuid: {} != {}, : {}".format(
-            # self.last_uuid, uuid, change))
-            return change
+        Steps of a setup_job share its uuid so they don't cancel each other,
+        any other call takes over the instance with a new uuid
+        """
+        uuid = getattr(self.run_context, "uuid", None)
+        if uuid is not None:
+            return uuid
+        return self.update_uuid()
+
+    @contextmanager
+    def job_event_log(self, event_log):
+        """Streams the ansible events of calls made in this thread, and the
+        setup steps they start, to a job's event log
+        """
+        self.run_context.event_log = event_log
+        try:
+            yield event_log
+        finally:
+            self.run_context.event_log = None
+            event_log.flush()
+
+    def get_event_log(self):
+        return getattr(self.run_context, "event_log", None)
 
-        return check_for_uuid_change
+    def ansible_runner_uuid_cancel(self, uuid):
+        return self.channel.get_cancel_callback(uuid)
 
     def check_uuid(self, uuid):
-        check = False
-        with self.lock:
-            if self.last_uuid == uuid:
-                check = True
-        return check
+        return self.channel.is_current(uuid)
 
     def get_experiment_hyperparameters(self):
         if self.ip_address is None:
@@ -111,7 +210,7 @@ class MonkeyInstance():
             return None
 
     def print_failed_event(self, runner):
-        events = list(runner.events)[-10:]
+        events = runner.captured_events[-10:]
         for e in events:
             event_data = e.get("event_data", dict())
             print("TASK-----------------------------")
@@ -129,19 +228,20 @@ class MonkeyInstance():
                                        extravars=dict(),
                                        envvars=dict(),
                                        cancel_callback=None):
-        extravars.update(self.additional_extravars)
-        runner = ansible_runner.run(host_pattern=self.name,
-                                    private_data_dir="ansible",
-                                    module="include_role",
-                                    module_args=f"name={rolename}",
-                                    quiet=QUIET_ANSIBLE,
-                                    extravars=extravars,
-                                    envvars=envvars,
-                                    cancel_callback=cancel_callback)
+        extravars = self.channel.get_extravars(extravars)
+        runner = run_ansible(host_pattern=self.name,
+                             private_data_dir="ansible",
+                             module="include_role",
+                             module_args=f"name={rolename}",
+                             quiet=QUIET_ANSIBLE,
+                             extravars=extravars,
+                             envvars=envvars,
+                             event_handler=self.get_event_log(),
+                             cancel_callback=cancel_callback)
         return runner
 
     def run_ansible_role(self, rolename, extravars=dict(), envvars=dict()):
-        uuid = self.update_uuid()
+        uuid = self.get_run_uuid()
         runner = self.run_ansible_role_inexclusively(
             rolename=rolename,
             extravars=extravars,
@@ -156,26 +256,62 @@ class MonkeyInstance():
             self.print_failed_event(runner=runner)
             raise AnsibleRunException("Ansible role failed to run")
 
+    def run_fast_path(self, command, uuid, printout=False):
+        """Runs a simple command over ssh instead of ansible
+
+        Returns:
+            bool: True if the command ran, False to fall back to ansible
+        """
+        start = time.time()
+        try:
+            result = self.run_ssh_command(command,
+                                          timeout=self.ssh_command_timeout)
+        except SSHCommandLostException as e:
+            # The command may have run, so it isn't retried through ansible
+            raise AnsibleRunException(f"Lost ssh command: {command}: {e}")
+        if result is None:
+            return False
+        event_log = self.get_event_log()
+        if event_log is not None:
+            event_log.write({
+                "host": self.name,
+                "role": "",
+                "task": command,
+                "status": "ok" if result[0] == 0 else "failed",
+                "duration": round(time.time() - start, 2),
+            })
+        if self.get_uuid() != uuid:
+            raise AnsibleRunException(
+                "Running ansible cancelled due to concurrency")
+        status, stdout, stderr = result
+        if status != 0 or printout:
+            print(f"Ran over ssh: {command}, status: {status}")
+            print("STDOUT:")
+            print(stdout)
+            print("STDERR:")
+            print(stderr)
+        if status != 0:
+            raise AnsibleRunException("Ansible module failed to run")
+        return True
+
     def run_ansible_module_inexclusively(self,
                                          modulename,
                                          args,
                                          cancel_callback=None):
-        args_string = args
-        if type(args) is dict:
-            args_string = ""
-            for key, val in args.items():
-
-                args_string += f"{key}={val} "
-        runner = ansible_runner.run(host_pattern=self.name,
-                                    private_data_dir="ansible",
-                                    module=modulename,
-                                    module_args=args_string,
-                                    quiet=QUIET_ANSIBLE,
-                                    cancel_callback=cancel_callback)
+        runner = run_ansible(host_pattern=self.name,
+                             private_data_dir="ansible",
+                             module=modulename,
+                             module_args=format_module_args(args),
+                             quiet=QUIET_ANSIBLE,
+                             event_handler=self.get_event_log(),
+                             cancel_callback=cancel_callback)
         return runner
 
     def run_ansible_module(self, modulename, args=""):
-        uuid = self.update_uuid()
+        uuid = self.get_run_uuid()
+        command = module_to_command(modulename, args)
+        if command is not None and self.run_fast_path(command, uuid):
+            return
         runner = self.run_ansible_module_inexclusively(
             modulename=modulename,
             args=args,
@@ -193,17 +329,18 @@ class MonkeyInstance():
                                            playbook,
                                            extravars,
                                            cancel_callback=None):
-        extravars.update(self.additional_extravars)
-        runner = ansible_runner.run(host_pattern=self.name,
-                                    playbook=playbook,
-                                    private_data_dir="ansible",
-                                    extravars=extravars,
-                                    quiet=QUIET_ANSIBLE,
-                                    cancel_callback=cancel_callback)
+        extravars = self.channel.get_extravars(extravars)
+        runner = run_ansible(host_pattern=self.name,
+                             playbook=playbook,
+                             private_data_dir="ansible",
+                             extravars=extravars,
+                             quiet=QUIET_ANSIBLE,
+                             event_handler=self.get_event_log(),
+                             cancel_callback=cancel_callback)
         return runner
 
     def run_ansible_playbook(self, playbook, extravars):
-        uuid = self.update_uuid()
+        uuid = self.get_run_uuid()
         runner = self.run_ansible_playbook_inexclusively(
             playbook=playbook,
             extravars=extravars,
@@ -220,16 +357,19 @@ class MonkeyInstance():
     def run_ansible_shell_inexclusively(self, command, cancel_callback=None):
         args = f"cmd='{command}' executable=/bin/bash"
         print(f"Running in shell: {args}")
-        runner = ansible_runner.run(host_pattern=self.name,
-                                    private_data_dir="ansible",
-                                    module="shell",
-                                    module_args=f'/bin/bash -c "{command}"',
-                                    quiet=QUIET_ANSIBLE,
-                                    cancel_callback=cancel_callback)
+        runner = run_ansible(host_pattern=self.name,
+                             private_data_dir="ansible",
+                             module="shell",
+                             module_args=f'/bin/bash -c "{command}"',
+                             quiet=QUIET_ANSIBLE,
+                             event_handler=self.get_event_log(),
+                             cancel_callback=cancel_callback)
         return runner
 
     def run_ansible_shell(self, command, printout=False):
-        uuid = self.update_uuid()
+        uuid = self.get_run_uuid()
+        if self.run_fast_path(command, uuid, printout=printout):
+            return
         runner = self.run_ansible_shell_inexclusively(
             command=command,
             cancel_callback=self.ansible_runner_uuid_cancel(uuid))
@@ -243,14 +383,15 @@ class MonkeyInstance():
         if printout:
             self.print_failed_event(runner)
 
-    from core.instance.monkey_instance_shared import (execute_command, run_job,
-                                                      setup_data_item,
-                                                      setup_dependency_manager,
-                                                      setup_logs_folder,
-                                                      setup_persist_folder,
-                                                      start_persist,
-                                                      unpack_code_and_persist,
-                                                      unpack_job_dir)
+    from core.instance.monkey_ssh import close_ssh_executor, run_ssh_command
+
+    from core.instance.monkey_instance_shared import (
+        execute_command, get_code_step, get_data_item_step,
+        get_dependency_manager_step, get_job_dir_step, get_logs_folder_step,
+        get_persist_folder_step, get_start_persist_step, run_job,
+        run_setup_step, setup_data_item, setup_dependency_manager,
+        setup_logs_folder, setup_persist_folder, start_persist,
+        unpack_code_and_persist, unpack_job_dir)
 
     def mount_monkeyfs(self, job_yml, provider_info):
         raise NotImplementedError("This is not implemented yet")
@@ -264,77 +405,330 @@ class MonkeyInstance():
         Persist all folders
         Start persisting
         Setup Dependency manager
+
+        By default independent steps run in parallel.  With setup_mode set to
+        playbook for the provider, every step runs in one generated playbook.
         """
         print("Setting up job: ", job_yml)
         job_uid = job_yml["job_uid"]
 
-        for data_item in job_yml.get("data", []):
-            print("Setting up data item", data_item)
-            success, msg = self.setup_data_item(
-                job_uid=job_uid,
-                data_item=data_item,
-            )
-            if not success:
-                return success, msg
-
-        success, msg = self.unpack_job_dir(job_uid=job_uid)
+        steps = self.get_setup_steps(job_yml=job_yml)
+        if steps is None:
+            return False, "Provided or missing dependency manager"
+        if provider_info.get("setup_mode", None) == "playbook":
+            success, msg, timings = self.run_setup_playbook(steps)
+        else:
+            success, msg, timings = self.run_setup_steps([
+                (name, dependencies, lambda x=step: self.run_setup_step(x))
+                for name, dependencies, step in steps
+            ])
+        self.setup_timings[job_uid] = timings
+        logger.info(f"{job_uid}: Setup step timings: {timings}")
         if not success:
             return success, msg
+        return True, "Successfully setup the job"
 
-        for code_item in job_yml.get("code", []):
-            success, msg = self.unpack_code_and_persist(
-                job_uid=job_uid,
-                code_item=code_item,
-            )
-            if not success:
-                return success, msg
-            print("Success in unpacking all codebase items")
-
-        print("Setting up logs folder")
-        success, msg = self.setup_logs_folder(job_uid=job_uid)
-        if not success:
-            return success, msg
+    def get_setup_steps(self, job_yml):
+        """Builds the setup steps of a job
+
+        Data items go alongside the job dir and code.  Code items, persist
+        folders and start persist keep their order.
+
+        Returns:
+            [(str, [str], dict)]: Name, names of the steps it depends on and
+                the step, in an order that satisfies the dependencies.  None
+                if the job's dependency manager is not supported
+        """
+        job_uid = job_yml["job_uid"]
+        steps = []
+        for data_item in job_yml.get("data", []):
+            steps.append(("data/" + data_item["name"], [],
+                          self.get_data_item_step(job_uid=job_uid,
+                                                  data_item=data_item)))
+        data_steps = [x[0] for x in steps]
+
+        steps.append(("job_dir", [], self.get_job_dir_step(job_uid=job_uid)))
 
+        previous = "job_dir"
+        for code_item in job_yml.get("code", []):
+            name = "code/" + code_item["run_name"]
+            steps.append((name, [previous],
+                          self.get_code_step(job_uid=job_uid,
+                                             code_item=code_item)))
+            previous = name
+        unpacked = previous
+
+        steps.append(("logs", [unpacked],
+                      self.get_logs_folder_step(job_uid=job_uid)))
+
+        # Persist folders may sit inside data, and are set up in order
+        previous = "logs"
         for persist_item in job_yml.get("persist", []):
-            print("Setting up persist item", persist_item)
-            success, msg = self.setup_persist_folder(
-                job_uid=job_uid,
-                persist=persist_item,
-            )
-            if not success:
-                return success, msg
-
-        print("Starting Persist")
-        success, msg = self.start_persist(job_uid=job_uid,)
-        if not success:
-            return success, msg
+            name = "persist/" + persist_item
+            steps.append((name, [previous] + data_steps,
+                          self.get_persist_folder_step(job_uid=job_uid,
+                                                       persist=persist_item)))
+            previous = name
+
+        steps.append(("start_persist", [previous] + data_steps,
+                      self.get_start_persist_step(job_uid=job_uid)))
 
-        print("Setting up dependency manager...")
-        success, msg = self.setup_dependency_manager(
+        dependency_step = self.get_dependency_manager_step(
             job_uid=job_uid,
             run_yml=job_yml["run"],
-        )
-        if not success:
-            return success, msg
+            installs=job_yml.get("install", []))
+        if dependency_step is None:
+            return None
+        steps.append(("dependency_manager", [unpacked], dependency_step))
+        return steps
 
-        return True, "Successfully setup the job"
+    def run_setup_playbook(self, steps):
+        """Runs every setup step in one generated playbook
+
+        Saves forking ansible, parsing the inventory and connecting to the
+        host once per task.  Each step is a block whose rescue fails with the
+        step's failure message, and starts with a marker task used to time it
+
+        Args:
+            steps ([(str, [str], dict)]): Steps from get_setup_steps
+
+        Returns:
+            (bool, str, dict): Success, message and seconds per step
+        """
+        tasks = []
+        for index, (name, _, step) in enumerate(steps):
+            tasks.append({
+                "name":
+                    name,
+                "block": [{
+                    "name": f"{SETUP_STEP_MARKER} {index}",
+                    "debug": {
+                        "msg": name
+                    },
+                }] + step["tasks"],
+                "rescue": [{
+                    "name": f"{SETUP_STEP_FAILED} {index}",
+                    "fail": {
+                        "msg": step["failure"]
+                    },
+                }],
+            })
+        playbook = [{"hosts": self.name, "gather_facts": False, "tasks": tasks}]
+
+        uuid = self.get_run_uuid()
+        runner = self.run_ansible_playbook_inexclusively(
+            playbook=playbook,
+            extravars=dict(),
+            cancel_callback=self.ansible_runner_uuid_cancel(uuid))
+        end_time = datetime.now()
+
+        step_starts = []
+        failed_index = None
+        for event in runner.captured_events:
+            task = event.get("event_data", dict()).get("task", "")
+            if task.startswith(SETUP_STEP_FAILED):
+                failed_index = int(task.split()[-1])
+            elif task.startswith(SETUP_STEP_MARKER) and \
+                    event.get("event") == "runner_on_ok":
+                step_starts.append((int(task.split()[-1]),
+                                    datetime.fromisoformat(event["created"])))
+        timings = dict()
+        for i, (index, start) in enumerate(step_starts):
+            end = step_starts[i + 1][1] if i + 1 < len(step_starts) \
+                else end_time
+            timings[steps[index][0]] = round((end - start).total_seconds(), 2)
+
+        if self.get_uuid() != uuid:
+            return False, "Running setup cancelled due to concurrency", timings
+        if failed_index is not None:
+            self.print_failed_event(runner=runner)
+            return False, steps[failed_index][2]["failure"], timings
+        if runner.status == "failed":
+            self.print_failed_event(runner=runner)
+            return False, "Failed to run setup playbook", timings
+        return True, "Setup steps ran successfully", timings
+
+    def run_setup_steps(self, steps):
+        """Runs each setup step once all of its dependencies succeeded
+
+        Args:
+            steps ([(str, [str], function)]): Name, names of the steps it
+                depends on and the step, which returns (success, message)
+
+        Returns:
+            (bool, str, dict): Success, message and seconds per step
+        """
+        uuid = self.update_uuid()
+        event_log = self.get_event_log()
+        timings = dict()
+
+        def run_step(name, step):
+            self.run_context.uuid = uuid
+            self.run_context.event_log = event_log
+            start = time.time()
+            try:
+                return step()
+            finally:
+                timings[name] = round(time.time() - start, 2)
+                self.run_context.uuid = None
+                self.run_context.event_log = None
+                if event_log is not None:
+                    event_log.flush()
+
+        pending = list(steps)
+        done = set()
+        running = dict()
+        failure = None
+        with ThreadPoolExecutor(max_workers=SETUP_STEP_WORKERS) as executor:
+            while (pending and failure is None) or running:
+                if failure is None:
+                    for entry in list(pending):
+                        name, dependencies, step = entry
+                        if all(x in done for x in dependencies):
+                            pending.remove(entry)
+                            running[executor.submit(run_step, name,
+                                                    step)] = name
+                if not running:
+                    failure = "Setup steps have unmet dependencies"
+                    break
+                finished, _ = wait(running.keys(),
+                                   return_when=FIRST_COMPLETED)
+                for future in finished:
+                    name = running.pop(future)
+                    try:
+                        success, msg = future.result()
+                    except Exception as e:
+                        success, msg = False, f"{name} failed: {e}"
+                    if success:
+                        done.add(name)
+                    elif failure is None:
+                        failure = msg
+        if failure is not None:
+            return False, failure, timings
+        return True, "Setup steps ran successfully", timings
+
+    def get_install_ledger_path(self):
+        return os.path.join(self.get_scratch_dir(), ".monkey-install-ledger")
+
+    def load_install_ledger(self):
+        """Reads the installs a host has done from its ledger
+
+        The ledger lives on the host so it survives restarts of the core.
+        Each line is a dependency and the fingerprint of its role.
+        """
+        if self.install_ledger_loaded:
+            return self.installed_dependencies
+        runner = self.run_ansible_module_inexclusively(
+            modulename="slurp",
+            args={"src": self.get_install_ledger_path()})
+        for event in runner.captured_events:
+            if event.get("event") != "runner_on_ok":
+                continue
+            content = event["event_data"].get("res", dict()).get("content")
+            if content is None:
+                continue
+            for line in base64.b64decode(content).decode().splitlines():
+                if len(line.split()) == 2:
+                    dependency, fingerprint = line.split()
+                    self.installed_dependencies.setdefault(
+                        dependency, fingerprint)
+        # A missing ledger means nothing was installed yet
+        self.install_ledger_loaded = True
+        return self.installed_dependencies
+
+    def record_install(self, dependency, fingerprint):
+        self.installed_dependencies[dependency] = fingerprint
+        ledger_args = {
+            "path": self.get_install_ledger_path(),
+            "regexp": "^" + re.escape(f"{dependency} "),
+            "line": f"{dependency} {fingerprint}",
+            "create": "yes",
+        }
+        try:
+            self.run_ansible_module(modulename="lineinfile", args=ledger_args)
+        except AnsibleRunException as e:
+            print(e)
+            logger.error(f"Failed to record install of {dependency}")
+
+    def install_dependency(self, dependency, force=False):
+        """Runs the install role for a dependency
 
-    def install_dependency(self, dependency):
+        Skipped when the host's ledger shows the dependency was installed by
+        the same version of the role, unless force is set
+
+        Returns:
+            bool: True if the dependency is installed
+        """
+        rolename = f"setup/install/{dependency}"
+        fingerprint = get_role_fingerprint(rolename)
+        if not force and \
+                self.load_install_ledger().get(dependency) == fingerprint:
+            logger.info(f"Dependency: {dependency} already installed")
+            return True
         logger.info(f"Instance installing: {dependency}")
 
         try:
-            self.run_ansible_role(rolename=f"setup/install/{dependency}")
+            self.run_ansible_role(rolename=rolename)
         except AnsibleRunException as e:
             print(e)
             logger.error(f"Installing Dependency: {dependency} failed")
             return False
 
         logger.info(f"Installing Dependency: {dependency} succeeded!")
+        self.record_install(dependency, fingerprint)
+        return True
+
+    def warm_up(self, installs, job_yml, provider_info=dict()):
+        """Installs dependencies and mounts monkeyfs ahead of any job
+
+        Returns:
+            bool: True if the instance is ready to be handed to a job
+        """
+        for dependency in installs:
+            if not self.install_dependency(dependency):
+                return False
+        success, msg = self.mount_monkeyfs(job_yml=job_yml,
+                                           provider_info=provider_info)
+        if not success:
+            logger.error(f"Failed to warm up {self.name}: {msg}")
+            return False
+        self.monkeyfs_mounted = True
         return True
 
     def cleanup_job(self, job_yml, provider_info=dict()):
         raise NotImplementedError("This is not implemented yet")
 
+    def reset_job(self, job_yml, provider_info=dict()):
+        """Stops a finished job's persist loop and removes its files
+
+        Leaves the instance booted with its installs, their
+        ~/.monkey_machine_activate and its monkeyfs mount so another job can
+        run on it
+
+        Returns:
+            (bool, str): (Success, Message)
+        """
+        job_uid = job_yml["job_uid"]
+        job_dir = os.path.normpath(self.get_job_dir(job_uid=job_uid))
+        unique_persist_all_script_name = self.get_unique_persist_all_script_name(
+            job_uid=job_uid)
+        try:
+            self.run_ansible_shell(
+                command=f"killall {unique_persist_all_script_name} || true")
+            if job_dir == os.path.normpath(self.get_scratch_dir()):
+                # Jobs unpack straight into the scratch dir, keep dotfiles
+                # such as the monkey client and ssh keys
+                self.run_ansible_shell(
+                    command=f"find {job_dir} -mindepth 1 -maxdepth 1 " +
+                    "! -name .\\* -exec rm -rf {} + ; " +
+                    f"rm -f {self.get_monkey_activate_file(job_uid=job_uid)}")
+            else:
+                self.run_ansible_shell(command=f"rm -rf {job_dir}")
+        except AnsibleRunException as e:
+            print(e)
+            return False, "Failed to reset instance for the next job"
+        return True, "Successfully reset instance for the next job"
+
     def get_monkeyfs_dir(self):
         raise NotImplementedError("This is not implemented yet")
 
@@ -344,6 +738,9 @@ class MonkeyInstance():
     def get_job_dir(self, job_uid):
         return os.path.join(self.get_scratch_dir(), job_uid, "")
 
+    def get_env_cache_dir(self):
+        return os.path.join(self.get_scratch_dir(), ".monkey-envs")
+
     def get_monkeyfs_job_dir(self, job_uid):
         return os.path.join(self.get_monkeyfs_dir(), "jobs", job_uid, "")
 
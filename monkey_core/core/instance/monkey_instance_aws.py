@@ -1,8 +1,8 @@
 import logging
 import os
 
-import ansible_runner
 from core import monkey_global
+from core.instance.monkey_ansible import run_ansible
 from core.instance.monkey_instance import AnsibleRunException, MonkeyInstance
 from core.setup_scripts.utils import aws_cred_file_environment, get_aws_vars
 
@@ -22,6 +22,7 @@ name: {}, ip: {}, state: {}
             "name": self.name,
             "ip_address": self.ip_address,
             "state": self.state,
+            "online": self.online,
             "machine_zone": self.machine_zone,
         }
 
@@ -92,8 +93,9 @@ name: {}, ip: {}, state: {}
         # Cleanup skipped for now
         print(provider_info)
 
+        # Instances drawn from a warm pool are not named after their job
         delete_instance_params = {
-            "monkey_job_uid": job_uid,
+            "monkey_job_uid": self.name,
             "aws_zone": provider_info["zone"],
             "aws_region": provider_info["zone"],
         }
@@ -102,7 +104,7 @@ name: {}, ip: {}, state: {}
             delete_instance_params[key] = val
 
         uuid = self.update_uuid()
-        runner = ansible_runner.run(
+        runner = run_ansible(
             host_pattern="localhost",
             private_data_dir="ansible",
             module="include_role",
@@ -117,4 +119,5 @@ name: {}, ip: {}, state: {}
         if runner.status == "failed":
             print("Failed Deletion of machine")
             return False, "Failed to cleanup job after completion"
+        self.close_ssh_executor()
         return True, "Succesfully cleaned up job"
@@ -1,7 +1,7 @@
 import logging
 
-import ansible_runner
 from core import monkey_global
+from core.instance.monkey_ansible import run_ansible
 from core.instance.monkey_instance import AnsibleRunException, MonkeyInstance
 from core.setup_scripts.utils import get_gcp_vars
 
@@ -22,6 +22,7 @@ name: {}, ip: {}, state: {}
             "name": self.name,
             "ip_address": self.ip_address,
             "state": self.state,
+            "online": self.online,
             "machine_zone": self.machine_zone,
             "machine_project": self.machine_project,
         }
@@ -51,6 +52,13 @@ name: {}, ip: {}, state: {}
         self.ansible_info = ansible_info
         self.state = ansible_info["status"]
 
+    def update_instance_details(self, other):
+        super().update_instance_details(other)
+        self.ansible_info = other.ansible_info
+        self.state = other.state
+        self.machine_zone = other.machine_zone
+        self.machine_project = other.machine_project
+
     def mount_monkeyfs(self, job_yml, provider_info):
         gcp_storage_name = provider_info["gcp_storage_name"]
         monkeyfs_path = provider_info.get("monkeyfs_path", "/monkeyfs")
@@ -78,15 +86,16 @@ name: {}, ip: {}, state: {}
         logger.debug("\n\nTerminating Machine:", job_uid, "\n\n")
         # Cleanup skipped for now
 
+        # Instances drawn from a warm pool are not named after their job
         delete_instance_params = {
-            "monkey_job_uid": job_uid,
+            "monkey_job_uid": self.name,
         }
 
         for key, val in get_gcp_vars().items():
             delete_instance_params[key] = val
 
         uuid = self.update_uuid()
-        runner = ansible_runner.run(
+        runner = run_ansible(
             host_pattern="localhost",
             private_data_dir="ansible",
             module="include_role",
@@ -101,4 +110,5 @@ name: {}, ip: {}, state: {}
         if runner.status == "failed":
             logger.error("Failed Deletion of machine")
             return False, "Failed to cleanup job after completion"
+        self.close_ssh_executor()
         return True, "Succesfully cleaned up job"
@@ -1,10 +1,11 @@
 import logging
 import os
+from datetime import datetime
 
 import ansible_runner
-import requests
 import yaml
 from core.instance.monkey_instance import AnsibleRunException, MonkeyInstance
+from core.instance.monkey_ssh import SSHCommandLostException
 
 logger = logging.getLogger(__name__)
 
@@ -22,6 +23,7 @@ name: {}, ip: {}, state: {}
             "name": self.name,
             "ip_address": self.ip_address,
             "state": self.state,
+            "online": self.online,
         }
 
     # Passes compute_api in order to restart instances
@@ -34,14 +36,11 @@ name: {}, ip: {}, state: {}
         try:
             with open("local.yml", 'r') as local_yaml_file:
                 local_yaml = yaml.full_load(local_yaml_file)
-                hosts = local_yaml.get("hosts", [])
-                extra_vars = None
-                for h in hosts:
-                    if h[0] == self.name:
-                        extra_vars = h[1]
+                hosts = self.provider.get_local_hosts(local_yaml)
+                extra_vars = hosts.get(self.name, None)
                 if extra_vars is not None:
                     print("Additional local vars detected: ", extra_vars)
-                    self.additional_extravars.update(extra_vars)
+                    self.channel.update_extravars(extra_vars)
         except Exception as e:
             print(e)
 
@@ -51,7 +50,8 @@ name: {}, ip: {}, state: {}
         else:
             raise Exception("Failed to create instance")
 
-        self.offline_count = 0
+        # The setup just ran on the host
+        self.record_ping(True)
 
     def mount_monkeyfs(self, job_yml, provider_info):
         return True, "No mounting needed, was mounted in setup"
@@ -77,22 +77,51 @@ name: {}, ip: {}, state: {}
 
         return True
 
-    def check_online(self):
-        return True
-        try:
-            r = requests.get("http://{}:9991/ping".format(self.ip_address),
-                             timeout=4)
-        except:
-            self.offline_count += 1
-            return self.offline_count >= self.offline_retries
-        if not r.ok:
-            self.offline_count += 1
-        if self.offline_count >= self.offline_retries:
-            return False
-        self.offline_count = 0
+    def ping(self):
         return True
 
-    def install_dependency(self, dependency):
+    def update_load(self):
+        """Reads the cpu count, load average and free gpu memory of the host
+
+        Returns:
+            dict: The load, None if the host could not be read
+        """
+        command = "echo $(nproc) $(cut -d ' ' -f 1 /proc/loadavg); " + \
+            "nvidia-smi --query-gpu=memory.free " + \
+            "--format=csv,noheader,nounits 2>/dev/null || true"
+        outputs = []
+        try:
+            result = self.run_ssh_command(command)
+        except SSHCommandLostException:
+            # Only reads the host, safe to run again through ansible
+            result = None
+        if result is not None:
+            outputs.append(result[1])
+        else:
+            runner = self.run_ansible_module_inexclusively(modulename="shell",
+                                                           args=command)
+            outputs = [
+                x["event_data"].get("res", dict()).get("stdout", "")
+                for x in runner.captured_events
+                if x.get("event") == "runner_on_ok"
+            ]
+        for stdout in outputs:
+            lines = stdout.splitlines()
+            try:
+                cpus, load_average = lines[0].split()
+                self.load = {
+                    "cpus": int(cpus),
+                    "load_average": float(load_average),
+                    "gpu_free_memory": [
+                        float(x) for x in lines[1:] if x.strip()
+                    ],
+                    "date": datetime.now(),
+                }
+            except (IndexError, ValueError) as e:
+                logger.error(f"Failed to read load of {self.name}: {e}")
+        return self.load
+
+    def install_dependency(self, dependency, force=False):
         print("Instance Dependency Installation SKIPPED (local): ", dependency)
         return True
 
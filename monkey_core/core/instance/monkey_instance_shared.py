@@ -1,6 +1,47 @@
 import os
 
-from core.instance.monkey_instance import AnsibleRunException
+from core.instance.monkey_instance import (ENV_CACHE_MIN_IDLE, ENV_CACHE_SIZE,
+                                           AnsibleRunException)
+
+
+#############################################
+#
+#  0. Run setup steps
+#
+#############################################
+def module_task(name, modulename, args):
+    return {"name": name, modulename: args}
+
+
+def role_task(name, rolename, extravars):
+    return {
+        "name": name,
+        "include_role": {
+            "name": rolename
+        },
+        "vars": extravars,
+    }
+
+
+def run_setup_step(self, step):
+    """
+    Runs the ansible tasks of a setup step one call at a time
+    A step is a dict of its tasks and the success and failure messages
+    """
+    try:
+        for task in step["tasks"]:
+            if "include_role" in task:
+                self.run_ansible_role(rolename=task["include_role"]["name"],
+                                      extravars=dict(task["vars"]))
+            else:
+                modulename = [x for x in task.keys() if x != "name"][0]
+                self.run_ansible_module(modulename=modulename,
+                                        args=task[modulename])
+    except AnsibleRunException as e:
+        print(e)
+        print(step["failure"])
+        return False, step["failure"]
+    return True, step["success"]
 
 
 #############################################
@@ -8,7 +49,7 @@ from core.instance.monkey_instance import AnsibleRunException
 #  1. Set up the dataset by unpacking it
 #
 #############################################
-def setup_data_item(self, job_uid, data_item):
+def get_data_item_step(self, job_uid, data_item):
     installation_location = os.path.join(self.get_job_dir(job_uid=job_uid),
                                          data_item["path"])
 
@@ -17,26 +58,27 @@ def setup_data_item(self, job_uid, data_item):
                                               extension=data_item["extension"])
     print("Copying dataset from", dataset_full_path, " to ",
           installation_location)
+    return {
+        "tasks": [
+            module_task("Create data folder", "file", {
+                "path": installation_location,
+                "state": "directory"
+            }),
+            module_task(
+                "Extract data archive", "unarchive", {
+                    "src": dataset_full_path,
+                    "remote_src": "True",
+                    "dest": installation_location,
+                }),
+        ],
+        "success": "Successfully setup data item",
+        "failure": "Failed to extract archive",
+    }
 
-    try:
-        self.run_ansible_module(modulename="file",
-                                args={
-                                    "path": installation_location,
-                                    "state": "directory"
-                                })
-
-        self.run_ansible_module(modulename="unarchive",
-                                args={
-                                    "src": dataset_full_path,
-                                    "remote_src": "True",
-                                    "dest": installation_location,
-                                })
-    except AnsibleRunException as e:
-        print(e)
-        return False, "Failed to extract archive"
 
-    print("Successfully setup data item")
-    return True, "Successfully setup data item"
+def setup_data_item(self, job_uid, data_item):
+    return self.run_setup_step(
+        self.get_data_item_step(job_uid=job_uid, data_item=data_item))
 
 
 #############################################
@@ -44,25 +86,25 @@ def setup_data_item(self, job_uid, data_item):
 #  2. Unpack Job Dir
 #
 #############################################
-def unpack_job_dir(self, job_uid):
+def get_job_dir_step(self, job_uid):
     job_path = os.path.join(self.get_job_dir(job_uid=job_uid), "")
     monkeyfs_job_path = os.path.join(
         self.get_monkeyfs_job_dir(job_uid=job_uid), "")
+    return {
+        "tasks": [
+            module_task("Copy job directory", "copy", {
+                "src": monkeyfs_job_path,
+                "dest": job_path,
+                "remote_src": True
+            })
+        ],
+        "success": "Unpacked code and persisted directories successfully",
+        "failure": "Failed to copy directory",
+    }
 
-    try:
-        self.run_ansible_module(modulename="copy",
-                                args={
-                                    "src": monkeyfs_job_path,
-                                    "dest": job_path,
-                                    "remote_src": True
-                                })
-    except AnsibleRunException as e:
-        print(e)
-        print("Failed to copy directory")
-        return False, "Failed to copy directory"
 
-    print("Unpacked job dir successfully")
-    return True, "Unpacked code and persisted directories successfully"
+def unpack_job_dir(self, job_uid):
+    return self.run_setup_step(self.get_job_dir_step(job_uid=job_uid))
 
 
 #############################################
@@ -70,7 +112,7 @@ def unpack_job_dir(self, job_uid):
 #  3. Unpack codebase
 #
 #############################################
-def unpack_code_and_persist(self, job_uid, code_item):
+def get_code_step(self, job_uid, code_item):
     print(code_item)
     run_name = code_item["run_name"]
     checksum = code_item["checksum"]
@@ -83,22 +125,24 @@ def unpack_code_and_persist(self, job_uid, code_item):
     job_dir_path = self.get_job_dir(job_uid=job_uid)
     print("Code tar path: ", code_tar_path)
     print("Run dir: ", job_dir_path)
+    return {
+        "tasks": [
+            module_task(
+                "Extract code archive", "unarchive", {
+                    "src": code_tar_path,
+                    "remote_src": "True",
+                    "dest": job_dir_path,
+                    "creates": "yes"
+                })
+        ],
+        "success": "Unpacked code and persisted directories successfully",
+        "failure": "Failed to extract code archive",
+    }
 
-    try:
-        self.run_ansible_module(modulename="unarchive",
-                                args={
-                                    "src": code_tar_path,
-                                    "remote_src": "True",
-                                    "dest": job_dir_path,
-                                    "creates": "yes"
-                                })
-    except AnsibleRunException as e:
-        print(e)
-        print("Failed to unpack code")
-        return False, "Failed to extract code archive"
 
-    print("Unpacked code successfully")
-    return True, "Unpacked code and persisted directories successfully"
+def unpack_code_and_persist(self, job_uid, code_item):
+    return self.run_setup_step(
+        self.get_code_step(job_uid=job_uid, code_item=code_item))
 
 
 #############################################
@@ -106,7 +150,7 @@ def unpack_code_and_persist(self, job_uid, code_item):
 #  4. Sets up Logs folder
 #
 #############################################
-def setup_logs_folder(self, job_uid):
+def get_logs_folder_step(self, job_uid):
     """
     Creates a logs folder and a sync script which will get executed
     Every time persist_all is executed
@@ -128,17 +172,18 @@ def setup_logs_folder(self, job_uid):
         "bucket_path": monkeyfs_output_folder,
         "persist_time": 3,
     }
-    try:
-        self.run_ansible_role(
-            rolename="setup/sync/persist_folder",
-            extravars=persist_folder_args,
-        )
-    except AnsibleRunException as e:
-        print(e)
-        print("Failed to create persisted logs folder")
-        return False, "Failed to create persisted logs folder"
+    return {
+        "tasks": [
+            role_task("Persist logs folder", "setup/sync/persist_folder",
+                      persist_folder_args)
+        ],
+        "success": "Setup logs persistence ran successfully",
+        "failure": "Failed to create persisted logs folder",
+    }
 
-    return True, "Setup logs persistence ran successfully"
+
+def setup_logs_folder(self, job_uid):
+    return self.run_setup_step(self.get_logs_folder_step(job_uid=job_uid))
 
 
 #############################################
@@ -146,7 +191,7 @@ def setup_logs_folder(self, job_uid):
 #  5. Set up Persist folders
 #
 #############################################
-def setup_persist_folder(self, job_uid, persist):
+def get_persist_folder_step(self, job_uid, persist):
     """
     For every folder defined, a persist script is generated.
     The persist script will live in {job_dir}/sync/ and be executed
@@ -173,14 +218,19 @@ def setup_persist_folder(self, job_uid, persist):
         "persist_script_path": script_path,
         "bucket_path": monkeyfs_output_folder,
     }
-    try:
-        self.run_ansible_role(rolename="setup/sync/persist_folder",
-                              extravars=persist_folder_args)
-    except AnsibleRunException as e:
-        print(e)
-        print("Failed to setup persist folder: " + persist_path)
-        return False, f"Failed to setup persist folder: {persist_path}"
-    return True, "Setup persist ran successfully"
+    return {
+        "tasks": [
+            role_task("Persist folder " + persist_path,
+                      "setup/sync/persist_folder", persist_folder_args)
+        ],
+        "success": "Setup persist ran successfully",
+        "failure": f"Failed to setup persist folder: {persist_path}",
+    }
+
+
+def setup_persist_folder(self, job_uid, persist):
+    return self.run_setup_step(
+        self.get_persist_folder_step(job_uid=job_uid, persist=persist))
 
 
 #############################################
@@ -188,7 +238,7 @@ def setup_persist_folder(self, job_uid, persist):
 #  6. Starts Persist Script Loop
 #
 #############################################
-def start_persist(self, job_uid):
+def get_start_persist_step(self, job_uid):
     """
     The persist script loop runs every designated time period
     and will sync all persisted folders, logs, or other defined persists
@@ -209,15 +259,18 @@ def start_persist(self, job_uid):
         "unique_persist_all_script_name": unique_persist_all_script_name,
         "persist_loop_script_path": script_loop_path,
     }
-    try:
-        self.run_ansible_role(rolename="setup/sync/start_persist",
-                              extravars=start_persist_args)
-    except AnsibleRunException as e:
-        print(e)
-        print("Failed start persistence of directories")
-        return False, "Failed start persistence of directories"
+    return {
+        "tasks": [
+            role_task("Start persist loop", "setup/sync/start_persist",
+                      start_persist_args)
+        ],
+        "success": "Start persist ran successfully",
+        "failure": "Failed start persistence of directories",
+    }
+
 
-    return True, "Start persist ran successfully"
+def start_persist(self, job_uid):
+    return self.run_setup_step(self.get_start_persist_step(job_uid=job_uid))
 
 
 #############################################
@@ -225,10 +278,13 @@ def start_persist(self, job_uid):
 #  7. Setup Environment Activation
 #
 #############################################
-def setup_dependency_manager(self, job_uid, run_yml):
+def get_dependency_manager_step(self, job_uid, run_yml, installs=None):
     """
     For every environment type, there needs to be special activation code
     added to the .monkey_activate to load environment variables upon run script.
+    Conda and pip environments are built once per host for each environment
+    file and install set, and reused by later jobs.
+    Returns None for an unknown environment type
     """
     job_dir_path = self.get_job_dir(job_uid=job_uid)
     env_type = run_yml["env_type"]
@@ -240,26 +296,32 @@ def setup_dependency_manager(self, job_uid, run_yml):
     env_args = {
         "environment_file": env_file,
         "activate_file": activate_file,
-        "job_dir_path": job_dir_path
+        "job_dir_path": job_dir_path,
+        "env_cache_dir": self.get_env_cache_dir(),
+        "env_cache_size": ENV_CACHE_SIZE,
+        "env_cache_min_idle": ENV_CACHE_MIN_IDLE,
+        "install_set": sorted(installs or []),
+    }
+    if env_type not in ("conda", "pip", "docker"):
+        return None
+    return {
+        "tasks": [
+            role_task("Setup " + env_type + " environment",
+                      "run/setup_" + env_type, env_args)
+        ],
+        "success": "Successfully created dependency manager" +
+                   "\nStored initialization in .monkey_activate",
+        "failure": "Failed to initialize environment manager",
     }
-    try:
-        if env_type == "conda":
-            self.run_ansible_role(rolename="run/setup_conda",
-                                  extravars=env_args)
-        elif env_type == "pip":
-            self.run_ansible_role(rolename="run/setup_pip", extravars=env_args)
-        elif env_type == "docker":
-            self.run_ansible_role(rolename="run/setup_docker",
-                                  extravars=env_args)
-        else:
-            return False, "Provided or missing dependency manager"
 
-    except AnsibleRunException as e:
-        print(e)
-        return False, "Failed to initialize environment manager"
 
-    return True, "Successfully created dependency manager" + \
-        "\nStored initialization in .monkey_activate"
+def setup_dependency_manager(self, job_uid, run_yml, installs=None):
+    step = self.get_dependency_manager_step(job_uid=job_uid,
+                                            run_yml=run_yml,
+                                            installs=installs)
+    if step is None:
+        return False, "Provided or missing dependency manager"
+    return self.run_setup_step(step)
 
 
 #############################################
@@ -267,16 +329,21 @@ def setup_dependency_manager(self, job_uid, run_yml):
 #  8. Run Command
 #
 #############################################
-def execute_command(self, job_uid, cmd, run_yml):
+def execute_command(self, job_uid, cmd, run_yml, resource_allocation=None):
     """
     This helper function will activate the .monkey_activate
     and run the defined command while piping output to the logs folder
+    Jobs bound to GPUs only see those devices through CUDA_VISIBLE_DEVICES
     """
     print("Executing cmd: ", cmd)
     print("Environment Variables:", run_yml.get("env", dict()))
 
     job_dir_path = self.get_job_dir(job_uid=job_uid)
     activate_file = self.get_monkey_activate_file(job_uid=job_uid)
+    job_environment = dict()
+    if resource_allocation and "gpus" in resource_allocation:
+        job_environment["CUDA_VISIBLE_DEVICES"] = ",".join(
+            str(x) for x in resource_allocation["gpus"])
 
     try:
         self.run_ansible_role(
@@ -285,6 +352,7 @@ def execute_command(self, job_uid, cmd, run_yml):
                 "run_command": cmd,
                 "job_dir_path": job_dir_path,
                 "activate_file": activate_file,
+                "job_environment": job_environment,
             },
             envvars=run_yml.get("env", dict()),
         )
@@ -303,9 +371,11 @@ def run_job(self, job_yml, provider_info=dict()):
     """
     print("Running job: ", job_yml)
     job_uid = job_yml["job_uid"]
-    success, msg = self.execute_command(job_uid=job_uid,
-                                        cmd=job_yml["cmd"],
-                                        run_yml=job_yml["run"])
+    success, msg = self.execute_command(
+        job_uid=job_uid,
+        cmd=job_yml["cmd"],
+        run_yml=job_yml["run"],
+        resource_allocation=job_yml.get("resource_allocation", None))
     if not success:
         return success, msg
 
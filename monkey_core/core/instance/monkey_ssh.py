@@ -0,0 +1,271 @@
+import getpass
+import logging
+import os
+import shlex
+import threading
+import time
+
+import paramiko
+from ansible.inventory.manager import InventoryManager
+from ansible.parsing.dataloader import DataLoader
+from ansible.vars.manager import VariableManager
+
+logger = logging.getLogger(__name__)
+
+# Seconds before the ssh fast path is retried on an instance it failed on
+SSH_RETRY_TIME = 300
+SSH_CONNECT_TIMEOUT = 10
+SSH_KEEPALIVE_INTERVAL = 30
+
+
+class SSHRunException(Exception):
+    """The command never started, it is safe to run it another way"""
+    pass
+
+
+class SSHCommandLostException(Exception):
+    """The connection failed after the command started, it may have run"""
+    pass
+
+
+def get_connection_settings(hostname, extravars=dict()):
+    """Reads how ansible connects to a host from the inventory
+
+    Host and group vars are resolved like ansible does, extravars take
+    precedence and ~/.ssh/config fills in anything the inventory doesn't set
+
+    Returns:
+        dict: hostname, port, username and key_filename for paramiko, None
+            if the host needs more than a plain ssh connection
+    """
+    loader = DataLoader()
+    inventory = InventoryManager(loader=loader, sources="ansible/inventory")
+    host = inventory.get_host(hostname)
+    host_vars = dict()
+    if host is not None:
+        host_vars = VariableManager(loader=loader,
+                                    inventory=inventory).get_vars(host=host)
+    host_vars = dict(host_vars, **extravars)
+    # Privilege escalation, passwords and other connection plugins stay
+    # with ansible
+    connection = host_vars.get("ansible_connection", "ssh")
+    if host_vars.get("ansible_become", False) or \
+            connection not in ("ssh", "smart") or \
+            "ansible_password" in host_vars:
+        return None
+
+    address = host_vars.get("ansible_host", hostname)
+    ssh_config = paramiko.SSHConfig()
+    ssh_config_path = os.path.expanduser("~/.ssh/config")
+    if os.path.isfile(ssh_config_path):
+        with open(ssh_config_path) as f:
+            ssh_config.parse(f)
+    host_config = ssh_config.lookup(address)
+
+    settings = {
+        "hostname":
+            host_config.get("hostname", address),
+        "port":
+            int(
+                host_vars.get("ansible_port", host_config.get("port", 22))),
+        "username":
+            host_vars.get("ansible_user",
+                          host_config.get("user", getpass.getuser())),
+        "key_filename":
+            host_vars.get("ansible_ssh_private_key_file",
+                          host_config.get("identityfile", None)),
+    }
+    if settings["key_filename"] is not None:
+        if type(settings["key_filename"]) is not list:
+            settings["key_filename"] = [settings["key_filename"]]
+        settings["key_filename"] = [
+            os.path.expanduser(x) for x in settings["key_filename"]
+        ]
+    return settings
+
+
+class SSHExecutor():
+    """A persistent ssh connection to one instance
+
+    Commands open a new channel on the same connection, so a short command
+    costs one round trip instead of an ansible_runner process, an inventory
+    parse and an ssh handshake.  The connection is reopened once if it
+    dropped since the last command, but a command that started is never
+    run again
+    """
+
+    def __init__(self, settings):
+        self.settings = settings
+        self.client = None
+        self.lock = threading.Lock()
+
+    def connect(self):
+        client = paramiko.SSHClient()
+        client.load_system_host_keys()
+        # Matches ansible's host_key_checking = False
+        client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        client.connect(timeout=SSH_CONNECT_TIMEOUT, **self.settings)
+        client.get_transport().set_keepalive(SSH_KEEPALIVE_INTERVAL)
+        return client
+
+    def get_client(self):
+        with self.lock:
+            transport = None if self.client is None \
+                else self.client.get_transport()
+            if transport is None or not transport.is_active():
+                self.close_client()
+                self.client = self.connect()
+            return self.client
+
+    def close_client(self):
+        if self.client is not None:
+            try:
+                self.client.close()
+            except Exception:
+                pass
+            self.client = None
+
+    def close(self):
+        with self.lock:
+            self.close_client()
+
+    def run(self, command, timeout=None):
+        """Runs a command under bash on the instance
+
+        Returns:
+            (int, str, str): (Exit status, stdout, stderr)
+
+        Raises:
+            SSHRunException: The command didn't start
+            SSHCommandLostException: The command started but its result
+                couldn't be read
+        """
+        for attempt in range(2):
+            try:
+                client = self.get_client()
+            except (paramiko.SSHException, OSError) as e:
+                raise SSHRunException(f"ssh connection failed: {e}")
+            try:
+                _, stdout, stderr = client.exec_command(
+                    "/bin/bash -c " + shlex.quote(command), timeout=timeout)
+            except (paramiko.SSHException, EOFError, OSError) as e:
+                # The connection dropped while idle, the command never ran
+                self.close()
+                if attempt == 1:
+                    raise SSHRunException(f"ssh command failed: {e}")
+                continue
+            try:
+                output = stdout.read().decode(errors="replace")
+                error = stderr.read().decode(errors="replace")
+                return stdout.channel.recv_exit_status(), output, error
+            except (paramiko.SSHException, EOFError, OSError) as e:
+                self.close()
+                raise SSHCommandLostException(
+                    f"ssh connection lost while running command: {e}")
+
+
+def module_to_command(modulename, args):
+    """The shell command for a simple ansible module call
+
+    Returns:
+        str: The command, None if the module needs ansible
+    """
+    if modulename in ("shell", "command") and type(args) is str:
+        return args
+    if type(args) is not dict:
+        return None
+    if modulename == "unarchive":
+        return unarchive_to_command(args)
+    if modulename != "file" or set(args.keys()) - {"path", "state", "mode"}:
+        return None
+    path = shlex.quote(str(args["path"]))
+    if args.get("state") == "directory":
+        command = f"mkdir -p {path}"
+        if "mode" in args:
+            command += f" && chmod {shlex.quote(str(args['mode']))} {path}"
+        return command
+    if args.get("state") == "absent":
+        return f"rm -rf {path}"
+    return None
+
+
+def unarchive_to_command(args):
+    """tar for unarchive calls on tarballs already on the instance"""
+    if set(args.keys()) - {"src", "dest", "remote_src", "creates"} or \
+            str(args.get("remote_src", False)).lower() not in ("true", "yes"):
+        return None
+    if not str(args["src"]).endswith(
+        (".tar", ".tar.gz", ".tgz", ".tar.bz2", ".tar.xz")):
+        return None
+    command = "tar -xf {} -C {}".format(shlex.quote(str(args["src"])),
+                                       shlex.quote(str(args["dest"])))
+    if "creates" in args:
+        command = f"[ -e {shlex.quote(str(args['creates']))} ] || {command}"
+    return command
+
+
+def get_ssh_executor(instance):
+    """The instance's ssh executor, created on first use
+
+    Returns:
+        SSHExecutor: None while the fast path is unavailable on the instance
+    """
+    with instance.ssh_lock:
+        if instance.ssh_executor is not None:
+            return instance.ssh_executor
+        if instance.ssh_failed_time is not None and \
+                time.time() - instance.ssh_failed_time < SSH_RETRY_TIME:
+            return None
+        try:
+            settings = get_connection_settings(
+                instance.name, instance.channel.get_extravars())
+        except Exception as e:
+            logger.warning(
+                f"Failed to read ssh settings of {instance.name}: {e}")
+            settings = None
+        if settings is None:
+            instance.ssh_failed_time = time.time()
+            return None
+        instance.ssh_executor = SSHExecutor(settings)
+        return instance.ssh_executor
+
+
+def run_ssh_command(self, command, timeout=None):
+    """Runs a command over the instance's persistent ssh connection
+
+    Returns:
+        (int, str, str): (Exit status, stdout, stderr), None if the fast
+            path isn't available and the caller should use ansible
+
+    Raises:
+        SSHCommandLostException: The command started but its result is
+            unknown, running it again through ansible could run it twice
+    """
+    if not self.ssh_fast_path:
+        return None
+    executor = get_ssh_executor(self)
+    if executor is None:
+        return None
+    try:
+        return executor.run(command, timeout=timeout)
+    except SSHRunException as e:
+        logger.warning(f"Falling back to ansible on {self.name}: {e}")
+        disable_ssh_executor(self)
+        return None
+    except SSHCommandLostException:
+        disable_ssh_executor(self)
+        raise
+
+
+def disable_ssh_executor(instance):
+    with instance.ssh_lock:
+        instance.ssh_executor = None
+        instance.ssh_failed_time = time.time()
+
+
+def close_ssh_executor(self):
+    with self.ssh_lock:
+        executor = self.ssh_executor
+        self.ssh_executor = None
+    if executor is not None:
+        executor.close()
@@ -0,0 +1,107 @@
+import asyncio
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from core.instance.monkey_ansible import prune_artifacts
+from core.mongo import mongo_global as monkey_state
+from core.mongo.monkey_job import MonkeyJob
+
+logger = logging.getLogger(__name__)
+
+# Pings block on requests, so they are fanned out on a shared pool
+ping_executor = ThreadPoolExecutor(max_workers=32)
+
+
+async def ping_instances(instances):
+    loop = asyncio.get_event_loop()
+    results = await asyncio.gather(
+        *[loop.run_in_executor(ping_executor, x.ping) for x in instances],
+        return_exceptions=True)
+    for instance, reachable in zip(instances, results):
+        instance.record_ping(reachable is True)
+
+
+def probe_instances(self, log_file=None):
+    """Pings every known instance in parallel once per tick
+
+    The results are stored on each instance for HEALTH_CHECK_TTL seconds, so
+    check_online calls made by the rest of the tick and /list/instances
+    don't ping the instance again
+    """
+    instances = []
+    for provider in self.providers:
+        try:
+            instances += provider.list_instances()
+        except Exception as e:
+            logger.error(f"Failed to list instances for {provider.name}: {e}")
+
+    instances = [x for x in instances if x.ip_address is not None]
+    if len(instances) > 0:
+        asyncio.run(ping_instances(instances))
+    # Host load only feeds placement decisions, so it doesn't hold up the tick
+    for provider in self.providers:
+        ping_executor.submit(provider.refresh_load)
+
+    offline_num = len([x for x in instances if not x.online])
+    printout = f"Probed: {len(instances)} instances, {offline_num} offline\n"
+    if log_file:
+        log_file.write(printout)
+
+
+def get_used_instances():
+    """
+    Returns:
+        set: Names of the instances unfinished jobs run on, None if they
+            couldn't be read
+    """
+    try:
+        jobs = MonkeyJob.objects(state__nin=[
+            monkey_state.MONKEY_STATE_FINISHED,
+            monkey_state.MONKEY_STATE_FAILED
+        ]).only("job_uid", "stage_instance")
+        return set(x.stage_instance or x.job_uid for x in jobs)
+    except Exception as e:
+        logger.error(f"Failed to read the instances jobs run on: {e}")
+        return None
+
+
+def maintain_warm_pools(self, log_file=None):
+    """Refills and evicts each provider's warm pools in the background
+
+    Creating and installing instances takes minutes, so the tick only starts
+    the work.  Providers skip the call while a previous one is running.
+    The first call after a start also deletes pool machines left behind by
+    a previous core process, which needs the instances jobs run on.
+    """
+    printout = ""
+    used_instances = None
+    if any(not x.warm_pools_reconciled for x in self.providers):
+        used_instances = get_used_instances()
+    for provider in self.providers:
+        if len(provider.warm_pools) == 0 and provider.warm_pools_reconciled:
+            continue
+        threading.Thread(target=provider.maintain_warm_pools,
+                         args=(used_instances,),
+                         daemon=True).start()
+        for pool in provider.get_warm_pool_stats():
+            printout += "Warm pool {} {}: {}/{} idle\n".format(
+                provider.name, pool["machine_params"].get("machine_type", ""),
+                len(pool["idle"]), pool["target"])
+    if log_file:
+        log_file.write(printout)
+
+
+def prune_ansible_artifacts(self, log_file=None):
+    """Caps the ansible artifact directories by count and age
+
+    The first prune after an upgrade may remove a large backlog, so it runs
+    in the background like the warm pools
+    """
+
+    def prune():
+        removed = prune_artifacts()
+        if removed > 0:
+            logger.info(f"Removed {removed} ansible artifact directories")
+
+    threading.Thread(target=prune, daemon=True).start()
@@ -1,5 +1,6 @@
 import logging
 import threading
+import time
 from datetime import datetime, timedelta
 
 from core import monkey_global
@@ -14,23 +15,25 @@ logger = logging.getLogger(__name__)
 
 def check_for_queued_jobs(self, log_file=None):
     """Checks for all queued jobs and dispatches if necessary
-    """
-    queued_jobs = MonkeyJob.objects(state=monkey_state.MONKEY_STATE_QUEUED)
-    printout = f"Found {len(queued_jobs)}  queued jobs\n"
 
-    for job in queued_jobs:
-        printout += f"Dispatching Job: {job.job_uid}\n"
-        found_provider = None
-        for p in self.providers:
-            if p.name == job.provider_name:
-                found_provider = p
-        if found_provider is None:
-            printout += "Provider should have been defined for the job to be submitted\n"
+    Queued jobs are normally dispatched as soon as the dispatcher thread sees
+    them, this pass reconciles any that were missed
+    """
+    dispatched_jobs = self.dispatch_queued_jobs()
+    stats = self.get_dispatch_stats()
+    printout = f"Found {stats['queued_jobs']}  queued jobs\n"
+    for job_uid in dispatched_jobs:
+        printout += f"Dispatching Job: {job_uid}\n"
+    printout += "Dispatch workers: {}/{}, average wait: {:.1f}s\n".format(
+        stats["active_workers"], stats["max_concurrent_dispatches"],
+        stats["average_wait_time"])
+    # Queued jobs pick up free instances when their machine is requested
+    for provider in self.providers:
+        if not provider.instance_reuse:
             continue
-        job.set_state(state=monkey_state.MONKEY_STATE_DISPATCHING)
-        threading.Thread(target=self.run_job,
-                         args=(found_provider, job.job_yml),
-                         daemon=True).start()
+        evicted = provider.evict_free_instances()
+        printout += "Free instances {}: {}, evicted: {}\n".format(
+            provider.name, len(provider.free_instances), evicted)
 
     if not monkey_global.QUIET_PERIODIC_PRINTOUT:
         print(printout)
@@ -55,28 +58,47 @@ def print_jobs_string(self, jobs):
     return printout
 
 
-def check_for_dead_jobs(self, log_file=None):
-    pending_jobs = MonkeyJob.objects(creation_date__gte=(datetime.now() -
-                                                         timedelta(days=10)))
+# Fields needed to reconcile a job, everything else is left in mongo
+RECONCILE_FIELDS = [
+    "job_uid", "job_yml", "state", "provider_type", "provider_name",
+    "creation_date", "last_state_change", "run_timeout_time",
+    "run_elapsed_time", "run_cleanup_start_date", "lease_owner",
+    "lease_expiry", "dispatch_attempts", "stage_instance",
+    "completed_stages"
+]
+
+
+def get_reconcile_jobs():
+    """Loads the jobs to reconcile through the state indexes
+
+    Returns:
+        ([MonkeyJob], [MonkeyJob]): (Jobs in a non-terminal state, jobs
+            finished within MONKEY_FINISHED_RECHECK_TIME)
+    """
+    pending_jobs = list(
+        MonkeyJob.objects(state__in=monkey_state.MONKEY_RECONCILE_STATES).only(
+            *RECONCILE_FIELDS))
+    finished_jobs = list(
+        MonkeyJob.objects(
+            state=monkey_state.MONKEY_STATE_FINISHED,
+            completion_date__gte=(
+                datetime.now() -
+                timedelta(seconds=monkey_state.MONKEY_FINISHED_RECHECK_TIME))
+        ).only(*RECONCILE_FIELDS))
+    return pending_jobs, finished_jobs
 
-    current_jobs = [
-        x for x in pending_jobs
-        if x.state != monkey_state.MONKEY_STATE_FINISHED
-        and x.state != monkey_state.MONKEY_STATE_CLEANUP
-    ]
 
-    pending_job_num = len(current_jobs)
-    cleanup_jobs = [
-        x for x in pending_jobs if x.state == monkey_state.MONKEY_STATE_CLEANUP
-    ]
-    potential_missed_cleanup_num = len(cleanup_jobs)
+def check_for_dead_jobs(self, log_file=None):
+    pending_jobs, finished_jobs = get_reconcile_jobs()
+
+    pending_job_num = len([
+        x for x in pending_jobs if x.state != monkey_state.MONKEY_STATE_CLEANUP
+    ])
+    potential_missed_cleanup_num = len(pending_jobs) - pending_job_num
 
     printout = f"Found: {pending_job_num} jobs in pending state\n"
     printout += f"Checking: {potential_missed_cleanup_num} jobs for late cleanup\n"
-    printout += self.print_jobs_string([
-        x for x in pending_jobs
-        if x.state != monkey_state.MONKEY_STATE_FINISHED
-    ])
+    printout += self.print_jobs_string(pending_jobs)
 
     if not monkey_global.QUIET_PERIODIC_PRINTOUT:
         print(printout)
@@ -84,84 +106,133 @@ def check_for_dead_jobs(self, log_file=None):
     if log_file:
         log_file.write(printout)
 
-    # TODO (averylamp): retry counts
-    for job in pending_jobs:
-        if job.state == monkey_state.MONKEY_STATE_QUEUED:
-            continue
-        found_provider = None
-        for p in self.providers:
-            if p.name == job.provider_name:
-                found_provider = p
-        if found_provider is None:
-            logger.error(
-                "Provider should have been defined for the job to be submitted: {}"
-                .format(job))
-            continue
+    reconcile_job_uids = set()
+    for job in pending_jobs + finished_jobs:
+        reconcile_job_uids.add(job.job_uid)
+        self.reconcile_executor.submit(self.run_with_job_lock, job.job_uid,
+                                       self.reconcile_job, job)
+    self.prune_job_locks(keep_job_uids=reconcile_job_uids)
+
+
+def get_job_lock(self, job_uid):
+    with self.job_locks_lock:
+        if job_uid not in self.job_locks:
+            self.job_locks[job_uid] = threading.Lock()
+        return self.job_locks[job_uid]
+
+
+def prune_job_locks(self, keep_job_uids):
+    with self.job_locks_lock:
+        for job_uid in list(self.job_locks.keys()):
+            if job_uid not in keep_job_uids and \
+                    not self.job_locks[job_uid].locked():
+                del self.job_locks[job_uid]
 
-        job.total_wall_time = (datetime.now() -
-                               job.creation_date).total_seconds()
 
-        timeout_for_state = monkey_state.state_to_timeout(job.state)
-        time_elapsed = job.time_elapsed_in_state()
-        if timeout_for_state is not None and time_elapsed > timeout_for_state and \
-           job.state != monkey_state.MONKEY_STATE_CLEANUP:
-            print("Found Timed out job with state {}.  Requeueing job".format(
-                job.state))
+def run_with_job_lock(self, job_uid, fn, *args):
+    """Runs fn while holding the job's lock
 
+    Skips the call if the job is already being worked on, so a job stuck on
+    a slow instance is picked up again on a later tick instead of queueing
+    up behind itself
+    """
+    job_lock = self.get_job_lock(job_uid)
+    if not job_lock.acquire(blocking=False):
+        logger.info(f"Skipping {job_uid}, still reconciling from last check")
+        return
+    try:
+        fn(*args)
+    except Exception as e:
+        logger.error(f"Failed to reconcile job: {job_uid}\n{e}")
+    finally:
+        job_lock.release()
+
+
+def reconcile_job(self, job):
+    previous_owner = job.lease_owner
+    if previous_owner != self.owner_id:
+        # Another live core process is working on the job
+        if not job.take_over_lease(owner=self.owner_id):
+            return
+        if previous_owner is not None and \
+                job.state in monkey_state.MONKEY_IN_FLIGHT_STATES:
+            logger.info("Took over {} from {}, requeueing job".format(
+                job.job_uid, previous_owner))
             job.set_state(monkey_state.MONKEY_STATE_QUEUED)
+            return
+        if previous_owner is not None and \
+                job.is_stage_complete(monkey_state.MONKEY_STAGE_RELEASING) \
+                and not job.is_stage_complete(
+                    monkey_state.MONKEY_STAGE_RELEASED):
+            # The previous owner stopped partway through the release
+            job.drop_stage(monkey_state.MONKEY_STAGE_RELEASING)
+
+    found_provider = self.get_provider(job.provider_name)
+    if found_provider is None:
+        logger.error(
+            "Provider should have been defined for the job to be submitted: {}"
+            .format(job))
+        return
+
+    timeout_for_state = monkey_state.state_to_timeout(job.state)
+    time_elapsed = job.time_elapsed_in_state()
+    if timeout_for_state is not None and time_elapsed > timeout_for_state and \
+       job.state != monkey_state.MONKEY_STATE_CLEANUP:
+        print("Found Timed out job with state {}.  Requeueing job".format(
+            job.state))
 
-        if job.provider_type == "local":
-            print("looking for local instance: ", job.job_yml["instance"])
-            instance = found_provider.get_instance(job.job_yml["instance"])
-        else:
-            instance = found_provider.get_instance(job.job_uid)
-
-        if (job.state not in [
-                monkey_state.MONKEY_STATE_QUEUED,
-                monkey_state.MONKEY_STATE_FINISHED,
-                monkey_state.MONKEY_STATE_DISPATCHING_MACHINE,
-                monkey_state.MONKEY_STATE_DISPATCHING,
-                monkey_state.MONKEY_STATE_CLEANUP
-        ]):
-            # Instance can't be found and should have been created already
-            if (instance is None and job.state !=
-                    monkey_state.MONKEY_STATE_DISPATCHING_MACHINE):
-
-                job.set_state(monkey_state.MONKEY_STATE_QUEUED)
-            # Instance found and is offline
-            elif (instance is not None and not instance.check_online()):
-                job.set_state(monkey_state.MONKEY_STATE_QUEUED)
-
-        if job.state == monkey_state.MONKEY_STATE_RUNNING:
-            if (job.run_timeout_time != -1 and job.run_timeout_time != 0) \
-                and time_elapsed > job.run_timeout_time:
-                logger.info(
-                    "Reached maximum running time: {}.  Killing job".format(
-                        job.job_uid))
-                # Will run until finished cleanup
-                job.set_state(state=monkey_state.MONKEY_STATE_CLEANUP)
-        elif job.state == monkey_state.MONKEY_STATE_CLEANUP:
-            instance = found_provider.get_instance(job.job_uid)
-            if instance is None:
-                print("Skipping cleanup, machine already destroyed")
-                job.set_state(monkey_state.MONKEY_STATE_FINISHED)
-
-            if (job.run_cleanup_start_date is None) or (
-                ((time_elapsed > monkey_state.MONKEY_TIMEOUT_CLEANUP) and
-                 (instance is not None and instance.check_online() == True))):
-                threading.Thread(target=instance.cleanup_job,
-                                 args=(job.job_yml,
-                                       found_provider.get_dict())).start()
-                job.run_cleanup_start_date = datetime.now()
-            elif (instance is not None and instance.check_online() == False):
-                job.set_state(monkey_state.MONKEY_STATE_FINISHED)
-        elif job.state == monkey_state.MONKEY_STATE_FINISHED:
-            # Check if there are finished jobs that haven't been cleaned
-            instance = found_provider.get_instance(job.job_uid)
-            if instance is not None and instance.check_online() == True:
-                print("Machine found existing in finished state, cleaning...")
-                job.set_state(monkey_state.MONKEY_STATE_CLEANUP)
-        job.save()
+        self.requeue_job(job, reason=f"Timed out in state: {job.state}")
+        return
+
+    instance = self.get_job_instance(found_provider, job)
+
+    if (job.state not in [
+            monkey_state.MONKEY_STATE_FINISHED,
+            monkey_state.MONKEY_STATE_DISPATCHING_MACHINE,
+            monkey_state.MONKEY_STATE_DISPATCHING,
+            monkey_state.MONKEY_STATE_CLEANUP
+    ]):
+        # Instance can't be found and should have been created already
+        if instance is None:
+            self.requeue_job(job, reason="Instance could not be found")
+            return
+        # Instance found and is offline
+        elif not instance.check_online():
+            self.requeue_job(job, reason="Instance went offline")
+            return
+
+    if job.state == monkey_state.MONKEY_STATE_RUNNING:
+        if (job.run_timeout_time != -1 and job.run_timeout_time != 0) \
+            and time_elapsed > job.run_timeout_time:
+            logger.info(
+                "Reached maximum running time: {}.  Killing job".format(
+                    job.job_uid))
+            # Will run until finished cleanup
+            job.set_state(state=monkey_state.MONKEY_STATE_CLEANUP)
+    elif job.state == monkey_state.MONKEY_STATE_CLEANUP:
+        # Local hosts outlive their jobs, only cloud machines are torn down
+        if instance is None or job.provider_type == "local" or \
+                job.is_stage_complete(monkey_state.MONKEY_STAGE_RELEASED):
+            print("Skipping cleanup, machine already destroyed")
+            job.set_state(monkey_state.MONKEY_STATE_FINISHED)
+        elif job.is_stage_complete(monkey_state.MONKEY_STAGE_RELEASING):
+            # release_job_instance is still running
+            pass
+        elif (job.run_cleanup_start_date is None) or (
+            (time_elapsed > monkey_state.MONKEY_TIMEOUT_CLEANUP) and
+                instance.check_online() == True):
+            threading.Thread(target=self.release_job_instance,
+                             args=(found_provider, job, instance)).start()
+            job.update_fields(run_cleanup_start_date=datetime.now())
+        elif instance.check_online() == False:
+            job.set_state(monkey_state.MONKEY_STATE_FINISHED)
+    elif job.state == monkey_state.MONKEY_STATE_FINISHED:
+        # Check if there are finished jobs that haven't been cleaned
+        if job.provider_type != "local" and instance is not None and \
+                not job.is_stage_complete(monkey_state.MONKEY_STAGE_RELEASED) \
+                and instance.check_online() == True:
+            print("Machine found existing in finished state, cleaning...")
+            job.set_state(monkey_state.MONKEY_STATE_CLEANUP)
 
 
 def check_for_job_hyperparameters(self, log_file=None):
@@ -189,7 +260,7 @@ def check_for_job_hyperparameters(self, log_file=None):
                 "Provider should have been defined for the job to be submitted: {}"
                 .format(job))
             continue
-        instance = found_provider.get_instance(job.job_uid)
+        instance = self.get_job_instance(found_provider, job)
         if instance is not None:
             hyperparameters = instance.get_experiment_hyperparameters()
             if hyperparameters is not None:
@@ -201,9 +272,29 @@ def check_for_job_hyperparameters(self, log_file=None):
                 print("No hyperparameters for job {}".format(job.job_uid))
 
 
+def get_loop_stats(self):
+    return {
+        "ticks": self.tick_count,
+        "overruns": self.tick_overruns,
+        "last_duration": self.last_tick_duration,
+        "max_duration": self.max_tick_duration,
+        "reconciling_jobs":
+            len([x for x in self.job_locks.values() if x.locked()]),
+    }
+
+
 def daemon_loop(self):  #
     threading.Timer(monkey_global.DAEMON_THREAD_TIME, self.daemon_loop).start()
-    with self.lock:
+    # Renewed before the overrun check so a slow tick never loses leases
+    MonkeyJob.renew_leases(owner=self.owner_id)
+    if not self.lock.acquire(blocking=False):
+        self.tick_overruns += 1
+        self.metrics.inc("monkey_daemon_tick_overruns_total")
+        logger.warning(
+            "Skipping periodic check, the previous check is still running")
+        return
+    tick_start = time.time()
+    try:
         with open(monkey_global.STATUS_LOG_FILE, "w") as f:
             printout = colored(
                 "\n======================================================================\n",
@@ -212,6 +303,17 @@ def daemon_loop(self):  #
             if not monkey_global.QUIET_PERIODIC_PRINTOUT:
                 print(printout)
             f.write(printout)
+            self.probe_instances(f)
+            self.maintain_warm_pools(f)
+            self.prune_ansible_artifacts(f)
             self.check_for_queued_jobs(f)
             self.check_for_dead_jobs(f)
             self.check_for_job_hyperparameters(f)
+    finally:
+        self.tick_count += 1
+        self.last_tick_duration = time.time() - tick_start
+        self.metrics.observe("monkey_daemon_tick_seconds",
+                             value=self.last_tick_duration)
+        self.max_tick_duration = max(self.max_tick_duration,
+                                     self.last_tick_duration)
+        self.lock.release()
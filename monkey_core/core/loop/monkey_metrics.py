@@ -0,0 +1,178 @@
+import bisect
+import logging
+import threading
+
+from core.mongo.monkey_job import MonkeyJob
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds (seconds) of the job state and daemon tick histograms
+STATE_BUCKETS = (1, 5, 15, 30, 60, 120, 300, 600, 1800, 3600, 14400, 86400)
+TICK_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+class MonkeyMetrics():
+    """In memory counters, gauges and histograms, rendered in the
+    Prometheus text format
+
+    Every value is updated as events happen so a scrape only formats what is
+    already in memory
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # name -> (type, help)
+        self.descriptions = dict()
+        # name -> {labels: value}
+        self.values = dict()
+        # name -> buckets
+        self.buckets = dict()
+
+    def describe(self, name, metric_type, help_text, buckets=None):
+        with self.lock:
+            self.descriptions[name] = (metric_type, help_text)
+            self.values.setdefault(name, dict())
+            if buckets is not None:
+                self.buckets[name] = tuple(buckets)
+
+    def inc(self, name, labels=None, value=1):
+        key = self.get_label_key(labels)
+        with self.lock:
+            series = self.values.setdefault(name, dict())
+            series[key] = series.get(key, 0) + value
+
+    def set(self, name, labels=None, value=0):
+        key = self.get_label_key(labels)
+        with self.lock:
+            self.values.setdefault(name, dict())[key] = value
+
+    def observe(self, name, labels=None, value=0):
+        key = self.get_label_key(labels)
+        with self.lock:
+            buckets = self.buckets[name]
+            series = self.values.setdefault(name, dict())
+            if key not in series:
+                series[key] = {
+                    "buckets": [0] * len(buckets),
+                    "sum": 0,
+                    "count": 0
+                }
+            histogram = series[key]
+            index = bisect.bisect_left(buckets, value)
+            if index < len(buckets):
+                histogram["buckets"][index] += 1
+            histogram["sum"] += value
+            histogram["count"] += 1
+
+    @staticmethod
+    def get_label_key(labels):
+        return tuple(sorted((labels or dict()).items()))
+
+    @staticmethod
+    def format_labels(key, extra=()):
+        pairs = list(key) + list(extra)
+        if len(pairs) == 0:
+            return ""
+        escaped = [(k, str(v).replace("\\", "\\\\").replace('"', '\\"'))
+                   for k, v in pairs]
+        return "{" + ",".join(f'{k}="{v}"' for k, v in escaped) + "}"
+
+    def render(self):
+        lines = []
+        with self.lock:
+            for name, (metric_type, help_text) in self.descriptions.items():
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} {metric_type}")
+                for key, value in self.values[name].items():
+                    if metric_type != "histogram":
+                        labels = self.format_labels(key)
+                        lines.append(f"{name}{labels} {value}")
+                        continue
+                    cumulative = 0
+                    for bound, count in zip(self.buckets[name],
+                                            value["buckets"]):
+                        cumulative += count
+                        labels = self.format_labels(key, [("le", bound)])
+                        lines.append(f"{name}_bucket{labels} {cumulative}")
+                    labels = self.format_labels(key, [("le", "+Inf")])
+                    lines.append(f"{name}_bucket{labels} {value['count']}")
+                    labels = self.format_labels(key)
+                    lines.append(f"{name}_sum{labels} {value['sum']}")
+                    lines.append(f"{name}_count{labels} {value['count']}")
+        return "\n".join(lines) + "\n"
+
+
+def setup_metrics(self):
+    """Describes the core's metrics and loads the current job counts
+
+    Job counts are read from mongo once, then kept up to date from state
+    transitions
+    """
+    self.metrics = MonkeyMetrics()
+    self.metrics.describe(
+        "monkey_job_state_seconds", "histogram",
+        "Seconds jobs spent in a state before moving on, by provider",
+        buckets=STATE_BUCKETS)
+    self.metrics.describe("monkey_job_transitions_total", "counter",
+                          "Job state transitions, by provider")
+    self.metrics.describe("monkey_job_requeues_total", "counter",
+                          "Failed dispatches that were requeued or failed")
+    self.metrics.describe("monkey_jobs", "gauge",
+                          "Jobs in each state, by provider")
+    self.metrics.describe("monkey_daemon_tick_seconds", "histogram",
+                          "Duration of the periodic daemon loop check",
+                          buckets=TICK_BUCKETS)
+    self.metrics.describe("monkey_daemon_tick_overruns_total", "counter",
+                          "Periodic checks skipped while one was running")
+    self.metrics.describe("monkey_dispatch_workers", "gauge",
+                          "Jobs being dispatched, by provider")
+    try:
+        counts = MonkeyJob.objects.aggregate([{
+            "$group": {
+                "_id": {
+                    "provider": "$provider_name",
+                    "state": "$state"
+                },
+                "count": {
+                    "$sum": 1
+                }
+            }
+        }])
+        for count in counts:
+            self.metrics.set("monkey_jobs", count["_id"], count["count"])
+    except Exception as e:
+        logger.error(f"Failed to load job counts for metrics: {e}")
+
+
+def record_job_transition(self, job, previous_state, state, elapsed):
+    """Records a job leaving previous_state after elapsed seconds
+
+    Registered as a job state transition listener
+    """
+    provider = job.provider_name or ""
+    if previous_state is not None:
+        self.metrics.observe("monkey_job_state_seconds", {
+            "provider": provider,
+            "state": previous_state
+        }, elapsed)
+        self.metrics.inc("monkey_jobs", {
+            "provider": provider,
+            "state": previous_state
+        }, -1)
+    self.metrics.inc("monkey_jobs", {"provider": provider, "state": state})
+    self.metrics.inc("monkey_job_transitions_total", {
+        "provider": provider,
+        "from": previous_state or "",
+        "to": state
+    })
+
+
+def get_metrics(self):
+    # Dispatch slots are already in memory and cheap to count on a scrape
+    with self.dispatch_lock:
+        slots = list(self.dispatch_slots.values())
+    for provider in self.providers:
+        self.metrics.set("monkey_dispatch_workers",
+                         {"provider": provider.name},
+                         len([x for x in slots if x[0] == provider.name]))
+    return self.metrics.render()
@@ -0,0 +1,508 @@
+import logging
+import queue
+import random
+import threading
+from datetime import datetime, timedelta
+
+from core.mongo import mongo_global as monkey_state
+from core.mongo.monkey_job import MonkeyJob
+from mongoengine import Q
+
+logger = logging.getLogger(__name__)
+
+
+def get_provider(self, provider_name):
+    for p in self.providers:
+        if p.name == provider_name:
+            return p
+    return None
+
+
+def get_job_instance(self, provider, job):
+    """Finds the instance a job was dispatched to
+
+    Local jobs name their host in the job yml.  Cloud jobs run on the
+    instance recorded when their machine stage completed, which is named
+    after the job unless it was drawn from a warm pool.
+    """
+    if job.provider_type == "local":
+        return provider.get_instance(job.job_yml.get("instance", None))
+    return provider.get_instance(job.stage_instance or job.job_uid)
+
+
+def notify_scheduler(self, job_uid, state):
+    """Pushes a job event onto the dispatch queue
+
+    Called on job submission and on every job state change so that the
+    dispatcher thread can react immediately instead of waiting for the
+    periodic reconciliation in daemon_loop.
+
+    Args:
+        job_uid (str): The job that changed, None for capacity changes
+        state (MONKEY_STATE): The state the job changed to
+    """
+    self.dispatch_queue.put((job_uid, state))
+
+
+def dispatch_loop(self):
+    """Reads job events off the dispatch queue and dispatches queued jobs
+
+    Events that arrive together are handled by a single ordered pass over
+    the queued jobs, so a burst of submissions is dispatched by priority and
+    fair share rather than arrival order
+    """
+    while True:
+        events = [self.dispatch_queue.get()]
+        while True:
+            try:
+                events.append(self.dispatch_queue.get_nowait())
+            except queue.Empty:
+                break
+        if all(state != monkey_state.MONKEY_STATE_QUEUED
+               for _, state in events):
+            continue
+        try:
+            self.dispatch_queued_jobs()
+        except Exception as e:
+            logger.error(f"Failed to dispatch queued jobs\n{e}")
+
+
+def get_project_usage():
+    """Sums run_elapsed_time per project over the fair share window
+
+    Returns:
+        dict: project_name -> (total run time, number of runs)
+    """
+    window_start = datetime.now() - timedelta(
+        seconds=monkey_state.MONKEY_FAIR_SHARE_WINDOW)
+    usage = MonkeyJob.objects(creation_date__gte=window_start,
+                              run_elapsed_time__gt=0).aggregate([{
+                                  "$group": {
+                                      "_id": "$project_name",
+                                      "usage": {
+                                          "$sum": "$run_elapsed_time"
+                                      },
+                                      "runs": {
+                                          "$sum": 1
+                                      },
+                                  }
+                              }])
+    return {x["_id"]: (x["usage"], x["runs"]) for x in usage}
+
+
+def get_active_project_counts():
+    """Counts jobs past QUEUED per provider and project
+
+    Returns:
+        dict: (provider_name, project_name) -> number of active jobs
+    """
+    active = MonkeyJob.objects(
+        state__in=monkey_state.MONKEY_RECONCILE_STATES).aggregate([{
+            "$group": {
+                "_id": {
+                    "provider_name": "$provider_name",
+                    "project_name": "$project_name",
+                },
+                "count": {
+                    "$sum": 1
+                },
+            }
+        }])
+    return {(x["_id"].get("provider_name"), x["_id"].get("project_name")):
+            x["count"] for x in active}
+
+
+def order_queued_jobs(queued_jobs, project_usage, project_weights):
+    """Orders queued jobs by priority and then weighted fair share
+
+    Within a priority, each project's n-th queued job is given a virtual
+    usage of its historical usage plus n average run times, divided by the
+    project's weight.  Jobs are dispatched lowest virtual usage first, which
+    interleaves projects in proportion to their weight and favours projects
+    that have used less of the cluster recently.
+
+    Args:
+        queued_jobs ([MonkeyJob]): Jobs in the QUEUED state
+        project_usage (dict): project_name -> (total run time, number of runs)
+        project_weights (dict): project_name -> fair share weight
+
+    Returns:
+        [MonkeyJob]: The jobs in dispatch order
+    """
+    queued_jobs = sorted(queued_jobs, key=lambda x: x.creation_date)
+    project_positions = dict()
+    keys = dict()
+    for job in queued_jobs:
+        project = job.project_name or ""
+        usage, runs = project_usage.get(project, (0, 0))
+        run_time = usage / runs if runs > 0 else \
+            monkey_state.MONKEY_FAIR_SHARE_DEFAULT_RUN_TIME
+        weight = float(project_weights.get(project, 1))
+        position = project_positions.get(project, 0)
+        project_positions[project] = position + 1
+        virtual_usage = (usage + position * run_time) / max(weight, 0.01)
+        keys[job.job_uid] = (-(job.priority or 0), virtual_usage,
+                             job.creation_date)
+    return sorted(queued_jobs, key=lambda x: keys[x.job_uid])
+
+
+def dispatch_queued_jobs(self):
+    """Dispatches queued jobs in scheduling order until capacity is reached
+
+    Jobs whose project is at its quota on the provider, or that are backing
+    off after a failed dispatch, stay QUEUED
+
+    Returns:
+        [str]: The job_uids that were dispatched
+    """
+    queued_jobs = list(
+        MonkeyJob.objects(
+            Q(state=monkey_state.MONKEY_STATE_QUEUED) &
+            (Q(next_eligible_at=None) |
+             Q(next_eligible_at__lte=datetime.now()))))
+    self.queued_job_num = len(queued_jobs)
+    if len(queued_jobs) == 0:
+        return []
+
+    active_counts = get_active_project_counts()
+    ordered_jobs = order_queued_jobs(queued_jobs=queued_jobs,
+                                     project_usage=get_project_usage(),
+                                     project_weights=self.project_weights)
+    dispatched = []
+    for job in ordered_jobs:
+        if len(self.dispatch_slots) >= self.max_concurrent_dispatches:
+            break
+        found_provider = self.get_provider(job.provider_name)
+        if found_provider is None or \
+                not self.has_dispatch_capacity(found_provider):
+            continue
+        project_key = (job.provider_name, job.project_name)
+        quota = found_provider.project_quotas.get(job.project_name, None)
+        if quota is not None and active_counts.get(project_key, 0) >= quota:
+            continue
+        if self.dispatch_job(job):
+            active_counts[project_key] = active_counts.get(project_key, 0) + 1
+            dispatched.append(job.job_uid)
+    return dispatched
+
+
+def has_dispatch_capacity(self, provider):
+    if len(self.dispatch_slots) >= self.max_concurrent_dispatches:
+        return False
+    provider_slots = [
+        x for x in self.dispatch_slots.values() if x[0] == provider.name
+    ]
+    return len(provider_slots) < provider.max_concurrent_dispatches
+
+
+def claim_dispatch_slot(self, job):
+    """Moves a queued job to DISPATCHING and takes a dispatch slot for it
+
+    The job is claimed with an atomic lease in mongo, so the dispatcher
+    thread, the reconciliation pass, foreground submissions and other core
+    processes never start the same job twice.  Jobs stay QUEUED while their
+    provider or the core is at its dispatch capacity.
+
+    Args:
+        job (MonkeyJob): The job to claim
+
+    Returns:
+        MonkeyProvider: The job's provider, None if the job wasn't claimed
+    """
+    with self.dispatch_lock:
+        if job.state != monkey_state.MONKEY_STATE_QUEUED:
+            return None
+        found_provider = self.get_provider(job.provider_name)
+        if found_provider is None:
+            logger.error(
+                "Provider should have been defined for the job to be submitted: {}"
+                .format(job.job_uid))
+            return None
+        if not self.has_dispatch_capacity(found_provider):
+            return None
+        if found_provider.tracks_resources:
+            fits, msg = found_provider.check_resource_request(job.job_yml)
+            if not fits:
+                logger.error(f"Failing {job.job_uid}: {msg}")
+                job.set_state(monkey_state.MONKEY_STATE_FAILED,
+                              failure_reason=msg)
+                return None
+            self.sync_resource_allocations(found_provider)
+        # Jobs stay QUEUED until their host has the resources they request
+        allocation = found_provider.allocate_resources(job.job_uid,
+                                                       job.job_yml)
+        if allocation is None:
+            return None
+        wait_time = job.time_elapsed_in_state()
+        # Other core processes may be dispatching from the same queue
+        if not job.claim(owner=self.owner_id):
+            found_provider.release_resources(job.job_uid)
+            return None
+        self.record_allocation(job, allocation)
+        if found_provider.tracks_resources and \
+                not self.verify_resource_allocation(found_provider, job):
+            return None
+        self.dispatch_slots[job.job_uid] = (found_provider.name,
+                                            datetime.now())
+        self.dispatch_wait_times.append(wait_time)
+    return found_provider
+
+
+def dispatch_job(self, job):
+    """Claims a queued job and starts running it in the background
+
+    Args:
+        job (MonkeyJob): The job to dispatch
+
+    Returns:
+        bool: True if the job was dispatched
+    """
+    found_provider = self.claim_dispatch_slot(job)
+    if found_provider is None:
+        return False
+    threading.Thread(target=self.run_dispatch_worker,
+                     args=(found_provider, job.job_yml),
+                     daemon=True).start()
+    return True
+
+
+def verify_resource_allocation(self, provider, job):
+    """Checks no other core process reserved the same resources at once
+
+    Every process saves its allocation before reading the others, so of two
+    clashing dispatches at least one sees the other.  A clashing job is put
+    back in the queue after a short random delay
+
+    Returns:
+        bool: True if the job's allocation holds
+    """
+    self.sync_resource_allocations(provider)
+    hostname = (job.resource_allocation or dict()).get("instance", None)
+    if not provider.is_overcommitted(hostname):
+        return True
+    logger.info(f"{job.job_uid}: resources on {hostname} were taken by " +
+                "another core process, requeueing")
+    job.set_state(monkey_state.MONKEY_STATE_QUEUED,
+                  next_eligible_at=datetime.now() +
+                  timedelta(seconds=random.uniform(1, 5)))
+    return False
+
+
+def record_allocation(self, job, allocation):
+    """Saves a job's resources and, when placed automatically, its host
+
+    Placed jobs keep auto_placement in their job_yml so a requeued job is
+    placed again instead of waiting on a host that went away
+    """
+    if not allocation:
+        return
+    placement = allocation.pop("placement", None)
+    if placement is None:
+        job.update_fields(resource_allocation=allocation)
+        return
+    job.job_yml["instance"] = placement["instance"]
+    job.job_yml["auto_placement"] = True
+    job.update_fields(resource_allocation=allocation,
+                      job_yml=job.job_yml,
+                      placement=placement)
+
+
+def run_dispatch_worker(self, provider, job_yml):
+    """Runs a claimed job and frees its dispatch slot
+
+    Returns:
+        (bool, str): (Success, Message)
+    """
+    try:
+        return self.run_job(provider=provider, job_yml=job_yml)
+    except Exception as e:
+        logger.error(f"Failed to run job: {job_yml['job_uid']}\n{e}")
+        return False, f"Failed to run job: {e}"
+    finally:
+        self.release_dispatch_slot(job_yml["job_uid"])
+
+
+def release_dispatch_slot(self, job_uid):
+    """Frees the dispatch slot held by a job and wakes up the dispatcher
+
+    Safe to call more than once, only the first call frees the slot
+    """
+    with self.dispatch_lock:
+        slot = self.dispatch_slots.pop(job_uid, None)
+    if slot is not None:
+        self.notify_scheduler(None, monkey_state.MONKEY_STATE_QUEUED)
+
+
+def release_job_resources(self, job_uid, state):
+    """Frees a job's resources once it is requeued, finished or failed
+
+    Registered as a job state change listener
+    """
+    if state not in (monkey_state.MONKEY_STATE_QUEUED,
+                     monkey_state.MONKEY_STATE_FINISHED,
+                     monkey_state.MONKEY_STATE_FAILED):
+        return
+    released = False
+    for provider in self.providers:
+        released = provider.release_resources(job_uid) or released
+    if released:
+        self.notify_scheduler(None, monkey_state.MONKEY_STATE_QUEUED)
+
+
+def restore_resource_allocations(self):
+    """Reloads the allocations of active jobs after a restart"""
+    for provider in self.providers:
+        if provider.tracks_resources:
+            self.sync_resource_allocations(provider)
+
+
+def sync_resource_allocations(self, provider):
+    """Loads the allocations of every active job of a provider from mongo
+
+    Allocations are saved on the jobs, so every core process dispatching to
+    the same hosts counts the resources the others reserved
+    """
+    active_jobs = MonkeyJob.objects(
+        provider_name=provider.name,
+        state__in=monkey_state.MONKEY_RECONCILE_STATES,
+        resource_allocation__exists=True).only("job_uid",
+                                               "resource_allocation")
+    provider.sync_allocations({
+        x.job_uid: x.resource_allocation
+        for x in active_jobs
+        if x.resource_allocation
+    })
+
+
+def get_dispatch_stats(self):
+    with self.dispatch_lock:
+        slots = list(self.dispatch_slots.values())
+        wait_times = list(self.dispatch_wait_times)
+
+    providers = dict()
+    for provider in self.providers:
+        providers[provider.name] = {
+            "active_workers":
+                len([x for x in slots if x[0] == provider.name]),
+            "max_concurrent_dispatches":
+                provider.max_concurrent_dispatches,
+            "warm_pools":
+                provider.get_warm_pool_stats(),
+            "free_instances": [x[0].name for x in provider.free_instances],
+            "resources": provider.get_resource_usage(),
+        }
+    return {
+        "owner_id": self.owner_id,
+        "queued_jobs": self.queued_job_num,
+        "pending_events": self.dispatch_queue.qsize(),
+        "active_workers": len(slots),
+        "max_concurrent_dispatches": self.max_concurrent_dispatches,
+        "average_wait_time":
+            sum(wait_times) / len(wait_times) if wait_times else 0,
+        "max_wait_time": max(wait_times) if wait_times else 0,
+        "providers": providers,
+    }
+
+
+def get_retry_delay(attempts):
+    """Exponential backoff with jitter for the given number of failed attempts
+    """
+    delay = min(monkey_state.MONKEY_RETRY_BASE_DELAY * 2**(attempts - 1),
+                monkey_state.MONKEY_RETRY_MAX_DELAY)
+    return delay * random.uniform(0.5, 1.5)
+
+
+def requeue_job(self, job, reason):
+    """Requeues a job after a failed dispatch stage
+
+    The job is held back with exponential backoff and marked FAILED once it
+    has used up its provider's max_dispatch_attempts
+
+    Args:
+        job (MonkeyJob): The job that failed
+        reason (str): Why the dispatch failed
+
+    Returns:
+        bool: True if the job was requeued or failed, False if its state was
+            changed elsewhere first
+    """
+    found_provider = self.get_provider(job.provider_name)
+    max_attempts = found_provider.max_dispatch_attempts \
+        if found_provider is not None \
+        else monkey_state.MONKEY_MAX_DISPATCH_ATTEMPTS
+    attempts = (job.dispatch_attempts or 0) + 1
+    requeue_labels = {"provider": job.provider_name, "state": job.state}
+
+    if attempts >= max_attempts:
+        logger.error("Job: {} failed {} dispatch attempts, last: {}".format(
+            job.job_uid, attempts, reason))
+        if not job.set_state(monkey_state.MONKEY_STATE_FAILED,
+                             dispatch_attempts=attempts,
+                             failure_reason=reason):
+            return False
+        self.metrics.inc("monkey_job_requeues_total",
+                         dict(requeue_labels, outcome="failed"))
+        if found_provider is not None:
+            self.cleanup_failed_job(job, found_provider)
+        return True
+
+    delay = get_retry_delay(attempts)
+    logger.info("Job: {} failed dispatch attempt {}, retrying in {:.0f}s: {}".
+                format(job.job_uid, attempts, delay, reason))
+    if not job.set_state(monkey_state.MONKEY_STATE_QUEUED,
+                         dispatch_attempts=attempts,
+                         failure_reason=reason,
+                         next_eligible_at=datetime.now() +
+                         timedelta(seconds=delay)):
+        return False
+    self.metrics.inc("monkey_job_requeues_total",
+                     dict(requeue_labels, outcome="requeued"))
+    timer = threading.Timer(delay,
+                            self.notify_scheduler,
+                            args=(job.job_uid,
+                                  monkey_state.MONKEY_STATE_QUEUED))
+    timer.daemon = True
+    timer.start()
+    return True
+
+
+def release_job_instance(self, provider, job, instance):
+    """Cleans up after a finished job
+
+    Cloud instances of providers with instance_reuse are reset and put on
+    the provider's free list, the job is marked released so later checks
+    don't tear the instance down under the next job.  The release is
+    claimed on the job first, so a slow release isn't started again by the
+    reconciler.  A failed release drops the claim to be retried
+
+    Returns:
+        (bool, str): (Success, Message)
+    """
+    if not job.claim_stage(monkey_state.MONKEY_STAGE_RELEASING):
+        logger.info(f"{job.job_uid}: instance is already being released")
+        return True, "Instance is already being released"
+    success, msg = False, "Failed to release instance"
+    try:
+        if not provider.instance_reuse or job.provider_type == "local":
+            success, msg = provider.cleanup_instance(instance,
+                                                     job_yml=job.job_yml)
+        else:
+            success, msg = provider.release_instance(
+                instance=instance,
+                machine_params=provider.get_machine_params(job.job_yml),
+                job_yml=job.job_yml)
+        if success:
+            job.complete_stage(monkey_state.MONKEY_STAGE_RELEASED,
+                               instance.name)
+        return success, msg
+    finally:
+        if not success:
+            job.drop_stage(monkey_state.MONKEY_STAGE_RELEASING)
+
+
+def cleanup_failed_job(self, job, provider):
+    instance = self.get_job_instance(provider, job)
+    if instance is not None:
+        threading.Thread(target=provider.cleanup_instance,
+                         args=(instance, job.job_yml),
+                         daemon=True).start()
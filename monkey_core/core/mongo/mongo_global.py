@@ -6,12 +6,65 @@ MONKEY_STATE_DISPATCHING_SETUP = "DISPATCHING_SETUP"
 MONKEY_STATE_RUNNING = "RUNNING"
 MONKEY_STATE_CLEANUP = "CLEANING_UP"
 MONKEY_STATE_FINISHED = "FINISHED"
+MONKEY_STATE_FAILED = "FAILED"
+
+# Dispatch stages recorded on a job so a retry can resume on the same host
+MONKEY_STAGE_MACHINE = "machine"
+MONKEY_STAGE_INSTALL = "install/{}"
+MONKEY_STAGE_MOUNT = "mount"
+MONKEY_STAGE_SETUP = "setup"
+# Set once a finished job has handed its instance back for reuse
+MONKEY_STAGE_RELEASED = "released"
+# Claimed while a finished job's instance is being released, so it is only
+# released once
+MONKEY_STAGE_RELEASING = "releasing"
 
 MONKEY_TIMEOUT_DISPATCHING_MACHINE = 60 * 5  # 5 min to dispatch machine max
 MONKEY_TIMEOUT_DISPATCHING_INSTALLS = 60 * 10  # 10 min to dispatch installs max
 MONKEY_TIMEOUT_DISPATCHING_SETUP = 60 * 5  # 3 min to dispatch setup max
 MONKEY_TIMEOUT_CLEANUP = 30  # 30s to dispatch machine max
 
+# Failed dispatches are retried with exponential backoff and jitter until
+# the job runs out of attempts and is marked FAILED
+MONKEY_MAX_DISPATCH_ATTEMPTS = 5
+MONKEY_RETRY_BASE_DELAY = 30
+MONKEY_RETRY_MAX_DELAY = 60 * 30
+
+# Seconds a core process holds a job lease without renewing it
+MONKEY_LEASE_TIME = 90
+
+# Finished jobs are rechecked for leftover machines for this long
+MONKEY_FINISHED_RECHECK_TIME = 60 * 60
+
+# States where the lease owner has a dispatch or run thread on the job
+MONKEY_IN_FLIGHT_STATES = [
+    MONKEY_STATE_DISPATCHING,
+    MONKEY_STATE_DISPATCHING_MACHINE,
+    MONKEY_STATE_DISPATCHING_INSTALLS,
+    MONKEY_STATE_DISPATCHING_SETUP,
+    MONKEY_STATE_RUNNING,
+]
+
+# Window of finished runs counted as a project's usage for fair share
+MONKEY_FAIR_SHARE_WINDOW = 60 * 60 * 24 * 7
+# Assumed run time of a job for projects without any finished runs
+MONKEY_FAIR_SHARE_DEFAULT_RUN_TIME = 60 * 10
+
+# Seconds a warm pool instance may sit idle before it is evicted
+MONKEY_WARM_POOL_IDLE_TIME = 60 * 30
+# Seconds a reused instance may wait on the free list for another job
+MONKEY_REUSE_IDLE_TIME = 60 * 10
+
+# States that still need to be reconciled against their instances
+MONKEY_RECONCILE_STATES = [
+    MONKEY_STATE_DISPATCHING,
+    MONKEY_STATE_DISPATCHING_MACHINE,
+    MONKEY_STATE_DISPATCHING_INSTALLS,
+    MONKEY_STATE_DISPATCHING_SETUP,
+    MONKEY_STATE_RUNNING,
+    MONKEY_STATE_CLEANUP,
+]
+
 
 def human_readable_state(state):
     if state == MONKEY_STATE_QUEUED:
@@ -30,6 +83,8 @@ def human_readable_state(state):
         return "Cleaning Up"
     elif state == MONKEY_STATE_FINISHED:
         return "Finished"
+    elif state == MONKEY_STATE_FAILED:
+        return "Failed"
     else:
         return state
 
@@ -8,6 +8,42 @@ from . import mongo_global as monkey_state
 
 logger = logging.getLogger(__name__)
 
+# Listeners of each core process, keyed by its owner id, only called for the
+# jobs it leases.  Changes of jobs without a lease, like queued jobs, are sent
+# to every owner
+# owner -> [listener(job_uid, state)]
+state_change_listeners = dict()
+# owner -> [listener(job, previous_state, state, seconds_in_previous_state)]
+state_transition_listeners = dict()
+
+
+def add_state_listeners(owner, change_listeners=(), transition_listeners=()):
+    """ Calls listeners after state changes of the jobs owner leases
+    """
+    state_change_listeners.setdefault(owner, []).extend(change_listeners)
+    state_transition_listeners.setdefault(owner,
+                                          []).extend(transition_listeners)
+
+
+def remove_state_listeners(owner):
+    state_change_listeners.pop(owner, None)
+    state_transition_listeners.pop(owner, None)
+
+
+def get_owner_listeners(listeners, owner):
+    if owner is None:
+        return [x for y in list(listeners.values()) for x in y]
+    return list(listeners.get(owner, []))
+
+
+def notify_state_listeners(job, previous_state, state, elapsed):
+    for listener in get_owner_listeners(state_transition_listeners,
+                                        job.lease_owner):
+        listener(job, previous_state, state, elapsed)
+    for listener in get_owner_listeners(state_change_listeners,
+                                        job.lease_owner):
+        listener(job.job_uid, state)
+
 
 class MonkeyJob(DynamicDocument):
     job_uid = StringField(required=True, unique=True)
@@ -18,9 +54,33 @@ class MonkeyJob(DynamicDocument):
     provider_name = StringField(required=True)
     provider_vars = DictField(required=True, default=dict)
 
+    # Scheduling, higher priority jobs are dispatched first and jobs of the
+    # same priority are shared fairly between projects
+    priority = IntField(required=True, default=0)
+    project_name = StringField(required=False, default="")
+
     # Job state
     current_ip_address = StringField(required=False)
 
+    # Failed dispatch attempts and when the job may be dispatched again
+    dispatch_attempts = IntField(required=True, default=0)
+    next_eligible_at = DateTimeField(required=False)
+    failure_reason = StringField(required=False)
+
+    # Dispatch stages already done on stage_instance
+    completed_stages = ListField(StringField(), required=False, default=list)
+    stage_instance = StringField(required=False)
+
+    # Host resources reserved for the job, as instance, cpus, memory and gpus
+    resource_allocation = DictField(required=False)
+
+    # How the host of a job that didn't name one was chosen
+    placement = DictField(required=False)
+
+    # The core process working on the job and when its claim runs out
+    lease_owner = StringField(required=False)
+    lease_expiry = DateTimeField(required=False)
+
     # Dates to store certain timing statistics
     creation_date = DateTimeField(required=True, default=datetime.now)
     last_state_change = DateTimeField(required=True, default=datetime.now)
@@ -36,6 +96,10 @@ class MonkeyJob(DynamicDocument):
     run_timeout_time = IntField(required=True, default=-1)
     run_elapsed_time = IntField(required=True, default=0)
     total_wall_time = IntField(required=True, default=0)
+    # Seconds spent in each setup_job step
+    setup_timings = DictField(required=False, default=dict)
+    # Seconds spent in each ansible role during installs and setup
+    task_timings = DictField(required=False, default=dict)
 
     # Experiment config, hyperparameters
     experiment_hyperparameters = DictField(required=False, default=dict)
@@ -44,41 +108,215 @@ class MonkeyJob(DynamicDocument):
         'indexes': [
             'job_uid',  # text index for uid
             '$state',  # text index for state
+            # Reconciliation, by state and finished jobs by completion_date
+            ('state', 'completion_date'),
+            ('state', 'provider_name', 'project_name'),
+            ('lease_owner', 'state'),
+            ('state', 'next_eligible_at'),
         ]
     }
 
     def get_dict(self):
         return json.loads(self.to_json())
 
-    def set_state(self, state):
+    def set_state(self, state, expected_state=None, **extra_fields):
         """ Sets the state and updates needed timestamps
 
+        The change is a single conditional update that only applies if the
+        job is still in expected_state, so a stale copy of the job can't
+        overwrite a transition made by another thread or process
+
         Args:
             state (MONKEY_STATE): The state to update to
+            expected_state (MONKEY_STATE, optional): The state the job must
+                be in. Defaults to the state loaded on this object.
+            **extra_fields: Other fields to set in the same update
+
+        Returns:
+            bool: True if the transition was applied
         """
+        if expected_state is None:
+            expected_state = self.state
         logger.info("Setting job: {} state to: {}, from: {}".format(
-            self.job_uid, state, self.state))
+            self.job_uid, state, expected_state))
 
-        if (self.state == monkey_state.MONKEY_STATE_RUNNING) and (
-                state != monkey_state.MONKEY_STATE_RUNNING):
-            self.run_elapsed_time += self.time_elapsed_in_state()
-
-        self.state = state
+        fields = {"state": state}
         if state == monkey_state.MONKEY_STATE_DISPATCHING_MACHINE:
-            self.run_dispatch_machine_start_date = datetime.now()
+            fields["run_dispatch_machine_start_date"] = datetime.now()
         elif state == monkey_state.MONKEY_STATE_DISPATCHING_INSTALLS:
-            self.run_dispatch_installs_start_date = datetime.now()
+            fields["run_dispatch_installs_start_date"] = datetime.now()
         elif state == monkey_state.MONKEY_STATE_DISPATCHING_SETUP:
-            self.run_dispatch_setup_start_date = datetime.now()
+            fields["run_dispatch_setup_start_date"] = datetime.now()
         elif state == monkey_state.MONKEY_STATE_RUNNING:
-            self.run_running_start_date = datetime.now()
+            fields["run_running_start_date"] = datetime.now()
         elif state == monkey_state.MONKEY_STATE_CLEANUP:
-            self.run_cleanup_start_date = datetime.now()
+            fields["run_cleanup_start_date"] = datetime.now()
         elif state == monkey_state.MONKEY_STATE_FINISHED:
-            self.completion_date = datetime.now()
-            self.total_wall_time = (datetime.now() - self.creation_date).total_seconds()
-        self.last_state_change = datetime.now()
-        self.save()
+            fields["completion_date"] = datetime.now()
+            fields["total_wall_time"] = (datetime.now() -
+                                         self.creation_date).total_seconds()
+        fields["last_state_change"] = datetime.now()
+        fields.update(extra_fields)
+
+        elapsed = self.time_elapsed_in_state()
+        update = {"set__" + key: value for key, value in fields.items()}
+        if (expected_state == monkey_state.MONKEY_STATE_RUNNING) and (
+                state != monkey_state.MONKEY_STATE_RUNNING):
+            update["inc__run_elapsed_time"] = int(elapsed)
+
+        updated = MonkeyJob.objects(pk=self.pk, state=expected_state).modify(
+            new=True, **update)
+        if updated is None:
+            logger.warning(
+                "Job: {} is no longer in state: {}, not setting: {}".format(
+                    self.job_uid, expected_state, state))
+            self.reload("state", "last_state_change")
+            return False
+
+        for key in fields.keys():
+            setattr(self, key, getattr(updated, key))
+        self.run_elapsed_time = updated.run_elapsed_time
+        self.lease_owner = updated.lease_owner
+        self._clear_changed_fields()
+
+        notify_state_listeners(self, expected_state, state, elapsed)
+        return True
+
+    def claim(self, owner, state=monkey_state.MONKEY_STATE_DISPATCHING):
+        """ Atomically moves a queued job to state and takes its lease
+
+        Args:
+            owner (str): The id of the claiming core process
+            state (MONKEY_STATE): The state to move the job to
+
+        Returns:
+            bool: True if this call claimed the job
+        """
+        now = datetime.now()
+        claimed = MonkeyJob.objects(
+            pk=self.pk, state=monkey_state.MONKEY_STATE_QUEUED).modify(
+                new=True,
+                set__state=state,
+                set__lease_owner=owner,
+                set__lease_expiry=now +
+                timedelta(seconds=monkey_state.MONKEY_LEASE_TIME),
+                set__last_state_change=now)
+        if claimed is None:
+            return False
+        elapsed = self.time_elapsed_in_state()
+        logger.info("Claimed job: {} for: {}, state: {}".format(
+            self.job_uid, owner, state))
+        self.state = claimed.state
+        self.lease_owner = claimed.lease_owner
+        self.lease_expiry = claimed.lease_expiry
+        self.last_state_change = claimed.last_state_change
+        self._clear_changed_fields()
+
+        notify_state_listeners(self, monkey_state.MONKEY_STATE_QUEUED, state,
+                               elapsed)
+        return True
+
+    def take_over_lease(self, owner):
+        """ Atomically takes the lease of a job that isn't held by anyone else
+
+        Succeeds when the job has no owner, is already owned by owner, or its
+        owner stopped renewing the lease
+
+        Args:
+            owner (str): The id of the claiming core process
+
+        Returns:
+            bool: True if owner now holds the lease
+        """
+        now = datetime.now()
+        claimed = MonkeyJob.objects(
+            Q(pk=self.pk) &
+            (Q(lease_owner=None) | Q(lease_owner=owner) |
+             Q(lease_expiry__lt=now))).modify(
+                 new=True,
+                 set__lease_owner=owner,
+                 set__lease_expiry=now +
+                 timedelta(seconds=monkey_state.MONKEY_LEASE_TIME))
+        if claimed is None:
+            return False
+        self.lease_owner = claimed.lease_owner
+        self.lease_expiry = claimed.lease_expiry
+        self._clear_changed_fields()
+        return True
+
+    @staticmethod
+    def renew_leases(owner):
+        """ Extends the leases of all unfinished jobs held by owner
+        """
+        return MonkeyJob.objects(
+            lease_owner=owner,
+            state__nin=[
+                monkey_state.MONKEY_STATE_FINISHED,
+                monkey_state.MONKEY_STATE_FAILED
+            ]).update(
+                set__lease_expiry=datetime.now() +
+                timedelta(seconds=monkey_state.MONKEY_LEASE_TIME))
+
+    def complete_stage(self, stage, instance_name):
+        """ Records a finished dispatch stage and the instance it ran on
+
+        Args:
+            stage (MONKEY_STAGE): The stage that finished
+            instance_name (str): The instance the stage ran on
+        """
+        MonkeyJob.objects(pk=self.pk).update_one(
+            add_to_set__completed_stages=stage,
+            set__stage_instance=instance_name)
+        if stage not in self.completed_stages:
+            self.completed_stages.append(stage)
+        self.stage_instance = instance_name
+        self._clear_changed_fields()
+
+    def claim_stage(self, stage):
+        """ Atomically records a stage unless it is already recorded
+
+        Args:
+            stage (MONKEY_STAGE): The stage to claim
+
+        Returns:
+            bool: True if this call recorded the stage
+        """
+        claimed = MonkeyJob.objects(
+            pk=self.pk, completed_stages__ne=stage).update_one(
+                push__completed_stages=stage)
+        if claimed == 0:
+            self.reload("completed_stages")
+            return False
+        if stage not in self.completed_stages:
+            self.completed_stages.append(stage)
+        self._clear_changed_fields()
+        return True
+
+    def drop_stage(self, stage):
+        """ Removes a recorded stage so it can be claimed again
+        """
+        MonkeyJob.objects(pk=self.pk).update_one(pull__completed_stages=stage)
+        if stage in self.completed_stages:
+            self.completed_stages.remove(stage)
+        self._clear_changed_fields()
+
+    def is_stage_complete(self, stage):
+        return stage in (self.completed_stages or [])
+
+    def reset_stages(self):
+        self.update_fields(completed_stages=[], stage_instance=None)
+
+    def update_fields(self, **fields):
+        """ Writes only the given fields with a targeted $set
+
+        Args:
+            **fields: Field names and the values to set on the job
+        """
+        for key, value in fields.items():
+            setattr(self, key, value)
+        MonkeyJob.objects(pk=self.pk).update_one(
+            **{"set__" + key: value for key, value in fields.items()})
+        self._clear_changed_fields()
 
     def time_elapsed_in_state(self):
         return (datetime.now() - self.last_state_change).total_seconds()
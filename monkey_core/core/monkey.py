@@ -1,12 +1,20 @@
 import logging
+import os
+import queue
+import socket
 import threading
-from datetime import datetime
+import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
 
 import yaml
 from termcolor import colored
 
 import core.mongo.mongo_global as mongo_state
+from core.instance.monkey_ansible import JobEventLog
 from core.mongo.mongo_utils import get_monkey_db
+from core.mongo import monkey_job
 from core.mongo.monkey_job import MonkeyJob
 from core.provider.monkey_provider import MonkeyProvider
 
@@ -24,26 +32,85 @@ else:
 
 class Monkey():
 
-    lock = threading.Lock()
     providers = []
+    # Global cap on jobs in a dispatch stage, set in providers.yml
+    max_concurrent_dispatches = 32
+    # Fair share weight of each project, set in providers.yml
+    project_weights = dict()
 
     from core.info.monkey_list import (get_job_config, get_job_info,
-                                       get_job_uid, get_list_instances,
-                                       get_list_jobs, get_list_local_instances,
+                                       get_job_setup_log, get_job_uid,
+                                       get_list_instances, get_list_jobs,
+                                       get_list_local_instances,
                                        get_list_providers)
     from core.loop.monkey_loop import (check_for_dead_jobs,
                                        check_for_job_hyperparameters,
                                        check_for_queued_jobs, daemon_loop,
-                                       print_jobs_string)
+                                       get_job_lock, get_loop_stats,
+                                       print_jobs_string, prune_job_locks,
+                                       reconcile_job, run_with_job_lock)
+    from core.loop.monkey_health import (maintain_warm_pools,
+                                         probe_instances,
+                                         prune_ansible_artifacts)
+    from core.loop.monkey_metrics import (get_metrics, record_job_transition,
+                                          setup_metrics)
+    from core.loop.monkey_scheduler import (claim_dispatch_slot,
+                                            cleanup_failed_job, dispatch_job,
+                                            dispatch_loop,
+                                            dispatch_queued_jobs,
+                                            get_dispatch_stats,
+                                            get_job_instance, get_provider,
+                                            has_dispatch_capacity,
+                                            notify_scheduler,
+                                            record_allocation,
+                                            release_dispatch_slot,
+                                            release_job_instance,
+                                            release_job_resources,
+                                            requeue_job,
+                                            restore_resource_allocations,
+                                            run_dispatch_worker,
+                                            sync_resource_allocations,
+                                            verify_resource_allocation)
 
     def __init__(self, providers_path="providers.yml", start_loop=True):
         super().__init__()
         logger.info("Monkey Initializing")
         self.providers = []
+        # Identifies this process when leasing jobs from other core processes
+        self.owner_id = "{}-{}-{}".format(socket.gethostname(), os.getpid(),
+                                          uuid.uuid4().hex[:6])
+        self.lock = threading.Lock()
+        self.dispatch_lock = threading.Lock()
+        self.dispatch_queue = queue.Queue()
+        self.dispatch_slots = dict()
+        self.dispatch_wait_times = deque(maxlen=100)
+        self.queued_job_num = 0
+        self.job_locks = dict()
+        self.job_locks_lock = threading.Lock()
+        self.reconcile_executor = ThreadPoolExecutor(max_workers=16)
+        self.tick_count = 0
+        self.tick_overruns = 0
+        self.last_tick_duration = 0
+        self.max_tick_duration = 0
         self.instantiate_providers(providers_path=providers_path)
+        self.restore_resource_allocations()
+        self.setup_metrics()
+        change_listeners = [self.release_job_resources]
         if start_loop:
+            change_listeners.append(self.notify_scheduler)
+        monkey_job.add_state_listeners(
+            self.owner_id,
+            change_listeners=change_listeners,
+            transition_listeners=[self.record_job_transition])
+        if start_loop:
+            threading.Thread(target=self.dispatch_loop, daemon=True).start()
             threading.Thread(target=self.daemon_loop, daemon=True).start()
 
+    def close(self):
+        """ Stops receiving job state changes
+        """
+        monkey_job.remove_state_listeners(self.owner_id)
+
     def instantiate_providers(self, providers_path: str = "providers.yml"):
         providers = dict()
         try:
@@ -51,6 +118,11 @@ class Monkey():
                 providers_yaml = yaml.load(providers_file,
                                            Loader=yaml.FullLoader)
                 providers = providers_yaml["providers"]
+                self.max_concurrent_dispatches = int(
+                    providers_yaml.get("max_concurrent_dispatches",
+                                       self.max_concurrent_dispatches))
+                self.project_weights = providers_yaml.get(
+                    "project_weights", dict())
         except:
             logger.error(
                 "Could not read providers.yml for configured providers")
@@ -105,17 +177,60 @@ class Monkey():
                         job_random_suffix=job_random_suffix,
                         job_yml=job_yml,
                         state=mongo_state.MONKEY_STATE_QUEUED,
+                        priority=int(job_yml.get("priority", 0)),
+                        project_name=job_yml.get("project_name", ""),
                         provider_name=provider_name,
                         provider_type=found_provider.provider_type,
-                        provider_vars=found_provider.get_dict())
+                        provider_vars=found_provider.get_dict(),
+                        lease_owner=self.owner_id,
+                        lease_expiry=datetime.now() + timedelta(
+                            seconds=mongo_state.MONKEY_LEASE_TIME))
         job.save()
+        self.record_job_transition(job, None, job.state, 0)
+
+        fits, msg = found_provider.check_resource_request(job_yml)
+        if not fits:
+            job.set_state(mongo_state.MONKEY_STATE_FAILED, failure_reason=msg)
+            return False, msg
 
         if foreground:
-            job.set_state(state=mongo_state.MONKEY_STATE_DISPATCHING)
-            return self.run_job(provider=found_provider, job_yml=job_yml)
+            # Foreground jobs take a dispatch slot like any other, and wait
+            # for the dispatcher when the caps or their host are full
+            if self.claim_dispatch_slot(job) is None:
+                if job.state != mongo_state.MONKEY_STATE_QUEUED:
+                    # The dispatcher already picked up the job
+                    return True, "Running in background"
+                self.notify_scheduler(job.job_uid, job.state)
+                return True, "Queued until a dispatch slot and " + \
+                    "resources are available"
+            return self.run_dispatch_worker(provider=found_provider,
+                                            job_yml=job.job_yml)
         else:
+            self.notify_scheduler(job.job_uid, job.state)
             return True, "Running in background"
 
+    def get_resumable_instance(self, provider: MonkeyProvider, job):
+        """ Finds the live instance a retried job already has stages done on
+
+        Args:
+            provider (MonkeyProvider): The provider the job runs on
+            job (MonkeyJob): The job being dispatched
+
+        Returns:
+            MonkeyInstance: The instance to resume on, None to start over
+        """
+        if job.stage_instance is None or not job.is_stage_complete(
+                mongo_state.MONKEY_STAGE_MACHINE):
+            return None
+        # Placement may have moved a requeued local job to another host
+        if job.provider_type == "local" and \
+                job.stage_instance != job.job_yml.get("instance", None):
+            return None
+        instance = provider.get_instance(job.stage_instance)
+        if instance is None or not instance.check_online():
+            return None
+        return instance
+
     def run_job(self, provider: MonkeyProvider, job_yml):
         """ Runs a job in the monkey core system
 
@@ -130,61 +245,108 @@ class Monkey():
         dbMonkeyJob = MonkeyJob.objects(job_uid=job_uid).get()
         logger.info(dbMonkeyJob.get_dict())
         logger.info(f"Dispatching: {job_uid}")
-        machine_params = dict()
-        for provider_yml in job_yml["providers"]:
-            if provider_yml.get("name", "") == provider.name:
-                for key, val in provider_yml.items():
-                    machine_params[key] = val
-                break
-        machine_params["monkey_job_uid"] = job_uid
-
-        dbMonkeyJob.set_state(
-            state=mongo_state.MONKEY_STATE_DISPATCHING_MACHINE)
-        created_host, creation_success = provider.create_instance(
-            machine_params=machine_params,
-            job_yml=job_yml,
-        )
-        logger.info(f"Created Host: {created_host}")
-        if creation_success is False:
-            print("Failed to create and virtualize instance properly")
-            dbMonkeyJob.set_state(state=mongo_state.MONKEY_STATE_QUEUED)
-            return False, "Failed to create and virtualize instance properly"
-        logger.info(f"{job_uid}: Successfully dispatched machine")
-
-        dbMonkeyJob.set_state(
-            state=mongo_state.MONKEY_STATE_DISPATCHING_INSTALLS)
-        # Run install scripts
-        for install_item in job_yml.get("install", []):
-            print("Installing item: ", install_item)
-            success = created_host.install_dependency(install_item)
-            if success is False:
-                print("Failed to install dependency " + install_item)
-                dbMonkeyJob.set_state(state=mongo_state.MONKEY_STATE_QUEUED)
-                return False, "Failed to install dependency " + install_item
-
-        logger.info(f"{job_uid}: Successfully configured machine installs")
-
-        dbMonkeyJob.set_state(state=mongo_state.MONKEY_STATE_DISPATCHING_SETUP)
-        success, msg = created_host.mount_monkeyfs(
-            job_yml=job_yml,
-            provider_info=provider.get_dict(),
-        )
-        if success is False:
-            print("Failed to setup host:", msg)
-            dbMonkeyJob.set_state(state=mongo_state.MONKEY_STATE_QUEUED)
-            return success, msg
-        success, msg = created_host.setup_job(
-            job_yml=job_yml,
-            provider_info=provider.get_dict(),
-        )
-        if success is False:
-            print("Failed to setup host:", msg)
-            dbMonkeyJob.set_state(state=mongo_state.MONKEY_STATE_QUEUED)
-            return success, msg
-        logger.info(
-            f"{job_uid}: Successfully configured host environment: {msg}")
+        machine_params = provider.get_machine_params(job_yml)
+
+        created_host = self.get_resumable_instance(provider=provider,
+                                                   job=dbMonkeyJob)
+        if created_host is not None:
+            logger.info(f"{job_uid}: Resuming on {created_host.name} after " +
+                        f"stages: {dbMonkeyJob.completed_stages}")
+        else:
+            dbMonkeyJob.reset_stages()
+            if not dbMonkeyJob.set_state(
+                    state=mongo_state.MONKEY_STATE_DISPATCHING_MACHINE):
+                return False, "Job state was changed elsewhere to: " + \
+                    dbMonkeyJob.state
+            created_host, creation_success = provider.request_instance(
+                machine_params=machine_params,
+                job_yml=job_yml,
+            )
+            logger.info(f"Created Host: {created_host}")
+            if creation_success is False:
+                print("Failed to create and virtualize instance properly")
+                self.requeue_job(
+                    dbMonkeyJob,
+                    reason="Failed to create and virtualize instance properly")
+                return False, "Failed to create and virtualize instance properly"
+            dbMonkeyJob.complete_stage(mongo_state.MONKEY_STAGE_MACHINE,
+                                       created_host.name)
+            logger.info(f"{job_uid}: Successfully dispatched machine")
+
+        # Streams install and setup progress to the job's setup log
+        event_log = JobEventLog(path=provider.get_job_setup_log_path(job_uid))
+        with created_host.job_event_log(event_log):
+            if not dbMonkeyJob.set_state(
+                    state=mongo_state.MONKEY_STATE_DISPATCHING_INSTALLS):
+                return False, "Job state was changed elsewhere to: " + \
+                    dbMonkeyJob.state
+            # Run install scripts, force_install reruns installs the host has
+            force_install = job_yml.get("force_install", False)
+            for install_item in job_yml.get("install", []):
+                install_stage = mongo_state.MONKEY_STAGE_INSTALL.format(
+                    install_item)
+                if dbMonkeyJob.is_stage_complete(install_stage):
+                    continue
+                print("Installing item: ", install_item)
+                success = created_host.install_dependency(
+                    install_item,
+                    force=force_install is True
+                    or install_item in (force_install or []))
+                if success is False:
+                    msg = "Failed to install dependency " + install_item
+                    print(msg)
+                    self.requeue_job(dbMonkeyJob, reason=msg)
+                    return False, msg
+                dbMonkeyJob.complete_stage(install_stage, created_host.name)
+
+            logger.info(f"{job_uid}: Successfully configured machine installs")
+
+            if not dbMonkeyJob.set_state(
+                    state=mongo_state.MONKEY_STATE_DISPATCHING_SETUP):
+                return False, "Job state was changed elsewhere to: " + \
+                    dbMonkeyJob.state
+            if not dbMonkeyJob.is_stage_complete(
+                    mongo_state.MONKEY_STAGE_MOUNT):
+                if not created_host.monkeyfs_mounted:
+                    success, msg = created_host.mount_monkeyfs(
+                        job_yml=job_yml,
+                        provider_info=provider.get_dict(),
+                    )
+                    if success is False:
+                        print("Failed to setup host:", msg)
+                        self.requeue_job(dbMonkeyJob, reason=msg)
+                        return success, msg
+                    created_host.monkeyfs_mounted = True
+                dbMonkeyJob.complete_stage(mongo_state.MONKEY_STAGE_MOUNT,
+                                           created_host.name)
+            msg = "Job setup already completed"
+            if not dbMonkeyJob.is_stage_complete(
+                    mongo_state.MONKEY_STAGE_SETUP):
+                success, msg = created_host.setup_job(
+                    job_yml=job_yml,
+                    provider_info=provider.get_dict(),
+                )
+                dbMonkeyJob.update_fields(
+                    setup_timings=created_host.setup_timings.pop(
+                        job_uid, dict()),
+                    task_timings=event_log.role_timings)
+                if success is False:
+                    print("Failed to setup host:", msg)
+                    self.requeue_job(dbMonkeyJob, reason=msg)
+                    return success, msg
+                dbMonkeyJob.complete_stage(mongo_state.MONKEY_STAGE_SETUP,
+                                           created_host.name)
+            logger.info(
+                f"{job_uid}: Successfully configured host environment: {msg}")
 
-        dbMonkeyJob.set_state(state=mongo_state.MONKEY_STATE_RUNNING)
+        # Dispatch is done, free the slot for the next queued job
+        self.release_dispatch_slot(job_uid)
+        if not dbMonkeyJob.set_state(
+                state=mongo_state.MONKEY_STATE_RUNNING):
+            return False, "Job state was changed elsewhere to: " + \
+                dbMonkeyJob.state
+        if dbMonkeyJob.resource_allocation:
+            job_yml["resource_allocation"] = dbMonkeyJob.resource_allocation
         success, msg = created_host.run_job(
             job_yml=job_yml,
             provider_info=provider.get_dict(),
@@ -192,15 +354,17 @@ class Monkey():
         print("Returning from run job")
         if success is False:
             print("Failed to run job:", msg)
-            dbMonkeyJob.set_state(state=mongo_state.MONKEY_STATE_QUEUED)
+            self.requeue_job(dbMonkeyJob, reason=msg)
             return success, msg
-        dbMonkeyJob.total_wall_time = (
-            datetime.now() - dbMonkeyJob.creation_date).total_seconds()
-        dbMonkeyJob.set_state(state=mongo_state.MONKEY_STATE_CLEANUP)
-        success, msg = created_host.cleanup_job(
-            job_yml=job_yml,
-            provider_info=provider.get_dict(),
-        )
+        dbMonkeyJob.update_fields(total_wall_time=(
+            datetime.now() - dbMonkeyJob.creation_date).total_seconds())
+        if not dbMonkeyJob.set_state(
+                state=mongo_state.MONKEY_STATE_CLEANUP):
+            return False, "Job state was changed elsewhere to: " + \
+                dbMonkeyJob.state
+        success, msg = self.release_job_instance(provider=provider,
+                                                 job=dbMonkeyJob,
+                                                 instance=created_host)
         if success is False:
             print("Job ran correctly, but cleanup failed:", msg)
             return success, msg
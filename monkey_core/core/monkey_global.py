@@ -8,7 +8,8 @@ QUIET_PERIODIC_PRINTOUT = False
 LOG_FILE = "monkey.log"
 STATUS_LOG_FILE = "monkey.status"
 ANSIBLE_LOG_FILE = "monkey_ansible.log"
-DAEMON_THREAD_TIME = 10
+# Queued jobs are dispatched by events, the daemon loop only reconciles
+DAEMON_THREAD_TIME = 30
 
 file_path = os.path.dirname(os.path.abspath(__file__))
 relative_monkeyfs_path = os.path.join(file_path, "../", "ansible/monkeyfs")
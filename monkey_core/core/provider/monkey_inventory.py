@@ -0,0 +1,179 @@
+import logging
+import threading
+import time
+from concurrent.futures import Future
+
+from ansible.inventory.manager import InventoryManager
+from ansible.parsing.dataloader import DataLoader
+
+logger = logging.getLogger(__name__)
+
+# Seconds a fetched inventory is served without refreshing
+INVENTORY_TTL = 10
+# Seconds past the ttl a stale inventory is still served while it refreshes
+# in the background
+INVENTORY_STALE_TIME = 120
+
+
+class InventoryCache():
+    """The instances of one provider's group in the dynamic inventory
+
+    Every fetch lists the machines of the cloud provider, so one cache is
+    shared by all callers of the provider:
+
+    - A fetch younger than ttl is served as is
+    - A stale fetch is served while a background refresh runs
+    - Callers without a usable fetch wait for the same single refresh
+    - invalidate() makes the next call wait for a fetch that started after
+      it, used after instances are created or deleted
+
+    Instances that are still in the inventory are kept across refreshes so
+    their health checks carry over.
+    """
+
+    def __init__(self,
+                 group,
+                 create_instance,
+                 ttl=INVENTORY_TTL,
+                 stale_time=INVENTORY_STALE_TIME,
+                 keep_missing=False):
+        """
+        Args:
+            group (str): The inventory group of the provider's hosts
+            create_instance (function): Builds a MonkeyInstance from the
+                host vars of a host
+            keep_missing (bool): Keep instances that left the inventory, with
+                their state set to offline
+        """
+        self.group = group
+        self.create_instance = create_instance
+        self.ttl = ttl
+        self.stale_time = stale_time
+        self.keep_missing = keep_missing
+        self.lock = threading.Lock()
+        # name -> MonkeyInstance, replaced as a whole on every refresh
+        self.instances = dict()
+        self.fetch_time = None
+        # Bumped by invalidate(), a fetch only counts as fresh if it started
+        # after the last invalidation
+        self.generation = 0
+        self.fetched_generation = -1
+        self.refresh_future = None
+        # name -> time of instances just created, kept even if the next
+        # listings of the inventory miss them
+        self.added_times = dict()
+
+    def fetch(self):
+        loader = DataLoader()
+        inventory = InventoryManager(loader=loader,
+                                     sources="ansible/inventory")
+        host_vars = dict()
+        for host in inventory.get_groups_dict().get(self.group, []):
+            host_vars[host] = inventory.get_host(host).get_vars()
+        return host_vars
+
+    def refresh(self, generation, future):
+        success = False
+        try:
+            host_vars = self.fetch()
+            detected = dict()
+            for host, variables in host_vars.items():
+                instance = self.create_instance(variables)
+                detected[instance.name] = instance
+            with self.lock:
+                instances = dict()
+                for name, instance in detected.items():
+                    existing = self.instances.get(name, None)
+                    if existing is not None:
+                        existing.update_instance_details(instance)
+                        instance = existing
+                    instances[name] = instance
+                now = time.time()
+                self.added_times = {
+                    k: v
+                    for k, v in self.added_times.items()
+                    if now - v < self.ttl + self.stale_time
+                }
+                for name, instance in self.instances.items():
+                    if name in instances:
+                        continue
+                    elif name in self.added_times:
+                        # Just created, the listing may lag behind
+                        instances[name] = instance
+                    elif self.keep_missing:
+                        instance.state = "offline"
+                        instances[name] = instance
+                self.instances = instances
+                self.fetch_time = time.time()
+                self.fetched_generation = generation
+            success = True
+        except Exception as e:
+            logger.error(f"Failed to refresh {self.group} inventory: {e}")
+        finally:
+            # Cleared first so woken callers can start the next refresh
+            with self.lock:
+                if self.refresh_future is future:
+                    self.refresh_future = None
+            future.set_result(success)
+
+    def start_refresh(self):
+        """Starts a refresh unless one is running
+
+        Returns:
+            Future: Resolves once the running refresh finishes
+        """
+        with self.lock:
+            if self.refresh_future is not None:
+                return self.refresh_future
+            future = Future()
+            self.refresh_future = future
+            generation = self.generation
+        threading.Thread(target=self.refresh,
+                         args=(generation, future),
+                         daemon=True).start()
+        return future
+
+    def get_instances(self):
+        """
+        Returns:
+            dict: Instance name -> MonkeyInstance
+        """
+        # A refresh that was already running when the cache was invalidated
+        # doesn't count, so wait for at most one more
+        for _ in range(2):
+            with self.lock:
+                age = None if self.fetch_time is None \
+                    else time.time() - self.fetch_time
+                valid = self.fetched_generation == self.generation
+                if valid and age is not None and age < self.ttl:
+                    return self.instances
+                servable = valid and age is not None and \
+                    age < self.ttl + self.stale_time
+            future = self.start_refresh()
+            if servable:
+                return self.instances
+            future.result()
+        return self.instances
+
+    def get_instance(self, name):
+        return self.get_instances().get(name, None)
+
+    def add_instance(self, instance):
+        """Records an instance that was just created
+
+        Returns:
+            MonkeyInstance: The cached instance of that name
+        """
+        with self.lock:
+            self.added_times[instance.name] = time.time()
+            existing = self.instances.get(instance.name, None)
+            if existing is not None:
+                if existing is not instance:
+                    existing.update_instance_details(instance)
+                return existing
+            self.instances = dict(self.instances, **{instance.name: instance})
+            return instance
+
+    def invalidate(self):
+        with self.lock:
+            self.generation += 1
@@ -0,0 +1,53 @@
+"""Placement policies for jobs that don't name a local host
+
+A policy is given the hosts a job fits on and returns a sort key for each,
+the host with the lowest key is chosen.  Each candidate is a dict of:
+
+    hostname: The host
+    running_jobs: Jobs holding an allocation on the host
+    load_average: 1 minute load average, None if not reported yet
+    cpus: Number of cpus the host reported
+    gpu_free_memory: Free memory (MB) of each gpu the host reported
+    free_cpus, free_memory, free_gpus: Declared capacity left after placing
+        the job, None for resources the host doesn't declare
+"""
+
+PLACEMENT_POLICIES = dict()
+
+
+def register_placement_policy(name):
+
+    def register(fn):
+        PLACEMENT_POLICIES[name] = fn
+        return fn
+
+    return register
+
+
+def get_placement_policy(name):
+    if name not in PLACEMENT_POLICIES:
+        raise ValueError("{} placement policy not supported yet".format(name))
+    return PLACEMENT_POLICIES[name]
+
+
+@register_placement_policy("least_loaded")
+def least_loaded(candidate):
+    """Spreads jobs, fewest running jobs then lowest load per cpu"""
+    load = candidate["load_average"] or 0
+    return (candidate["running_jobs"], load / max(candidate["cpus"] or 1, 1),
+            -sum(candidate["gpu_free_memory"]))
+
+
+@register_placement_policy("bin_packing")
+def bin_packing(candidate):
+    """Fills the fullest host the job fits on, keeping other hosts free for
+    large jobs
+    """
+
+    def remaining(name):
+        if candidate[name] is None:
+            return float("inf")
+        return candidate[name]
+
+    return (remaining("free_gpus"), remaining("free_cpus"),
+            remaining("free_memory"), -candidate["running_jobs"])
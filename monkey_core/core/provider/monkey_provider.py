@@ -1,7 +1,14 @@
+import json
 import logging
+import os
+import threading
+import uuid
 from concurrent.futures import Future
+from datetime import datetime
 from threading import Thread
 
+import core.mongo.mongo_global as mongo_state
+
 logger = logging.getLogger(__name__)
 logging.getLogger("urllib3").setLevel(logging.WARNING)
 logging.getLogger("google.auth.transport.requests").setLevel(logging.WARNING)
@@ -35,6 +42,33 @@ class MonkeyProvider():
     provider_type = None
     provider_type = None
     instances = []
+    # Maximum jobs in a dispatch stage at once, set per provider in
+    # providers.yml
+    max_concurrent_dispatches = 8
+    # Maximum active jobs per project, set per provider in providers.yml
+    project_quotas = dict()
+    # Failed dispatches of a job before it is marked FAILED
+    max_dispatch_attempts = mongo_state.MONKEY_MAX_DISPATCH_ATTEMPTS
+    # Seconds to collect machine requests with identical params into one
+    # create_instances call, 0 creates every machine on its own.  Only jobs
+    # holding a dispatch slot request machines, so a batch is also capped by
+    # max_concurrent_dispatches of the provider and of the core
+    batch_create_window = 0
+    max_batch_size = 64
+    # Pools of booted, installed and mounted instances, set per provider in
+    # providers.yml
+    warm_pools = []
+    # Machine params of a pool entry that are not passed to create_instances
+    warm_pool_settings = ("install", "size", "min_size", "idle_time")
+    warm_pool_prefix = "monkey-pool-"
+    # Providers that reserve host resources for jobs, their allocations are
+    # synced with the jobs other core processes dispatched
+    tracks_resources = False
+    # Keep instances after their job and hand them to the next job with the
+    # same machine params, set per provider in providers.yml
+    instance_reuse = False
+    max_jobs_per_instance = 10
+    max_instance_idle_time = mongo_state.MONKEY_REUSE_IDLE_TIME
 
     def merge_params(self, base, additional):
         for key, value in additional.items():
@@ -63,16 +97,72 @@ class MonkeyProvider():
     def __init__(self, provider_info):
         super().__init__()
         self.name = provider_info["name"]
+        self.max_concurrent_dispatches = int(
+            provider_info.get("max_concurrent_dispatches",
+                              self.max_concurrent_dispatches))
+        self.project_quotas = provider_info.get("project_quotas", dict())
+        self.max_dispatch_attempts = int(
+            provider_info.get("max_dispatch_attempts",
+                              self.max_dispatch_attempts))
+        self.batch_create_window = float(
+            provider_info.get("batch_create_window",
+                              self.batch_create_window))
+        self.max_batch_size = int(
+            provider_info.get("max_batch_size", self.max_batch_size))
+        self.batch_lock = threading.Lock()
+        self.pending_batches = dict()
+        self.warm_pools = [
+            self.create_warm_pool(x)
+            for x in provider_info.get("warm_pools", [])
+        ]
+        self.warm_pool_lock = threading.Lock()
+        self.warm_pool_maintain_lock = threading.Lock()
+        # Pools only live in memory, machines a previous core process left
+        # in them are deleted once on the first maintenance
+        self.warm_pools_reconciled = False
+        self.instance_reuse = bool(
+            provider_info.get("instance_reuse", self.instance_reuse))
+        self.max_jobs_per_instance = int(
+            provider_info.get("max_jobs_per_instance",
+                              self.max_jobs_per_instance))
+        self.max_instance_idle_time = float(
+            provider_info.get("max_instance_idle_time",
+                              self.max_instance_idle_time))
+        # (instance, released time, machine key) of instances between jobs
+        self.free_instances = []
+        self.free_instances_lock = threading.Lock()
 
     def get_local_filesystem_path(self):
         raise NotImplementedError("This is not implemented yet")
 
+    def get_job_setup_log_path(self, job_uid):
+        """The append-only log of a job's install and setup tasks, in the
+        job's folder on the core's monkeyfs
+        """
+        return os.path.join(self.get_local_filesystem_path(), "jobs", job_uid,
+                            "setup.log")
+
     def list_instances(self):
         raise NotImplementedError("This is not implemented yet")
 
     def get_instance(self, instance_name):
         raise NotImplementedError("This is not implemented yet")
 
+    def invalidate_instances(self):
+        """Makes the next instance lookup fetch the provider's instances"""
+        pass
+
+    def cleanup_instance(self, instance, job_yml):
+        """Cleans up after a job on an instance, deleting cloud instances
+
+        Returns:
+            (bool, str): (Success, Message)
+        """
+        result = instance.cleanup_job(job_yml=job_yml,
+                                      provider_info=self.get_dict())
+        self.invalidate_instances()
+        return result
+
     def list_jobs(self):
         raise NotImplementedError("This is not implemented yet")
 
@@ -82,6 +172,450 @@ class MonkeyProvider():
     def create_instance(self, machine_params, job_yml):
         raise NotImplementedError("This is not implemented yet")
 
+    def get_machine_params(self, job_yml):
+        """Reads the machine params for this provider out of a job yml"""
+        machine_params = dict()
+        for provider_yml in job_yml["providers"]:
+            if provider_yml.get("name", "") == self.name:
+                for key, val in provider_yml.items():
+                    machine_params[key] = val
+                break
+        machine_params["monkey_job_uid"] = job_yml["job_uid"]
+        return machine_params
+
+    def get_machine_key(self, machine_params):
+        """Identifies machines that are interchangeable between jobs"""
+        return json.dumps(
+            {
+                key: val
+                for key, val in machine_params.items()
+                if key not in ("name", "monkey_job_uid")
+            },
+            sort_keys=True,
+            default=str)
+
+    def create_instances(self, machine_params, job_ymls):
+        """Creates one machine per job, all with the same machine_params
+
+        Providers that can create several machines in one call override this
+
+        Returns:
+            dict: job_uid -> (MonkeyInstance, success)
+        """
+        results = dict()
+        for job_yml in job_ymls:
+            job_uid = job_yml["job_uid"]
+            job_machine_params = dict(machine_params)
+            job_machine_params["monkey_job_uid"] = job_uid
+            results[job_uid] = self.create_instance(
+                machine_params=job_machine_params, job_yml=job_yml)
+        return results
+
+    def request_instance(self, machine_params, job_yml):
+        """Creates the machine for a job, batched with other jobs
+
+        Requests with identical machine_params that arrive within
+        batch_create_window seconds are created by one create_instances call,
+        at most max_batch_size and, as every request holds a dispatch slot,
+        max_concurrent_dispatches of them.  Blocks until the machine for this
+        job is created.
+
+        Returns:
+            (MonkeyInstance, bool): The created instance and success
+        """
+        warm_instance = self.acquire_warm_instance(
+            machine_params=machine_params, job_yml=job_yml)
+        if warm_instance is not None:
+            return warm_instance, True
+        free_instance = self.acquire_free_instance(
+            machine_params=machine_params, job_yml=job_yml)
+        if free_instance is not None:
+            return free_instance, True
+
+        if self.batch_create_window <= 0:
+            return self.create_instance(machine_params=machine_params,
+                                        job_yml=job_yml)
+
+        shared_params = {
+            key: val
+            for key, val in machine_params.items()
+            if key != "monkey_job_uid"
+        }
+        batch_key = json.dumps(shared_params, sort_keys=True, default=str)
+        future = Future()
+        with self.batch_lock:
+            batch = self.pending_batches.get(batch_key, None)
+            if batch is None:
+                batch = {"params": shared_params, "requests": []}
+                self.pending_batches[batch_key] = batch
+                batch["timer"] = threading.Timer(self.batch_create_window,
+                                                 self.flush_batch,
+                                                 args=(batch_key, batch))
+                batch["timer"].daemon = True
+                batch["timer"].start()
+            batch["requests"].append((job_yml, future))
+            # No more requests can arrive once every dispatch slot waits on it
+            batch_full = len(batch["requests"]) >= min(
+                self.max_batch_size, self.max_concurrent_dispatches)
+            if batch_full:
+                # Later requests start a new batch with its own timer
+                del self.pending_batches[batch_key]
+                batch["timer"].cancel()
+        if batch_full:
+            Thread(target=self.create_batch, args=(batch,),
+                   daemon=True).start()
+        return future.result()
+
+    def flush_batch(self, batch_key, batch):
+        """Creates a batch once its window is over, unless it was already
+        created for being full
+        """
+        with self.batch_lock:
+            if self.pending_batches.get(batch_key, None) is not batch:
+                return
+            del self.pending_batches[batch_key]
+        self.create_batch(batch)
+
+    def create_batch(self, batch):
+        shared_params, requests = batch["params"], batch["requests"]
+        job_ymls = [job_yml for job_yml, _ in requests]
+        logger.info(f"Creating {len(job_ymls)} machines in one batch")
+        try:
+            results = self.create_instances(machine_params=shared_params,
+                                            job_ymls=job_ymls)
+        except Exception as e:
+            logger.error(f"Failed to create batch of machines: {e}")
+            results = dict()
+        for job_yml, future in requests:
+            future.set_result(results.get(job_yml["job_uid"], (None, False)))
+
+    def allocate_resources(self, job_uid, job_yml):
+        """Reserves the resources a job requests
+
+        Providers that don't track resources admit every job
+
+        Returns:
+            dict: The allocation, None if the job doesn't fit yet
+        """
+        return dict()
+
+    def release_resources(self, job_uid):
+        """Frees a job's allocation
+
+        Returns:
+            bool: True if the job held an allocation
+        """
+        return False
+
+    def check_resource_request(self, job_yml):
+        """Checks a job could ever fit, even on an idle host
+
+        Returns:
+            (bool, str): (Whether the request fits, Message)
+        """
+        return True, "No resources are tracked"
+
+    def sync_allocations(self, active_allocations):
+        """Replaces the allocations with those of the active jobs in mongo
+
+        Args:
+            active_allocations (dict): job_uid -> resource_allocation of every
+                active job of the provider
+        """
+        pass
+
+    def is_overcommitted(self, hostname):
+        return False
+
+    def get_resource_usage(self):
+        return dict()
+
+    def refresh_load(self):
+        """Reads the live load of the provider's hosts for placement"""
+        pass
+
+    def create_warm_pool(self, pool_info):
+        """Reads a warm pool entry from providers.yml
+
+        Args:
+            pool_info (dict): machine params plus install, size, min_size and
+                idle_time for the pool
+
+        Returns:
+            dict: The pool with its idle instances
+        """
+        return {
+            "machine_params": {
+                key: val
+                for key, val in pool_info.items()
+                if key not in self.warm_pool_settings
+            },
+            "install": list(pool_info.get("install", [])),
+            "size": int(pool_info.get("size", 1)),
+            "min_size": int(pool_info.get("min_size", 0)),
+            "idle_time": float(
+                pool_info.get("idle_time",
+                              mongo_state.MONKEY_WARM_POOL_IDLE_TIME)),
+            "idle": [],
+            "last_draw": datetime.now(),
+        }
+
+    def find_warm_pool(self, machine_params, installs):
+        """Finds a pool whose instances can run a job
+
+        The pool's machine params must match the job's and the pool must not
+        install anything the job doesn't ask for
+        """
+        job_params = {
+            key: val
+            for key, val in machine_params.items()
+            if key not in ("name", "monkey_job_uid")
+        }
+        for pool in self.warm_pools:
+            if pool["machine_params"] == job_params and \
+                    set(pool["install"]).issubset(set(installs)):
+                return pool
+        return None
+
+    def acquire_warm_instance(self, machine_params, job_yml):
+        """Takes an idle instance from a matching warm pool
+
+        Returns:
+            MonkeyInstance: A booted instance with the pool's installs done
+                and monkeyfs mounted, None if no pool has one ready
+        """
+        pool = self.find_warm_pool(machine_params=machine_params,
+                                   installs=job_yml.get("install", []))
+        if pool is None:
+            return None
+        while True:
+            with self.warm_pool_lock:
+                pool["last_draw"] = datetime.now()
+                if len(pool["idle"]) == 0:
+                    return None
+                instance, _ = pool["idle"].pop(0)
+            # Pinged outside the lock so other draws and stats don't wait
+            if instance.check_online():
+                logger.info(f"Drew {instance.name} from the warm pool " +
+                            f"for {job_yml['job_uid']}")
+                return instance
+            Thread(target=self.cleanup_instance,
+                   args=(instance, {
+                       "job_uid": instance.name
+                   }),
+                   daemon=True).start()
+
+    def maintain_warm_pools(self, used_instances=None):
+        """Refills warm pools and evicts instances idle for too long
+
+        A pool is kept at its size while it has been drawn from within its
+        idle_time, afterwards instances idle longer than idle_time are
+        deleted until the pool is down to min_size
+
+        Args:
+            used_instances (set, optional): Names of instances unfinished
+                jobs run on, needed by the first call to reconcile the pools
+        """
+        if not self.warm_pool_maintain_lock.acquire(blocking=False):
+            return
+        try:
+            # Pools are only filled once leftovers are gone, so the reconcile
+            # never sees an instance this process is still handing out
+            if not self.warm_pools_reconciled and (
+                    used_instances is None or
+                    not self.reconcile_warm_pools(used_instances)):
+                return
+            for pool in self.warm_pools:
+                self.evict_warm_instances(pool)
+                self.fill_warm_pool(pool)
+        except Exception as e:
+            logger.error(f"Failed to maintain warm pools for {self.name}: {e}")
+        finally:
+            self.warm_pool_maintain_lock.release()
+
+    def reconcile_warm_pools(self, used_instances):
+        """Deletes warm pool machines that no pool or job knows about
+
+        Pool membership is kept in memory, so after a restart the idle
+        machines of the previous core process would keep running unused.
+        Runs before the pools are first filled, while they are still empty
+
+        Args:
+            used_instances (set): Names of instances unfinished jobs run on
+
+        Returns:
+            bool: True once the provider's instances were checked
+        """
+        try:
+            instances = self.list_instances()
+        except Exception as e:
+            logger.error(f"Failed to list warm pool instances: {e}")
+            return False
+        with self.warm_pool_lock:
+            known = set(x.name for pool in self.warm_pools
+                        for x, _ in pool["idle"])
+        with self.free_instances_lock:
+            known.update(x[0].name for x in self.free_instances)
+        for instance in instances:
+            if not instance.name.startswith(self.warm_pool_prefix) or \
+                    instance.name in known or \
+                    instance.name in used_instances:
+                continue
+            logger.info("Deleting orphaned warm pool instance " +
+                        instance.name)
+            self.cleanup_instance(instance, job_yml={"job_uid": instance.name})
+        self.warm_pools_reconciled = True
+        return True
+
+    def get_warm_pool_target(self, pool):
+        idle_seconds = (datetime.now() - pool["last_draw"]).total_seconds()
+        if idle_seconds < pool["idle_time"]:
+            return pool["size"]
+        return pool["min_size"]
+
+    def evict_warm_instances(self, pool):
+        now = datetime.now()
+        evicted = []
+        # Pinged outside the lock so draws don't wait on the network
+        with self.warm_pool_lock:
+            idle = [x for x, _ in pool["idle"]]
+        offline = set(x.name for x in idle if not x.check_online())
+        with self.warm_pool_lock:
+            target = self.get_warm_pool_target(pool)
+            kept = []
+            for instance, idle_since in pool["idle"]:
+                idle_seconds = (now - idle_since).total_seconds()
+                if instance.name in offline or (
+                        len(pool["idle"]) - len(evicted) > target and
+                        idle_seconds > pool["idle_time"]):
+                    evicted.append(instance)
+                else:
+                    kept.append((instance, idle_since))
+            pool["idle"] = kept
+        for instance in evicted:
+            logger.info(f"Evicting {instance.name} from the warm pool")
+            self.cleanup_instance(instance, job_yml={"job_uid": instance.name})
+
+    def fill_warm_pool(self, pool):
+        with self.warm_pool_lock:
+            missing = self.get_warm_pool_target(pool) - len(pool["idle"])
+        if missing <= 0:
+            return
+        job_ymls = [{
+            "job_uid": self.warm_pool_prefix + uuid.uuid4().hex[:8]
+        } for _ in range(missing)]
+        logger.info(f"Creating {missing} warm instances for {self.name}")
+        results = self.create_instances(machine_params=pool["machine_params"],
+                                        job_ymls=job_ymls)
+        for job_yml in job_ymls:
+            instance, success = results.get(job_yml["job_uid"], (None, False))
+            if not success:
+                continue
+            if not instance.warm_up(installs=pool["install"],
+                                    job_yml=job_yml,
+                                    provider_info=self.get_dict()):
+                self.cleanup_instance(instance, job_yml=job_yml)
+                continue
+            with self.warm_pool_lock:
+                pool["idle"].append((instance, datetime.now()))
+
+    def get_warm_pool_stats(self):
+        with self.warm_pool_lock:
+            return [{
+                "machine_params": pool["machine_params"],
+                "install": pool["install"],
+                "size": pool["size"],
+                "target": self.get_warm_pool_target(pool),
+                "idle": [x.name for x, _ in pool["idle"]],
+            } for pool in self.warm_pools]
+
+    def acquire_free_instance(self, machine_params, job_yml):
+        """Takes an instance a previous job released with the same params
+
+        Instances that already have more of the job's installs are preferred
+
+        Returns:
+            MonkeyInstance: The instance to reuse, None if there is none
+        """
+        if not self.instance_reuse:
+            return None
+        machine_key = self.get_machine_key(machine_params)
+        installs = set(job_yml.get("install", []))
+        while True:
+            with self.free_instances_lock:
+                candidates = sorted(
+                    [x for x in self.free_instances if x[2] == machine_key],
+                    key=lambda x: -len(
+                        installs.intersection(x[0].installed_dependencies)))
+                if len(candidates) == 0:
+                    return None
+                instance = candidates[0][0]
+                self.free_instances.remove(candidates[0])
+            # Pinged outside the lock so other acquires and releases don't wait
+            if instance.check_online():
+                logger.info(f"Reusing {instance.name} for " +
+                            f"{job_yml['job_uid']}")
+                return instance
+            Thread(target=self.cleanup_instance,
+                   args=(instance, {
+                       "job_uid": instance.name
+                   }),
+                   daemon=True).start()
+
+    def release_instance(self, instance, machine_params, job_yml):
+        """Hands a finished job's instance back to the free list
+
+        The job's persist loop is stopped and its files removed.  Instances
+        that have run max_jobs_per_instance jobs or fail to reset are deleted.
+        An instance already on the free list is left as is
+
+        Returns:
+            (bool, str): (Success, Message)
+        """
+        if self.is_free_instance(instance):
+            logger.warning(f"{instance.name} was already released")
+            return True, "Instance was already released"
+        instance.jobs_run += 1
+        if self.instance_reuse and \
+                instance.jobs_run < self.max_jobs_per_instance:
+            success, msg = instance.reset_job(job_yml=job_yml,
+                                              provider_info=self.get_dict())
+            if success:
+                with self.free_instances_lock:
+                    if all(x[0] is not instance
+                           for x in self.free_instances):
+                        self.free_instances.append(
+                            (instance, datetime.now(),
+                             self.get_machine_key(machine_params)))
+                return success, msg
+            logger.error(f"Failed to reset {instance.name}: {msg}")
+        return self.cleanup_instance(instance, job_yml=job_yml)
+
+    def is_free_instance(self, instance):
+        with self.free_instances_lock:
+            return any(x[0] is instance for x in self.free_instances)
+
+    def evict_free_instances(self):
+        """Deletes free instances that have waited too long for a job"""
+        now = datetime.now()
+        with self.free_instances_lock:
+            evicted = [
+                x for x in self.free_instances
+                if (now - x[1]).total_seconds() > self.max_instance_idle_time
+                or not x[0].online
+            ]
+            self.free_instances = [
+                x for x in self.free_instances if x not in evicted
+            ]
+        for instance, _, _ in evicted:
+            logger.info(f"Deleting idle instance {instance.name}")
+            Thread(target=self.cleanup_instance,
+                   args=(instance, {
+                       "job_uid": instance.name
+                   }),
+                   daemon=True).start()
+        return len(evicted)
+
     def wait_for_operation(self, operation_name):
         raise NotImplementedError("This is not implemented yet")
 
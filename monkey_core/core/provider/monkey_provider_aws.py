@@ -3,15 +3,13 @@ import os
 import subprocess
 import time
 from concurrent.futures import Future
-from datetime import datetime, timedelta
 from threading import Thread
 
-import ansible_runner
-from ansible.inventory.manager import InventoryManager
-from ansible.parsing.dataloader import DataLoader
 from ansible.vars.manager import VariableManager
 from core import monkey_global
+from core.instance.monkey_ansible import run_ansible
 from core.instance.monkey_instance_aws import MonkeyInstanceAWS
+from core.provider.monkey_inventory import InventoryCache
 from core.provider.monkey_provider import MonkeyProvider
 from core.setup_scripts.utils import aws_cred_file_environment
 
@@ -21,10 +19,8 @@ logging.getLogger("botocore").setLevel(logging.WARNING)
 
 class MonkeyProviderAWS(MonkeyProvider):
 
-    raw_provider_info = dict()
-    instances = dict()
-    last_instance_fetch = datetime.now() - timedelta(minutes=10)
     instance_list_refresh_period = 10
+    batch_create_window = 2
 
     def get_dict(self):
         res = super().get_dict()
@@ -39,7 +35,14 @@ class MonkeyProviderAWS(MonkeyProvider):
         self.zone = provider_info["aws_zone"]
         provider_info["zone"] = provider_info["aws_zone"]
         self.provider_info = provider_info
-
+        # Machines that left the inventory are kept and marked offline
+        self.inventory = InventoryCache(
+            group="monkey_aws",
+            create_instance=lambda x: MonkeyInstanceAWS(ansible_info=x),
+            ttl=self.instance_list_refresh_period,
+            keep_missing=True)
+
+        self.raw_provider_info = dict()
         for key, value in provider_info.items():
             if value is not None:
                 self.raw_provider_info[key] = value
@@ -82,7 +85,7 @@ class MonkeyProviderAWS(MonkeyProvider):
         cred_environment = aws_cred_file_environment(
             cred_file=self.provider_info["aws_cred_file"])
 
-        runner = ansible_runner.run(
+        runner = run_ansible(
             playbook='aws_setup_checks.yml',
             private_data_dir='ansible',
             extravars={
@@ -106,37 +109,15 @@ class MonkeyProviderAWS(MonkeyProvider):
     def check_connection(self):
         pass
 
-    def list_instances(self):
-        time_difference = (datetime.now() - self.last_instance_fetch)
-        if time_difference.total_seconds() < self.instance_list_refresh_period:
-            return sorted(list(self.instances.values()))
-        # MARK(alamp): AnsibleInternalAPI
-        loader = DataLoader()
-        inventory = InventoryManager(loader=loader,
-                                     sources="ansible/inventory")
-        host_list = inventory.get_groups_dict().get("monkey_aws", [])
-        detected_instances = []
-        for host in host_list:
-            h = inventory.get_host(host)
-            host_vars = h.get_vars()
-            inst = MonkeyInstanceAWS(ansible_info=host_vars)
-            detected_instances.append(inst)
-
-        detected_names = set([x.name for x in detected_instances])
-        for detected_instance in detected_instances:
-            if detected_instance.name in self.instances:
-                self.instances[detected_instance.name].update_instance_details(
-                    detected_instance)
-            else:
-                self.instances[detected_instance.name] = detected_instance
+    @property
+    def instances(self):
+        return self.inventory.instances
 
-        offline_instances = set(
-            self.instances.keys()).difference(detected_names)
-        for offline_instance in offline_instances:
-            self.instances[offline_instance].state = "offline"
+    def invalidate_instances(self):
+        self.inventory.invalidate()
 
-        self.last_instance_fetch = datetime.now()
-        return sorted(list(self.instances.values()))
+    def list_instances(self):
+        return sorted(list(self.inventory.get_instances().values()))
 
     def get_instance(self, instance_name):
         """Attempts to get instance by name
@@ -147,13 +128,7 @@ class MonkeyProviderAWS(MonkeyProvider):
         Returns:
             [MonkeyInstance]: MonkeyInstance if it exists otherwise None
         """
-        instances = self.list_instances()
-        for instance in instances:
-            if instance.name == instance_name:
-                return instance
-        found_instance = None
-
-        return found_instance
+        return self.inventory.get_instance(instance_name)
 
     def list_jobs(self):
         jobs = []
@@ -191,42 +166,57 @@ class MonkeyProviderAWS(MonkeyProvider):
         return images
 
     def create_instance(self, machine_params=dict(), job_yml=dict()):
-        print("MACHINE PARAMS: ", machine_params)
-        print("CREATING NEW INSTANCE")
-        runner = ansible_runner.run(playbook='aws_create_job.yml',
-                                    private_data_dir='ansible',
-                                    extravars=machine_params,
-                                    quiet=monkey_global.QUIET_ANSIBLE)
+        job_uid = machine_params["monkey_job_uid"]
+        results = self.create_instances(machine_params=machine_params,
+                                        job_ymls=[{
+                                            "job_uid": job_uid
+                                        }])
+        return results[job_uid]
+
+    def create_instances(self, machine_params=dict(), job_ymls=[]):
+        job_uids = [x["job_uid"] for x in job_ymls]
+        # The playbook loops over monkey_job_uids, an extravar would
+        # override the loop variable
+        create_params = {
+            key: val
+            for key, val in machine_params.items()
+            if key != "monkey_job_uid"
+        }
+        create_params["monkey_job_uids"] = job_uids
+        print("MACHINE PARAMS: ", create_params)
+        print(f"CREATING {len(job_uids)} NEW INSTANCES")
+        runner = run_ansible(playbook='aws_create_job.yml',
+                             private_data_dir='ansible',
+                             extravars=create_params,
+                             quiet=monkey_global.QUIET_ANSIBLE)
         print(runner.stats)
 
+        results = {job_uid: (None, False) for job_uid in job_uids}
         if runner.status == "failed":
-            print("Failed to create the instance")
-            return None, False
+            # Some machines of a batch may still have been created
+            print("Failed to create all of the instances")
         retries = 1
         while retries > 0:
-            loader = DataLoader()
-            inventory = InventoryManager(loader=loader,
-                                         sources="ansible/inventory")
-            try:
-                print("Checking inventory for host machine")
-                h = inventory.get_host(machine_params["monkey_job_uid"])
-                host_vars = h.get_vars()
-                inst = MonkeyInstanceAWS(ansible_info=host_vars)
-                print(inst)
-                # TODO ensure machine is on
-                if inst is not None and inst.check_online():
-                    print("Instance found online")
-                    if inst.name in self.instances:
-                        self.instances[inst.name].update_instance_details(inst)
-                    else:
-                        print("Adding to provider instances")
-                        self.instances[inst.name] = inst
-
-                    return inst, True
-            except Exception as e:
-                print("Failed to get host", e)
-                return None, False
+            # The cached inventory doesn't list the new machines yet
+            self.inventory.invalidate()
+            instances = self.inventory.get_instances()
+            for job_uid in job_uids:
+                if results[job_uid][1]:
+                    continue
+                try:
+                    print("Checking inventory for host machine")
+                    inst = instances.get(job_uid, None)
+                    print(inst)
+                    # TODO ensure machine is on
+                    if inst is not None and inst.check_online():
+                        print("Instance found online")
+                        inst = self.inventory.add_instance(inst)
+                        results[job_uid] = (inst, True)
+                except Exception as e:
+                    print("Failed to get host", e)
+            if all(success for _, success in results.values()):
+                break
             retries -= 1
             print("Retry inventory creation for machine")
             time.sleep(2)
-        return None, False
+        return results
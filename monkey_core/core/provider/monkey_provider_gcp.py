@@ -8,13 +8,12 @@ import time
 from concurrent.futures import Future
 from threading import Thread
 
-import ansible_runner
 import googleapiclient.discovery
-from ansible.inventory.manager import InventoryManager
-from ansible.parsing.dataloader import DataLoader
 from ansible.vars.manager import VariableManager
 from core import monkey_global
+from core.instance.monkey_ansible import run_ansible
 from core.instance.monkey_instance_gcp import MonkeyInstanceGCP
+from core.provider.monkey_inventory import InventoryCache
 from core.provider.monkey_provider import MonkeyProvider
 from google.oauth2 import service_account
 
@@ -27,7 +26,7 @@ logging.getLogger("google.auth.transport.requests").setLevel(logging.WARNING)
 class MonkeyProviderGCP(MonkeyProvider):
     compute_api = None
     credentials = None
-    raw_provider_info = dict()
+    batch_create_window = 2
 
     def get_dict(self):
         res = super().get_dict()
@@ -44,7 +43,12 @@ class MonkeyProviderGCP(MonkeyProvider):
         self.project = provider_info["gcp_project"]
         self.gcp_user = provider_info["gcp_user"]
         self.provider_info = provider_info
+        self.inventory = InventoryCache(
+            group="monkey_gcp",
+            create_instance=lambda x: MonkeyInstanceGCP(
+                ansible_info=x, gcp_user=self.gcp_user))
 
+        self.raw_provider_info = dict()
         for key, value in provider_info.items():
             if value is not None:
                 self.raw_provider_info[key] = value
@@ -89,9 +93,9 @@ class MonkeyProviderGCP(MonkeyProvider):
         return False
 
     def check_provider(self):
-        runner = ansible_runner.run(playbook='gcp_setup_checks.yml',
-                                    private_data_dir='ansible',
-                                    quiet=True)
+        runner = run_ansible(playbook='gcp_setup_checks.yml',
+                             private_data_dir='ansible',
+                             quiet=True)
 
         if runner.status == "failed":
             print("Failed to mount the GCP  filesystem")
@@ -116,21 +120,15 @@ class MonkeyProviderGCP(MonkeyProvider):
             pass
         return False
 
+    @property
+    def instances(self):
+        return self.inventory.instances
+
+    def invalidate_instances(self):
+        self.inventory.invalidate()
+
     def list_instances(self):
-        instances = []
-        # MARK(alamp): AnsibleInternalAPI
-        loader = DataLoader()
-        inventory = InventoryManager(loader=loader,
-                                     sources="ansible/inventory")
-        variable_manager = VariableManager(loader=loader, inventory=inventory)
-        host_list = inventory.get_groups_dict().get("monkey_gcp", [])
-        for host in host_list:
-            h = inventory.get_host(host)
-            host_vars = h.get_vars()
-            inst = MonkeyInstanceGCP(ansible_info=host_vars,
-                                     gcp_user=self.gcp_user)
-            instances.append(inst)
-        return instances
+        return list(self.inventory.get_instances().values())
 
     def get_instance(self, instance_name):
         """Attempts to get instance by name
@@ -141,13 +139,7 @@ class MonkeyProviderGCP(MonkeyProvider):
         Returns:
             [MonkeyInstance]: MonkeyInstance if it exists otherwise None
         """
-        instances = self.list_instances()
-        for instance in instances:
-            if instance.name == instance_name:
-                return instance
-        found_instance = None
-
-        return found_instance
+        return self.inventory.get_instance(instance_name)
 
     def list_jobs(self):
         jobs = []
@@ -184,36 +176,57 @@ class MonkeyProviderGCP(MonkeyProvider):
         return images
 
     def create_instance(self, machine_params=dict(), job_yml=dict()):
-        logger.debug("MACHINE PARAMS: ", machine_params)
-        logger.info("CREATING NEW INSTANCE")
-        runner = ansible_runner.run(playbook='gcp_create_job.yml',
-                                    private_data_dir='ansible',
-                                    extravars=machine_params,
-                                    quiet=monkey_global.QUIET_ANSIBLE)
-
+        job_uid = machine_params["monkey_job_uid"]
+        results = self.create_instances(machine_params=machine_params,
+                                        job_ymls=[{
+                                            "job_uid": job_uid
+                                        }])
+        return results[job_uid]
+
+    def create_instances(self, machine_params=dict(), job_ymls=[]):
+        job_uids = [x["job_uid"] for x in job_ymls]
+        # The playbook loops over monkey_job_uids, an extravar would
+        # override the loop variable
+        create_params = {
+            key: val
+            for key, val in machine_params.items()
+            if key != "monkey_job_uid"
+        }
+        create_params["monkey_job_uids"] = job_uids
+        logger.debug(f"MACHINE PARAMS: {create_params}")
+        logger.info(f"CREATING {len(job_uids)} NEW INSTANCES")
+        runner = run_ansible(playbook='gcp_create_job.yml',
+                             private_data_dir='ansible',
+                             extravars=create_params,
+                             quiet=monkey_global.QUIET_ANSIBLE)
+
+        results = {job_uid: (None, False) for job_uid in job_uids}
         if runner.status == "failed":
-            logger.info("Failed creation of instance")
-            return None, False
+            # Some machines of a batch may still have been created
+            logger.info("Failed creation of all instances")
 
-        job_uid = machine_params["monkey_job_uid"]
-        logger.info(f"Successfully created instance for job: {job_uid}")
         retries = 4
         while retries > 0:
-            logger.info("Attempting to get instance from inventory")
-            loader = DataLoader()
-            inventory = InventoryManager(loader=loader,
-                                         sources="ansible/inventory")
-            try:
-                h = inventory.get_host(machine_params["monkey_job_uid"])
-                host_vars = h.get_vars()
-                inst = MonkeyInstanceGCP(ansible_info=host_vars,
-                                         gcp_user=self.gcp_user)
-                if inst is not None and inst.check_online():
-                    return inst, True
-            except Exception as e:
-                print("Failed to get host", e)
-                return None, False
+            logger.info("Attempting to get instances from inventory")
+            # The cached inventory doesn't list the new machines yet
+            self.inventory.invalidate()
+            instances = self.inventory.get_instances()
+            for job_uid in job_uids:
+                if results[job_uid][1]:
+                    continue
+                try:
+                    inst = instances.get(job_uid, None)
+                    if inst is not None and inst.check_online():
+                        logger.info(
+                            f"Successfully created instance for job: {job_uid}"
+                        )
+                        inst = self.inventory.add_instance(inst)
+                        results[job_uid] = (inst, True)
+                except Exception as e:
+                    print("Failed to get host", e)
+            if all(success for _, success in results.values()):
+                break
             retries -= 1
             print("Retry inventory creation for machine")
             time.sleep(2)
-        return None, False
+        return results
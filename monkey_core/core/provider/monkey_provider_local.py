@@ -1,10 +1,13 @@
 import logging
 import os
 import subprocess
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 
 import yaml
 from core.instance.monkey_instance_local import MonkeyInstanceLocal
+from core.provider.monkey_placement import get_placement_policy
 from core.provider.monkey_provider import MonkeyProvider
 
 logger = logging.getLogger(__name__)
@@ -13,10 +16,11 @@ logging.getLogger("botocore").setLevel(logging.WARNING)
 
 class MonkeyProviderLocal(MonkeyProvider):
 
-    raw_provider_info = dict()
-    instances = dict()
+    tracks_resources = True
     last_instance_fetch = datetime.now() - timedelta(minutes=10)
     instance_list_refresh_period = 10
+    # How hosts are chosen for jobs that don't name one, see monkey_placement
+    placement_policy = "least_loaded"
 
     def get_dict(self):
         res = super().get_dict()
@@ -29,11 +33,26 @@ class MonkeyProviderLocal(MonkeyProvider):
         self.provider_type = "local"
         self.provider_info = provider_info
 
+        self.raw_provider_info = dict()
         for key, value in provider_info.items():
             if value is not None:
                 self.raw_provider_info[key] = value
 
         logger.info("Local Handler Instantiating {}".format(self.name))
+        self.placement_policy = provider_info.get("placement_policy",
+                                                  self.placement_policy)
+        get_placement_policy(self.placement_policy)
+        self.resource_lock = threading.Lock()
+        self.load_lock = threading.Lock()
+        # hostname -> cpus, memory and gpu indices declared in local.yml
+        self.host_resources = dict()
+        # job_uid -> resources reserved on its host
+        self.allocations = dict()
+        # job_uid -> resources reserved by jobs other core processes
+        # dispatched, read from mongo by sync_allocations
+        self.shared_allocations = dict()
+        # hostname -> MonkeyInstanceLocal
+        self.instances = dict()
 
         self.check_filesystem_existence()
         # TODO(alamp): Dispatch in backgorund thread to allow no stall monkey_core start
@@ -67,9 +86,10 @@ class MonkeyProviderLocal(MonkeyProvider):
         try:
             with open("local.yml", "r") as local_yaml_file:
                 local_yaml = yaml.full_load(local_yaml_file)
-                local_hosts = local_yaml.get("hosts", [])
-                hostnames = [x[0] for x in local_hosts]
-                for hostname in hostnames:
+                local_hosts = self.get_local_hosts(local_yaml)
+                for hostname, details in local_hosts.items():
+                    self.host_resources[hostname] = self.get_host_capacity(
+                        details)
                     inst = self.create_local_instance(name=hostname, hostname=hostname)
                     self.instances[inst.name] = inst
 
@@ -81,6 +101,251 @@ class MonkeyProviderLocal(MonkeyProvider):
         except Exception as e:
             print(f"Exception found: {e}")
 
+    @staticmethod
+    def get_local_hosts(local_yaml):
+        """Reads the hosts of local.yml as hostname -> host details
+
+        Hosts are written as a mapping, older files list [hostname, details]
+        """
+        hosts = local_yaml.get("hosts", None) or dict()
+        if isinstance(hosts, dict):
+            return {
+                hostname: details or dict()
+                for hostname, details in hosts.items()
+            }
+        return {
+            x[0]: (x[1] if len(x) > 1 else None) or dict() for x in hosts
+        }
+
+    @staticmethod
+    def get_host_capacity(details):
+        """Reads the cpus, memory (GB) and gpus a host declares
+
+        gpus is either a count or a list of device indices.  Resources that
+        are not declared are not limited
+        """
+        gpus = details.get("gpus", None)
+        if isinstance(gpus, int):
+            gpus = list(range(gpus))
+        return {
+            "cpus": float(details["cpus"]) if "cpus" in details else None,
+            "memory":
+                float(details["memory"]) if "memory" in details else None,
+            "gpus": gpus,
+        }
+
+    def get_host_allocations(self, hostname):
+        allocations = dict(self.shared_allocations, **self.allocations)
+        return [
+            x for x in allocations.values()
+            if x.get("instance", None) == hostname
+        ]
+
+    def get_host_usage(self, hostname):
+        used = {"cpus": 0, "memory": 0, "gpus": []}
+        for allocation in self.get_host_allocations(hostname):
+            used["cpus"] += allocation.get("cpus", 0)
+            used["memory"] += allocation.get("memory", 0)
+            used["gpus"] += allocation.get("gpus", [])
+        return used
+
+    def fit_allocation(self, hostname, requests):
+        """Builds the allocation of a job's requests on a host
+
+        Returns:
+            dict: The allocation, None if the host doesn't have room left
+        """
+        capacity = self.host_resources.get(hostname, dict())
+        used = self.get_host_usage(hostname)
+        allocation = {"instance": hostname}
+        for name in ("cpus", "memory"):
+            request = float(requests.get(name, 0))
+            allocation[name] = request
+            if capacity.get(name) is not None and \
+                    used[name] + request > capacity[name]:
+                return None
+        if capacity.get("gpus") is not None:
+            gpu_request = int(requests.get("gpus", 0))
+            free_gpus = [x for x in capacity["gpus"] if x not in used["gpus"]]
+            if len(free_gpus) < gpu_request:
+                return None
+            allocation["gpus"] = free_gpus[:gpu_request]
+        return allocation
+
+    def get_placement_candidate(self, hostname, allocation):
+        capacity = self.host_resources.get(hostname, dict())
+        used = self.get_host_usage(hostname)
+        load = self.instances[hostname].load or dict()
+
+        def remaining(name):
+            if capacity.get(name) is None:
+                return None
+            return capacity[name] - used[name] - allocation[name]
+
+        return {
+            "hostname": hostname,
+            "running_jobs": len(self.get_host_allocations(hostname)),
+            "load_average": load.get("load_average", None),
+            "cpus": load.get("cpus", None),
+            "gpu_free_memory": load.get("gpu_free_memory", []),
+            "free_cpus": remaining("cpus"),
+            "free_memory": remaining("memory"),
+            "free_gpus":
+                None if capacity.get("gpus") is None else
+                len(capacity["gpus"]) - len(used["gpus"]) -
+                len(allocation["gpus"]),
+        }
+
+    def place_job(self, job_uid, requests):
+        """Picks an online host the job fits on with the placement policy
+
+        Returns:
+            dict: The allocation on the chosen host, with the decision under
+                placement, None if no host has room
+        """
+        policy = get_placement_policy(self.placement_policy)
+        candidates = []
+        for hostname, instance in self.instances.items():
+            if not instance.online:
+                continue
+            allocation = self.fit_allocation(hostname, requests)
+            if allocation is None:
+                continue
+            candidate = self.get_placement_candidate(hostname, allocation)
+            candidates.append((policy(candidate), allocation, candidate))
+        if len(candidates) == 0:
+            return None
+        candidates.sort(key=lambda x: x[0])
+        allocation = candidates[0][1]
+        allocation["placement"] = {
+            "policy": self.placement_policy,
+            "instance": allocation["instance"],
+            "date": datetime.now(),
+            "candidates": [x[2] for x in candidates],
+        }
+        logger.info(f"Placed {job_uid} on {allocation['instance']} with " +
+                    f"{self.placement_policy}")
+        return allocation
+
+    def allocate_resources(self, job_uid, job_yml):
+        """Reserves the cpus, memory and gpus a job requests on its host
+
+        Jobs request resources under resources in job.yml.  GPUs are bound
+        to specific device indices, which the job sees through
+        CUDA_VISIBLE_DEVICES.  Jobs that don't name a host, or were placed
+        before being requeued, are placed with the provider's
+        placement_policy
+
+        Returns:
+            dict: The allocation, None if the job doesn't fit yet
+        """
+        hostname = job_yml.get("instance", None)
+        requests = job_yml.get("resources", None) or dict()
+        with self.resource_lock:
+            if job_uid in self.allocations:
+                return self.allocations[job_uid]
+            if hostname is None or job_yml.get("auto_placement", False):
+                allocation = self.place_job(job_uid, requests)
+            else:
+                allocation = self.fit_allocation(hostname, requests)
+            if allocation is None:
+                return None
+            self.allocations[job_uid] = {
+                k: v for k, v in allocation.items() if k != "placement"
+            }
+            return allocation
+
+    def release_resources(self, job_uid):
+        with self.resource_lock:
+            return self.allocations.pop(job_uid, None) is not None
+
+    def fits_capacity(self, hostname, requests):
+        capacity = self.host_resources.get(hostname, dict())
+        for name in ("cpus", "memory"):
+            if capacity.get(name) is not None and \
+                    float(requests.get(name, 0)) > capacity[name]:
+                return False
+        return capacity.get("gpus") is None or \
+            int(requests.get("gpus", 0)) <= len(capacity["gpus"])
+
+    def check_resource_request(self, job_yml):
+        """Checks the job's resources fit on its host, or on any host when
+        the job is placed automatically, with nothing else running
+
+        Returns:
+            (bool, str): (Whether the request fits, Message)
+        """
+        requests = job_yml.get("resources", None) or dict()
+        hostname = job_yml.get("instance", None)
+        if hostname is None or job_yml.get("auto_placement", False):
+            if len(self.host_resources) == 0 or any(
+                    self.fits_capacity(x, requests)
+                    for x in self.host_resources.keys()):
+                return True, "Resources fit on a host"
+            return False, f"Requested resources {requests} exceed the " + \
+                "capacity of every host"
+        if self.fits_capacity(hostname, requests):
+            return True, "Resources fit on the host"
+        return False, f"Requested resources {requests} exceed the " + \
+            f"capacity of {hostname}: {self.host_resources[hostname]}"
+
+    def sync_allocations(self, active_allocations):
+        """Replaces the allocations with those of the active jobs in mongo
+
+        Jobs dispatched by other core processes count against the hosts too,
+        and allocations of jobs that finished elsewhere are dropped.  Called
+        under the dispatch lock, where every allocation of this process is
+        already saved on its job.
+        """
+        with self.resource_lock:
+            self.allocations = {
+                k: v
+                for k, v in self.allocations.items()
+                if k in active_allocations
+            }
+            self.shared_allocations = {
+                k: v
+                for k, v in active_allocations.items()
+                if k not in self.allocations
+            }
+
+    def is_overcommitted(self, hostname):
+        """
+        Returns:
+            bool: True if the jobs on the host reserve more than it has, or
+                share a gpu
+        """
+        capacity = self.host_resources.get(hostname, dict())
+        with self.resource_lock:
+            used = self.get_host_usage(hostname)
+        for name in ("cpus", "memory"):
+            if capacity.get(name) is not None and used[name] > capacity[name]:
+                return True
+        return len(set(used["gpus"])) != len(used["gpus"])
+
+    def refresh_load(self):
+        """Reads the load of every host, skipped while a refresh is running
+        """
+        if not self.load_lock.acquire(blocking=False):
+            return
+        try:
+            online_instances = [
+                x for x in self.instances.values() if x.online
+            ]
+            with ThreadPoolExecutor(max_workers=8) as executor:
+                list(executor.map(lambda x: x.update_load(), online_instances))
+        finally:
+            self.load_lock.release()
+
+    def get_resource_usage(self):
+        with self.resource_lock:
+            return {
+                hostname: {
+                    "capacity": capacity,
+                    "used": self.get_host_usage(hostname),
+                } for hostname, capacity in self.host_resources.items()
+            }
+
     def check_provider(self):
         return True
 
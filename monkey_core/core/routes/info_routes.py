@@ -7,7 +7,7 @@ import yaml
 from core import monkey_global
 from core.routes.utils import (get_local_filesystem_for_provider,
                                sync_directories)
-from flask import Blueprint, jsonify, request, send_file
+from flask import Blueprint, Response, jsonify, request, send_file
 from ruamel.yaml import YAML, round_trip_load
 
 info_routes = Blueprint("info_routes", __name__)
@@ -50,6 +50,25 @@ def get_list_instances():
     return jsonify(res)
 
 
+@info_routes.route('/get/dispatch_stats')
+def get_dispatch_stats():
+    monkey = monkey_global.get_monkey()
+    return jsonify(monkey.get_dispatch_stats())
+
+
+@info_routes.route('/metrics')
+def get_metrics():
+    monkey = monkey_global.get_monkey()
+    return Response(monkey.get_metrics(),
+                    mimetype="text/plain; version=0.0.4")
+
+
+@info_routes.route('/get/loop_stats')
+def get_loop_stats():
+    monkey = monkey_global.get_monkey()
+    return jsonify(monkey.get_loop_stats())
+
+
 @info_routes.route('/list/jobs')
 def get_list_jobs():
     monkey = monkey_global.get_monkey()
@@ -104,6 +123,31 @@ def get_job_config():
         })
 
 
+@info_routes.route('/get/job/setup_log')
+def get_job_setup_log():
+    """Returns the setup log of a job from a byte offset
+
+    Poll with the returned offset to follow the log while the job sets up
+    """
+    monkey = monkey_global.get_monkey()
+    job_uid = request.args.get("job_uid", None)
+    if job_uid is None:
+        return jsonify({"success": False, "msg": "No job_uid provided"})
+    try:
+        offset = max(int(request.args.get("offset", 0)), 0)
+    except ValueError:
+        return jsonify({"success": False, "msg": "Invalid offset"})
+    setup_log = monkey.get_job_setup_log(job_uid, offset=offset)
+    if setup_log is None:
+        return jsonify({"success": False, "msg": "No matching job found"})
+    return jsonify({
+        "success": True,
+        "msg": "Found setup log",
+        "log": setup_log["log"],
+        "offset": setup_log["offset"]
+    })
+
+
 @info_routes.route('/get/job/output')
 def get_job_output():
     monkey = monkey_global.get_monkey()
@@ -0,0 +1,125 @@
+"""Dispatches ansible calls to many fake instances at once to check that
+their execution channels are independent
+
+ansible_runner is replaced by a call that sleeps, so no hosts are needed:
+
+    python3 stress_channels.py -n 50 --delay 0.5
+
+Checks that:
+- Calls to different instances run in parallel
+- Extravars of one instance never reach another
+- Taking over one instance cancels only the call running on it
+"""
+import argparse
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+import core.instance.monkey_instance as monkey_instance
+from core.instance.monkey_instance import AnsibleRunException, MonkeyInstance
+
+# host -> extravars of every call made to it
+calls = dict()
+calls_lock = threading.Lock()
+
+
+def fake_run_ansible(host_pattern,
+                     delay,
+                     extravars=None,
+                     cancel_callback=None,
+                     **kwargs):
+    with calls_lock:
+        calls.setdefault(host_pattern, []).append(dict(extravars or dict()))
+    end = time.time() + delay
+    while time.time() < end:
+        if cancel_callback is not None and cancel_callback():
+            return SimpleNamespace(status="canceled", captured_events=[])
+        time.sleep(0.01)
+    return SimpleNamespace(status="successful", captured_events=[])
+
+
+class FakeInstance(MonkeyInstance):
+    ssh_fast_path = False
+
+    def __init__(self, name):
+        super().__init__(name=name, ip_address=None)
+        self.channel.update_extravars({"fake_host": name})
+
+
+def check_parallel(instances, delay):
+    shared_extravars = {"job": "stress"}
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=len(instances)) as executor:
+        list(
+            executor.map(
+                lambda x: x.run_ansible_role(rolename="stress",
+                                             extravars=shared_extravars),
+                instances))
+    elapsed = time.time() - start
+    print(f"{len(instances)} calls of {delay}s took {elapsed:.2f}s, "
+          f"{len(instances) * delay / elapsed:.1f}x parallel")
+    errors = []
+    # Serial dispatch would take len(instances) * delay
+    if elapsed > delay * 5:
+        errors.append(f"calls didn't run in parallel: {elapsed:.2f}s")
+    if shared_extravars != {"job": "stress"}:
+        errors.append(f"caller's extravars were changed: {shared_extravars}")
+    for instance in instances:
+        for extravars in calls.get(instance.name, []):
+            if extravars.get("fake_host") != instance.name:
+                errors.append(f"{instance.name} ran with {extravars}")
+    return errors
+
+
+def check_cancel(instances, delay):
+    target = instances[0]
+    results = dict()
+
+    def run(instance):
+        try:
+            instance.run_ansible_role(rolename="stress")
+            results[instance.name] = "successful"
+        except AnsibleRunException:
+            results[instance.name] = "cancelled"
+
+    threads = [threading.Thread(target=run, args=(x,)) for x in instances]
+    for thread in threads:
+        thread.start()
+    time.sleep(delay / 2)
+    # Any new call to the instance takes it over
+    target.update_uuid()
+    for thread in threads:
+        thread.join()
+    errors = []
+    for name, result in results.items():
+        expected = "cancelled" if name == target.name else "successful"
+        if result != expected:
+            errors.append(f"{name} was {result}, expected {expected}")
+    print(f"Took over {target.name}: "
+          f"{list(results.values()).count('cancelled')} call(s) cancelled")
+    return errors
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Stress test per-instance execution channels")
+    parser.add_argument("-n", type=int, default=50, dest="count")
+    parser.add_argument("--delay", type=float, default=0.5)
+    args = parser.parse_args()
+
+    monkey_instance.run_ansible = lambda **kwargs: fake_run_ansible(
+        delay=args.delay, **kwargs)
+    instances = [FakeInstance(f"fake-{x}") for x in range(args.count)]
+    errors = check_parallel(instances, args.delay)
+    errors += check_cancel(instances, args.delay)
+    for error in errors:
+        print(f"FAILED: {error}")
+    if len(errors) > 0:
+        sys.exit(1)
+    print("All checks passed")
+
+
+if __name__ == '__main__':
+    main()